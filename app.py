@@ -2,36 +2,37 @@
 
 import dash
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import dash_core_components as dcc
+import dash_html_components as html
 
 import flask
-from flask_caching import Cache
+import numpy as np
 
 import figures
+import jobs
 import layouts
+import uploads
 import workers
 import os
 import shutil
+import time
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 
-# Local cache settings
-cache = Cache(app.server, config={
-    'CACHE_TYPE': 'filesystem',
-    'CACHE_DIR': 'cache-directory',
-    'CACHE_THRESHOLD': 50  # should be equal to maximum number of active users
-})
-cache.clear()
+# Fork the process pools while this is the only thread of the process
+workers.start_pools()
 
 # Enable multithreading through the "Server" call
 server = app.server
 
 app.config['suppress_callback_exceptions'] = True
 
-# Set up app layouts
-app.layout = layouts.app_layout()
+# Set up app layouts. The layout is a function so that every page load gets a
+# new session id.
+app.layout = layouts.app_layout
 
 
 # Create a TAPSuite-data folder in the user's home directory to store temp files
@@ -50,46 +51,171 @@ else:
 
 ######################################################################################
     
-# Save raw data from pulse files from the upload component
-# in hidden html.Divs.
+# Save raw data from pulse files from the upload component, or from the
+# datasets of finished streamed uploads, in hidden html.Divs.
 @app.callback(Output('data-tab1', 'children'),
-              [Input('upload-files', 'contents')],
+              [Input('upload-files', 'contents'),
+               Input('streamed-uploads', 'data')],
               [State('upload-files', 'filename'),
-               State('data-tab1', 'children')])
-@cache.memoize()
-def read_store_uploaded_files(list_of_contents, list_of_names, current_data):
-    
-    if list_of_contents is not None:
-        sorted_contents = [x for _,x in sorted(zip(list_of_names, list_of_contents))]
-        sorted_filenames = sorted(list_of_names)
-        list_of_data = [workers.load_data(c, n) for c, n in zip(sorted_contents, sorted_filenames)]
+               State('data-tab1', 'children'),
+               State('session-id', 'children')])
+def read_store_uploaded_files(list_of_contents, streamed, list_of_names, current_data, session):
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
 
-        children = [workers.update_database(list_of_data, current_data)]
+    if 'streamed-uploads.data' in triggered and streamed:
+        list_of_data, errors = uploads.load_finished(streamed)
 
-        return children
+    elif list_of_contents is not None:
+        list_of_data, errors = workers.load_all_data(list_of_contents, list_of_names)
+
+    else:
+        return current_data
+
+    raw_store, restored = workers.update_database(list_of_data, current_data, session)
+    children = [raw_store,
+                dcc.Store(id='upload-errors', data=errors),
+                dcc.Store(id='restored-corrections', data=restored)]
+
+    return children
+
+
+# Chunked upload route used by assets/stream_upload.js. Each POST carries one
+# chunk of a file; the response reports the upload status.
+@app.server.route('/dash/upload', methods=['POST'])
+def upload_chunk():
+    form = flask.request.form
+    try:
+        status = uploads.write_chunk(form['session'], form['upload_id'], form['filename'],
+                                     int(form['offset']), int(form['total']),
+                                     flask.request.files['chunk'].stream)
+    except (KeyError, ValueError) as e:
+        return flask.jsonify({'error': str(e)}), 400
+
+    return flask.jsonify(status)
+
+
+# Route used by assets/stream_upload.js to report an upload whose chunks could not
+# be sent, so that it ends in the 'error' state instead of waiting forever
+@app.server.route('/dash/upload/error', methods=['POST'])
+def upload_error():
+    form = flask.request.form
+    try:
+        status = uploads.fail_upload(form['session'], form['upload_id'], form['filename'],
+                                     form.get('error', 'upload failed'))
+    except (KeyError, ValueError) as e:
+        return flask.jsonify({'error': str(e)}), 400
+
+    return flask.jsonify(status)
+
+
+# Poll for streamed uploads only while some are pending. The hidden
+# "stream-upload-started" button is clicked by assets/stream_upload.js.
+@app.callback(Output('stream-upload-interval', 'disabled'),
+              [Input('stream-upload-started', 'n_clicks'),
+               Input('stream-upload-interval', 'n_intervals')],
+              [State('session-id', 'children')])
+def toggle_stream_interval(n_clicks, n_intervals, session):
+    if not n_clicks:
+        raise PreventUpdate
+
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if 'stream-upload-started.n_clicks' in triggered:
+        return False
+
+    return not uploads.list_uploads(session)
+
+
+# Show the progress of streamed uploads in this session
+@app.callback(Output('stream-upload-progress', 'children'),
+              [Input('stream-upload-interval', 'n_intervals')],
+              [State('session-id', 'children')])
+def show_stream_progress(n_intervals, session):
+    children = []
+    for status in uploads.list_uploads(session):
+        if status['state'] == 'uploading':
+            percent = 100.0*status['received']/max(status['total'], 1)
+            children.append(html.Div('{0}: {1:0.0f}% uploaded'.format(status['filename'], percent)))
+        elif status['state'] == 'parsing':
+            children.append(html.Div('{0}: reading pulses'.format(status['filename'])))
+
+    return children
+
+
+# Hand the dataset handles of finished streamed uploads to "data-tab1"
+@app.callback(Output('streamed-uploads', 'data'),
+              [Input('stream-upload-interval', 'n_intervals')],
+              [State('session-id', 'children')])
+def collect_streamed_uploads(n_intervals, session):
+    finished = uploads.consume_finished(session)
+    if not finished:
+        raise PreventUpdate
+
+    return finished
+
+
+# Report the uploaded files that could not be read
+@app.callback(Output('upload-status', 'children'),
+              [Input('data-tab1', 'children')])
+def show_upload_errors(raw_pulse_data):
+    if raw_pulse_data is not None and len(raw_pulse_data) > 1:
+        errors = raw_pulse_data[1]['props']['data']
+        return [html.Div('Could not read {0}'.format(error)) for error in errors]
 
     
-# Store 25 randomly generated pulses in the "condensed-data-tab1" dcc.Storage component
+# Store evenly spaced pulses of every AMU in the "condensed-data-tab1" dcc.Storage component
 # Use these data in the preprocessing section for faster responses.
 @app.callback(Output('condensed-data-tab1', 'data'),
               [Input('data-tab1', 'children')],
-              [State('condensed-data-tab1', 'data')])
-@cache.memoize()
-def store_condensed_tab1(raw_pulse_data, current_cond_data):
+              [State('condensed-data-tab1', 'data'),
+               State('session-id', 'children')])
+def store_condensed_tab1(raw_pulse_data, current_cond_data, session):
     if raw_pulse_data is not None:
-        data = workers.store_condensed(raw_pulse_data, current_cond_data)
+        data = workers.store_condensed(raw_pulse_data, current_cond_data, session)
 
         return data
                 
 
-# Generate 3D scatter plots for all data stored in Tab 1
-@app.callback(Output('3d-pulse-figs', 'children'),
-              [Input('condensed-data-tab1', 'data')])
-def generate_scatter3d(raw_data):
-    if raw_data is not None:
-        children = [figures.scatter3d(raw_data[k], k) for k in raw_data.keys()]
+# Generate 3D scatter plots for all data stored in Tab 1, drawn as lines or surfaces.
+# Every AMU keeps its slot and its figure is only sent again when its condensed
+# dataset or the mode changes; '3d-fig-keys' records what each slot shows.
+@app.callback([Output('3d-fig-slot-{0}'.format(i), 'children') for i in range(figures.SLOTS_3D)] +
+              [Output('3d-pulse-figs', 'children'),
+               Output('3d-fig-keys', 'data')],
+              [Input('condensed-data-tab1', 'data'),
+               Input('3d-mode-radioitems', 'value')],
+              [State('3d-fig-keys', 'data')])
+def generate_scatter3d(raw_data, mode, fig_keys):
+    if raw_data is None:
+        raise PreventUpdate
+
+    keys = dict((k, [k, raw_data[k]['id'], raw_data[k]['version'], mode]) for k in raw_data.keys())
+    if fig_keys is None:
+        fig_keys = {'slots': [None] * figures.SLOTS_3D, 'overflow': []}
+
+    # AMUs keep their slots and new AMUs take the first free ones
+    slots = [key[0] if key is not None and key[0] in keys else None for key in fig_keys['slots']]
+    for k in sorted(keys):
+        if k not in slots and None in slots:
+            slots[slots.index(None)] = k
+    overflow = [keys[k] for k in sorted(keys) if k not in slots]
+
+    children = []
+    for k, old_key in zip(slots, fig_keys['slots']):
+        if k is None:
+            children.append(dash.no_update if old_key is None else None)
+        elif keys[k] == old_key:
+            children.append(dash.no_update)
+        else:
+            children.append(figures.scatter3d(k, workers.condensed_figure(raw_data[k], mode)))
 
-        return children
+    if overflow == fig_keys['overflow']:
+        children.append(dash.no_update)
+    else:
+        children.append([figures.scatter3d(key[0], workers.condensed_figure(raw_data[key[0]], mode))
+                         for key in overflow])
+
+    return children + [{'slots': [keys[k] if k is not None else None for k in slots],
+                        'overflow': overflow}]
 
     
 # Generate dropdown in Tab 2 based on uploaded data in Tab 1
@@ -112,12 +238,14 @@ def update_amu_dropdown(raw_data):
 # baseline correction is enabled for the AMU chosen by user
 @app.callback(Output('baseline-corr-slider', 'children'),
               [Input('baseline-corr-radioitems', 'value'),
-               Input('amu-dropdown', 'value')],
+               Input('amu-dropdown', 'value'),
+               Input('baseline-windows-radioitems', 'value')],
               [State('condensed-data-tab1', 'data')])
-def update_baseline_corr_slider(corr, amu, raw_data):
+def update_baseline_corr_slider(corr, amu, n_windows, raw_data):
     if amu is not None:
-        dataset = raw_data[amu]
-        children = layouts.baseline_corr_slider(dataset, disable=not(corr))
+        dataset = workers.get_dataset(raw_data[amu])
+        children = layouts.baseline_corr_slider(dataset, disable=not(corr),
+                                                n_windows=n_windows or 1)
 
         return children
 
@@ -126,8 +254,11 @@ def update_baseline_corr_slider(corr, amu, raw_data):
 @app.callback(Output('slider-output', 'children'),
               [Input('time-range-slider', 'value')])
 def update_time_intervals(time_int):
-    if time_int != [1, 1]:
-        return 'Time interval chosen: {}'.format(time_int)
+    if time_int and set(time_int) != set([1]):
+        windows = [time_int[i:i+2] for i in range(0, len(time_int), 2)]
+        if len(windows) == 1:
+            return 'Time interval chosen: {}'.format(windows[0])
+        return 'Time intervals chosen: {}'.format(', '.join(str(w) for w in windows))
     else:
         return 'Baseline correction disabled'
 
@@ -163,15 +294,23 @@ def update_sg_window_size(order):
 # Perform all operations as set by the user.
 # Store corrected data in temp storage. This can be accessed by the user
 # to download xlsx files for the chosen amu.
+# In preview mode slider changes are answered with a correction of a small
+# preview of the dataset, and the full-resolution correction runs in the
+# background. The "full-res-interval" polls for it and swaps it in when ready.
 @app.callback(Output('temp-data', 'children'),
               [Input('data-tab1', 'children'),
                Input('amu-dropdown', 'value'),
                Input('time-range-slider', 'value'),
                Input('sg-window-size-slider', 'value'),
-               Input('sg-order-slider', 'value')],
+               Input('sg-order-slider', 'value'),
+               Input('full-res-interval', 'n_intervals')],
               [State('baseline-corr-radioitems', 'value'),
-               State('sg-radioitems', 'value')])
-def perform_correction(raw_pulse_data, amu, timespan, window_size, order, corr, smooth):
+               State('sg-radioitems', 'value'),
+               State('preview-radioitems', 'value'),
+               State('temp-data', 'children'),
+               State('session-id', 'children')])
+def perform_correction(raw_pulse_data, amu, timespan, window_size, order, n_intervals,
+                       corr, smooth, preview, current, session):
     if amu is not None:        
         if corr is True and smooth is True:
             x = 'baseline corr smooth pulses'
@@ -182,56 +321,201 @@ def perform_correction(raw_pulse_data, amu, timespan, window_size, order, corr,
         else:
             x = 'pulses'
 
-        dataset = dict(raw_pulse_data[0]['props']['data'])[amu]
-        corrected_dataset = workers.correct_data(dataset, x, timespan, corr,
-                                                 smooth, window_size, order)
+        raw_handle = dict(raw_pulse_data[0]['props']['data'])[amu]
         params = [amu, x, timespan, corr, smooth, window_size, order]
 
+        triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+        if triggered == ['full-res-interval.n_intervals']:
+            # Only a pending preview of the same params is replaced
+            if current is None:
+                raise PreventUpdate
+            current_data = current[0]['props']['data']
+            if not current_data.get('preview') or current_data['params'] != params:
+                raise PreventUpdate
+
+            corrected_dataset = workers.full_correction(session, raw_handle, params,
+                                                        current_data['requested'])
+            if corrected_dataset is None:
+                raise PreventUpdate
+            preview = False
+
+        elif preview is True and workers.correction_key(raw_handle, params) not in workers.correction_cache:
+            corrected_dataset = workers.preprocess(raw_handle, params, preview=True)
+            workers.schedule_full_correction(session, raw_handle, params)
+
+        else:
+            corrected_dataset = workers.get_corrected(raw_handle, params)
+            preview = False
+
         temp_data = {}
-        temp_data['data'] = corrected_dataset
+        temp_data['handle'] = workers.datastore.put(session, 'corrected/{0}'.format(amu),
+                                                    corrected_dataset)
+        temp_data['raw handle'] = raw_handle
         temp_data['params'] = params
+        temp_data['preview'] = preview
+        temp_data['requested'] = time.time()
         
         return [dcc.Store(id='blah', data=temp_data), x]
 
-    
-# Read the temp data and plot the average pulse 
-@app.callback(Output('avg-fig-tab2', 'children'),
+
+# Poll for the full-resolution correction only while a preview is shown
+@app.callback(Output('full-res-interval', 'disabled'),
               [Input('temp-data', 'children')])
-def plot_avg_pulse(stuff):
-    if stuff is not None:
-        temp_data, x = stuff
-        pulse_data = temp_data['props']['data']['data']
-        children = [figures.scatter(pulse_data, type_of_pulse=x)]
+def toggle_full_res_interval(stuff):
+    return not (stuff is not None and stuff[0]['props']['data'].get('preview'))
 
-        return children
+
+# Display whether the average pulse is a preview
+@app.callback(Output('preview-status', 'children'),
+              [Input('temp-data', 'children')])
+def show_preview_status(stuff):
+    if stuff is not None and stuff[0]['props']['data'].get('preview'):
+        return 'Preview of {0} pulses, computing full resolution...'.format(workers.PREVIEW_PULSES)
+
+
+# Read the temp data and plot the average pulse, and re-plot it at full detail for
+# the time range zoomed into, decimated to the whole pulse again when the zoom is
+# reset. New data only replaces the figure of the graph, at the range shown.
+@app.callback([Output('avg-pulse-graph', 'figure'),
+               Output('avg-fig-tab2', 'style')],
+              [Input('temp-data', 'children'),
+               Input('avg-pulse-graph', 'relayoutData')],
+              [State('avg-pulse-graph', 'figure')])
+def plot_avg_pulse(stuff, relayout_data, figure):
+    if stuff is None:
+        raise PreventUpdate
+
+    # A handle that has been replaced in the store belongs to a render that newer
+    # data has overtaken
+    temp_data = stuff[0]['props']['data']
+    try:
+        pulse_set = workers.get_dataset(temp_data['handle'])
+    except KeyError:
+        raise PreventUpdate
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if 'temp-data.children' in triggered:
+        x_range = figures.figure_range(figure, '{0:0.1f}'.format(pulse_set.amu))
+        style = figures.graph_style(True)
+    else:
+        x_range = figures.relayout_range(relayout_data)
+        if x_range is False:
+            raise PreventUpdate
+        style = dash.no_update
+
+    try:
+        times, avg_pulse = workers.avg_plot_data(temp_data, x_range)
+    except KeyError:
+        raise PreventUpdate
+
+    return figures.avg_figure(pulse_set, times, avg_pulse, x_range), style
+
+
+# Read the temp data and plot the heatmap of every pulse against time, and render
+# it again at full resolution for the time and pulse ranges zoomed into, and for
+# the whole dataset when the zoom is reset
+@app.callback([Output('heatmap-graph', 'figure'),
+               Output('heatmap-fig-tab2', 'style')],
+              [Input('temp-data', 'children'),
+               Input('heatmap-graph', 'relayoutData')],
+              [State('heatmap-graph', 'figure')])
+def plot_heatmap(stuff, relayout_data, figure):
+    if stuff is None:
+        raise PreventUpdate
+
+    temp_data = stuff[0]['props']['data']
+    try:
+        pulse_set = workers.get_dataset(temp_data['handle'])
+    except KeyError:
+        raise PreventUpdate
+    uirevision = '{0:0.1f}'.format(pulse_set.amu)
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if 'temp-data.children' in triggered:
+        x_range, y_range = False, False
+        style = figures.graph_style(True)
+    else:
+        x_range = figures.relayout_range(relayout_data)
+        y_range = figures.relayout_range(relayout_data, 'yaxis')
+        if x_range is False and y_range is False:
+            raise PreventUpdate
+        style = dash.no_update
+
+    # Axes that were not zoomed keep the range shown
+    if x_range is False:
+        x_range = figures.figure_range(figure, uirevision)
+    if y_range is False:
+        y_range = figures.figure_range(figure, uirevision, 'yaxis')
+
+    # Rows of the pulses shown, pulse numbers counting from 1
+    pulse_range = None
+    if y_range is not None:
+        first = min(max(int(np.floor(y_range[0] + 0.5)) - 1, 0), pulse_set.n_pulses - 1)
+        stop = min(max(int(np.ceil(y_range[1] - 0.5)), first + 1), pulse_set.n_pulses)
+        pulse_range = (first, stop)
+
+    try:
+        image, extent, vmin, vmax = workers.heatmap_data(temp_data, x_range, pulse_range)
+    except KeyError:
+        raise PreventUpdate
+
+    return figures.heatmap_figure(pulse_set, image, extent, vmin, vmax, x_range, y_range), style
 
 
 # Monitor and create new link for dynamically modified data, when new data is stored
 # in the temp stoarge as the preprocessing is performed by the user.
 # The href component of the download button is updated through the
-# Flask server route and an xlsx file is generated for download
+# Flask server route and a file in the selected format is generated for download
 @app.callback(Output('download-link-1', 'href'),
               [Input('temp-data', 'children'),
-               Input('amu-dropdown', 'value')],
-              [State('data-tab1', 'children')])
-def update_link1(temp_data_amu, amu, raw_data_dict):
+               Input('amu-dropdown', 'value'),
+               Input('export-format-radioitems', 'value')],
+              [State('data-tab1', 'children'),
+               State('session-id', 'children')])
+def update_link1(temp_data_amu, amu, fmt, raw_data_dict, session):
     if amu is not None:
-        raw_data = dict(raw_data_dict[0]['props']['data'])[amu]
-        amu, x, timespan, corr, smooth, window_size, order = temp_data_amu[0]['props']['data']['params']
+        # Nothing to download before the AMU has been corrected
+        if not temp_data_amu:
+            raise PreventUpdate
+
+        # Downloads are only made of full-resolution corrections
+        if temp_data_amu[0]['props']['data'].get('preview'):
+            raise PreventUpdate
 
-        corrected_dataset = workers.correct_data(raw_data, x, timespan, corr,
-                                                     smooth, window_size, order)
+        params = temp_data_amu[0]['props']['data']['params']
+        amu = params[0]
+        raw_handle = dict(raw_data_dict[0]['props']['data'])[amu]
+
+        corrected_dataset = workers.get_corrected(raw_handle, params)
         
-        workers.write_temp(corrected_dataset, x)
-        return '/dash/url?value={0}'.format(amu)
+        workers.datastore.put(session, 'export/{0}'.format(amu),
+                              {'data': corrected_dataset, 'params': params,
+                               'key': workers.correction_key(raw_handle, params)})
+        return '/dash/url?value={0}&session={1}&fmt={2}'.format(amu, session, fmt)
 
     
-# Defining the route for the download link and making the xslx available
+# Defining the route for the hit and miss counters of the result caches
+@app.server.route('/dash/cache-stats')
+def cache_stats():
+    return flask.jsonify(correction=workers.correction_cache.stats(),
+                         stages=workers.stage_cache.stats(),
+                         normalization=workers.normalization_cache.stats(),
+                         plot=workers.plot_cache.stats())
+
+
+# Defining the route for the download link and making the file available.
+# Repeat downloads carry the ETag of the file and get a 304 while it is unchanged.
 @app.server.route('/dash/url')
 def download_xlsx():
     amu = flask.request.args.get('value')
-    downloadlink = workers.create_download_link(amu)
-    return downloadlink
+    fmt = flask.request.args.get('fmt', 'xlsx')
+    try:
+        session = uploads.check_id(flask.request.args.get('session'))
+        downloadlink = workers.create_download_link(amu, session, fmt)
+    except ValueError:
+        flask.abort(400)
+    except KeyError:
+        flask.abort(404)
+
+    return downloadlink.make_conditional(flask.request)
 
     
 # Append temp params to existing params in the "temp-data-full" dcc.Store component
@@ -259,22 +543,102 @@ def reset_sg_sliders(amu):
 
 
 # Apply corrections to full dataset from "data-tab1" based on params stored in "temp-data-full" based on user's choice in "all-corr-radioitems"
-@app.callback(Output('data-tab2', 'data'),
+# The corrections run as a background job, which replaces any unfinished one;
+# its result is collected into "data-tab2" by polling.
+@app.callback(Output('apply-all-job', 'data'),
               [Input('all-corr-radioitems', 'value'),
                Input('full-temp-data', 'data')],
               [State('data-tab1', 'children'),
-               State('data-tab2', 'data')])
-def correct_store_pulses(all_corr, temp_data, raw_data_dict, current_temp_data):
+               State('data-tab2', 'data'),
+               State('apply-all-job', 'data'),
+               State('session-id', 'children')])
+def correct_store_pulses(all_corr, temp_data, raw_data_dict, current_temp_data, current_job, session):
     if all_corr is True:
-        return workers.correct_full_data(temp_data, raw_data_dict, current_temp_data)
+        if current_job is not None:
+            jobs.job_queue.cancel(current_job['id'])
 
+        job_id = jobs.job_queue.submit(
+            'apply-all',
+            lambda job: workers.correct_full_data(temp_data, raw_data_dict,
+                                                  current_temp_data, session, job=job))
+        return {'id': job_id}
 
-# Display message whether apply-all is enabled or not
+
+# Collect the result of the apply-all job when it is done, and the corrections
+# restored from saved sessions when they are uploaded
+@app.callback(Output('data-tab2', 'data'),
+              [Input('job-interval', 'n_intervals'),
+               Input('data-tab1', 'children')],
+              [State('apply-all-job', 'data'),
+               State('data-tab2', 'data')])
+def collect_apply_all(n_intervals, raw_pulse_data, job, current_data):
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if 'data-tab1.children' in triggered:
+        restored = raw_pulse_data[2]['props']['data'] if raw_pulse_data and len(raw_pulse_data) > 2 else None
+        if not restored:
+            raise PreventUpdate
+        result = dict(current_data or {})
+        result.update(restored)
+
+        return result
+
+    result = jobs.job_queue.collect(job['id']) if job is not None else None
+    if result is None:
+        raise PreventUpdate
+
+    return result
+
+
+# Function that describes the state of a background job for the status lines
+def job_status_text(job_id, done_text):
+    info = jobs.job_queue.status(job_id)
+    if info is None:
+        return None
+    if info['status'] == jobs.QUEUED:
+        return 'Waiting...'
+    if info['status'] == jobs.RUNNING:
+        return 'Working... {0:0.0f}%'.format(info['progress'])
+    if info['status'] == jobs.FAILED:
+        return 'Failed: {0}'.format(info['error'])
+    if info['status'] == jobs.CANCELLED:
+        return 'Cancelled'
+
+    return done_text
+
+
+# Display message whether apply-all is enabled or not, with the progress of the
+# apply-all job. The cancel button cancels the job.
 @app.callback(Output('apply-all', 'children'),
-              [Input('all-corr-radioitems', 'value')])
-def corr_status(value):
+              [Input('all-corr-radioitems', 'value'),
+               Input('job-interval', 'n_intervals'),
+               Input('cancel-apply-all-button', 'n_clicks')],
+              [State('apply-all-job', 'data')])
+def corr_status(value, n_intervals, n_clicks, job):
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if job is not None and 'cancel-apply-all-button.n_clicks' in triggered:
+        jobs.job_queue.cancel(job['id'])
+
     if value is True:
-        return 'Corrections applied to full data'
+        if job is None:
+            return 'Corrections applied to full data'
+        return job_status_text(job['id'], 'Corrections applied to full data')
+
+
+# Poll the job status only while a job is unfinished, or its result has not
+# been collected yet
+@app.callback(Output('job-interval', 'disabled'),
+              [Input('apply-all-job', 'data'),
+               Input('norm-job', 'data'),
+               Input('apply-all', 'children'),
+               Input('inert-output', 'children')])
+def toggle_job_interval(apply_all_job, norm_job, apply_all_status, norm_status):
+    for job in [apply_all_job, norm_job]:
+        info = jobs.job_queue.status(job['id']) if job is not None else None
+        if info is not None and (info['status'] not in jobs.FINISHED or
+                                 info['status'] == jobs.DONE and not info['collected']):
+            return False
+
+    return True
 
 
 # Update the inert normalization dropdown based on the amu keys stored in the
@@ -293,35 +657,101 @@ def update_inert_dropdown(current_data):
         return children
     
 
-# Inert normalize all data based on amu choice by user
-@app.callback(Output('inert-output', 'children'),
+# Inert normalize all data based on amu choice by user, as a background job
+@app.callback(Output('norm-job', 'data'),
               [Input('inert-dropdown', 'value')],
-              [State('data-tab2', 'data')])
-def update_text_do_norm(amu_inert, current_data):
+              [State('data-tab2', 'data'),
+               State('norm-job', 'data'),
+               State('session-id', 'children')])
+def update_text_do_norm(amu_inert, current_data, current_job, session):
     if amu_inert is not None:
-        workers.inert_normalization(amu_inert, current_data)
-        return 'Inert species AMU chosen: {0}'.format(amu_inert)
+        if current_job is not None:
+            jobs.job_queue.cancel(current_job['id'])
 
+        job_id = jobs.job_queue.submit(
+            'inert-normalization',
+            lambda job: workers.inert_normalization(amu_inert, current_data, session, job=job))
+        return {'id': job_id, 'amu': amu_inert}
 
-# Update inert normalization download link based on inert-dropdown choice
-# Combined xlsx is created on the fly when download button is clicked and
+
+# Display the progress of the inert normalization job. The cancel button cancels it.
+@app.callback(Output('inert-output', 'children'),
+              [Input('norm-job', 'data'),
+               Input('job-interval', 'n_intervals'),
+               Input('cancel-norm-button', 'n_clicks')])
+def show_norm_status(job, n_intervals, n_clicks):
+    if job is not None:
+        triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+        if 'cancel-norm-button.n_clicks' in triggered:
+            jobs.job_queue.cancel(job['id'])
+
+        return job_status_text(job['id'], 'Inert species AMU chosen: {0}'.format(job['amu']))
+
+
+# Update inert normalization download link once the normalization job is done
+# Combined file is created on the fly when download button is clicked and
 # user the latest data from tab 2
 @app.callback(Output('download-link-2', 'href'),
-              [Input('inert-dropdown', 'value')])
-def update_link2(amu_inert):
-    if amu_inert is not None:
-        return '/dash/url2?value={0}'.format(amu_inert)
-
-# Defining the route for the download link
+              [Input('inert-output', 'children'),
+               Input('export-format-radioitems', 'value')],
+              [State('norm-job', 'data'),
+               State('session-id', 'children')])
+def update_link2(status, fmt, job, session):
+    if job is not None:
+        info = jobs.job_queue.status(job['id'])
+        if info is not None and info['status'] == jobs.DONE:
+            return '/dash/url2?value={0}&session={1}&fmt={2}'.format(job['amu'], session, fmt)
+
+    raise PreventUpdate
+
+# Defining the route for the download link, with the same conditional requests
+# as /dash/url
 @app.server.route('/dash/url2')
 def download_xlsx_inert():
     amu_inert = flask.request.args.get('value')
-    downloadlink = workers.create_download_link_norm(amu_inert)
-
-    return downloadlink
+    fmt = flask.request.args.get('fmt', 'xlsx')
+    try:
+        session = uploads.check_id(flask.request.args.get('session'))
+        downloadlink = workers.create_download_link_norm(amu_inert, session, fmt)
+    except ValueError:
+        flask.abort(400)
+    except KeyError:
+        flask.abort(404)
+
+    return downloadlink.make_conditional(flask.request)
+
+# Save the session into a .tap container when the user clicks "Save" and point
+# the session download link to it
+@app.callback(Output('session-link', 'href'),
+              [Input('save-session-button', 'n_clicks')],
+              [State('data-tab1', 'children'),
+               State('data-tab2', 'data'),
+               State('session-id', 'children')])
+def save_session(n_clicks, raw_data_dict, current_data, session):
+    if n_clicks and raw_data_dict is not None:
+        workers.save_session(raw_data_dict, current_data,
+                             workers.session_path(uploads.check_id(session)))
+        return '/dash/session?value={0}&n={1}'.format(session, n_clicks)
+
+
+# Defining the route for the session download link
+@app.server.route('/dash/session')
+def download_session():
+    try:
+        session = uploads.check_id(flask.request.args.get('value'))
+    except ValueError:
+        flask.abort(400)
+
+    return flask.send_file(workers.session_path(session),
+                           mimetype='application/octet-stream',
+                           attachment_filename='TAPPy-session.tap',
+                           as_attachment=True,
+                           cache_timeout=0)
 
 # Run the app
+# The background jobs, the preview timers and the result caches live in the server
+# process, so requests are served by threads whatever the dataset store backend.
 if __name__ == '__main__':
 #    app.run_server(debug=True)
-    app.run_server(debug=True, processes=6)
+    app.run_server(debug=True, threaded=True)
 
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# On-disk cache of generated export files.
+#
+# Export files are generated while they are streamed to the first client that
+# asks for them, and written through to a file named after their key on the way,
+# so repeat downloads are served from disk. The key is a hash of what the file is
+# made of: the dataset ids and versions, the correction params and the format.
+# Changing the params in 'full-temp-data' changes the key, so stale files are
+# never served; they are evicted least-recently-used first once the cache grows
+# beyond max_artifact_bytes. Keys double as the ETags of the download routes.
+#
+# The cache lives in the TAPSuite-data folder, which the app clears at every
+# startup along with the dataset versions the keys are made of.
+
+import hashlib
+import os
+import tempfile
+
+savedir = os.path.join(os.path.expanduser('~'), 'TAPSuite-data')
+artifactdir = os.path.join(savedir, 'exports')
+
+# Maximum total size of the cache in bytes
+max_artifact_bytes = int(float(os.environ.get('TAPPY_EXPORT_CACHE_MB', 1024)) * 2**20)
+
+
+# Function that returns the key of an export file made of `parts`, tuples of
+# strings and numbers
+def artifact_key(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+# Function that returns the path of the cached file of a key, or None on a miss
+def lookup(key):
+    path = os.path.join(artifactdir, key)
+    try:
+        # mtime records the last access for LRU eviction
+        os.utime(path, None)
+    except OSError:
+        return None
+
+    return path
+
+
+# Function that yields the byte strings of `chunks` and writes them to the cache
+# under `key` as they pass. The file only enters the cache once every chunk has
+# been written, so a download that is interrupted caches nothing.
+def write_through(key, chunks):
+    if not os.path.exists(artifactdir):
+        try:
+            os.makedirs(artifactdir)
+        except OSError:
+            if not os.path.isdir(artifactdir):
+                raise
+
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=artifactdir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for data in chunks:
+                f.write(data)
+                yield data
+        os.rename(tmp, os.path.join(artifactdir, key))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    evict()
+
+
+# Function that removes least-recently-used files until the cache fits in
+# `max_bytes`
+def evict(max_bytes=None):
+    if max_bytes is None:
+        max_bytes = max_artifact_bytes
+
+    entries = []
+    for name in os.listdir(artifactdir):
+        path = os.path.join(artifactdir, name)
+        if name.startswith('.'):
+            continue
+        try:
+            entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        except OSError:
+            continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
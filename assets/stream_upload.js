@@ -0,0 +1,96 @@
+// Chunked upload of large pulse files to the /dash/upload route.
+//
+// Dash serves every file in assets/ automatically. Clicking the
+// "stream-upload-button" opens a file picker; the picked files are sent as a
+// sequence of multipart POSTs of CHUNK_SIZE bytes each, instead of being
+// base64-encoded into the dcc.Upload component. The server reports progress and
+// the parsed dataset handle back to the app, which polls for it with the
+// "stream-upload-interval" component. That interval is disabled until the hidden
+// "stream-upload-started" button is clicked here, and failed uploads are reported
+// to the /dash/upload/error route so that they show up as errors in the app.
+
+(function () {
+    var CHUNK_SIZE = 8 * 1024 * 1024;
+    var URL = '/dash/upload';
+    var ERROR_URL = '/dash/upload/error';
+
+    function newUploadId() {
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2, 10);
+    }
+
+    // Start polling for upload progress in the app
+    function notifyStarted() {
+        var button = document.getElementById('stream-upload-started');
+        if (button) {
+            button.click();
+        }
+    }
+
+    function reportFailure(session, uploadId, file, error) {
+        var form = new FormData();
+        form.append('session', session);
+        form.append('upload_id', uploadId);
+        form.append('filename', file.name);
+        form.append('error', error.message);
+
+        return fetch(ERROR_URL, {method: 'POST', body: form, credentials: 'same-origin'})
+            .catch(function (reportError) {
+                window.console.error(error, reportError);
+            })
+            .then(notifyStarted);
+    }
+
+    function postChunk(session, uploadId, file, offset) {
+        var end = Math.min(offset + CHUNK_SIZE, file.size);
+        var form = new FormData();
+        form.append('session', session);
+        form.append('upload_id', uploadId);
+        form.append('filename', file.name);
+        form.append('offset', offset);
+        form.append('total', file.size);
+        form.append('chunk', file.slice(offset, end), file.name);
+
+        return fetch(URL, {method: 'POST', body: form, credentials: 'same-origin'})
+            .then(function (response) {
+                if (!response.ok) {
+                    throw new Error('upload failed with HTTP status ' + response.status);
+                }
+                if (offset === 0) {
+                    notifyStarted();
+                }
+                return end < file.size ? postChunk(session, uploadId, file, end) : null;
+            });
+    }
+
+    // Files are uploaded one after the other so that the server parses them in
+    // the same order as they were selected. A failed file does not stop the rest.
+    function uploadFiles(session, files) {
+        return files.reduce(function (previous, file) {
+            return previous.then(function () {
+                var uploadId = newUploadId();
+                return postChunk(session, uploadId, file, 0).catch(function (error) {
+                    return reportFailure(session, uploadId, file, error);
+                });
+            });
+        }, Promise.resolve());
+    }
+
+    // The button is rendered by React after this script runs, so listen on the
+    // document instead of the element itself. The file input is never attached to
+    // the page, so React does not manage it.
+    document.addEventListener('click', function (event) {
+        if (event.target.id !== 'stream-upload-button') {
+            return;
+        }
+
+        var input = document.createElement('input');
+        input.type = 'file';
+        input.multiple = true;
+        input.addEventListener('change', function () {
+            var session = document.getElementById('session-id').textContent;
+            var files = Array.prototype.slice.call(input.files);
+            uploadFiles(session, files);
+        });
+        input.click();
+    });
+})();
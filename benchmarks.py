@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+# Micro-benchmarks for the processing routines in workers.py, compared against
+# the implementations they replaced. Run all of them with
+#
+#     python benchmarks.py
+#
+# or a subset by name, e.g. ``python benchmarks.py read_raw``.
+
+import io
+import json
+import multiprocessing
+import os
+import sys
+import timeit
+
+from math import factorial
+
+import numpy as np
+import plotly
+import plotly.graph_objs as go
+
+import decimation
+import exports
+import figures
+import pulseset
+import pyramid
+import workers
+
+testdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test-data')
+raw_files = sorted(os.path.join(testdir, f) for f in os.listdir(testdir) if f.endswith('p'))
+
+
+# Function that times a callable and returns the best of `repeat` runs in seconds
+def best_of(func, repeat=5, number=1):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+# Function that prints one result line of a benchmark
+def report(name, t_old, t_new):
+    print('{0:<40s} {1:10.2f} ms {2:10.2f} ms {3:8.1f}x'.format(
+        name, 1e3*t_old, 1e3*t_new, t_old/t_new))
+
+
+# Function that builds an in-memory TAP-1 raw file with `n_pulses` pulses by
+# tiling the pulses of the first test file
+def scaled_raw_file(n_pulses):
+    with open(raw_files[0], 'rb') as f:
+        lines = f.read().splitlines()
+
+    header, body = lines[:20], lines[20:]
+    header[2+7] = ' {0} '.format(n_pulses).encode('ascii')
+    n_datapts = int(header[2+3])
+    n_tiles = -(-n_pulses*n_datapts // len(body))
+    body = (body * n_tiles)[:n_pulses*n_datapts]
+
+    return b'\r\n'.join(header + body) + b'\r\n'
+
+
+######################################################################################
+
+# Reference implementations
+
+######################################################################################
+
+# The np.loadtxt based TAP-1 parser that workers.read_raw replaced
+def read_raw_loadtxt(fil):
+    d = np.loadtxt(fil, skiprows=1)
+    n_datapts = int(d[3])
+    n_pulses = int(d[7])
+    pulse_data = d[18:]
+
+    return np.array([pulse_data[i*n_datapts:(i+1)*n_datapts:1] for i in range(n_pulses)])
+
+
+# The per-pulse baseline correction that workers.correct_baseline replaced
+def correct_baseline_loop(pulses, times, timespan):
+    pulses = np.array([np.array(pulse) for pulse in pulses])
+    t1, t2 = timespan
+    indx = (times>=t1) & (times<=t2)
+
+    select_pulses = np.array([pulse[indx] for pulse in pulses])
+    avg_spans = np.mean(select_pulses, axis=1)
+
+    return np.array([pulse - avg_spans[i] for i, pulse in enumerate(pulses)])
+
+
+# The per-pulse Savitzky-Golay filter that workers.savitzky_golay_pulses replaced,
+# which recomputes its coefficients on every call
+def savitzky_golay_pinv(y, window_size, order, deriv=0, rate=1):
+#    Taken from https://scipy-cookbook.readthedocs.io/items/SavitzkyGolay.html
+#    Have not really thought much about it. Hopefully works for all cases!
+
+    try:
+        window_size = np.abs(np.int(window_size))
+        order = np.abs(np.int(order))
+    except ValueError:
+        raise ValueError("window_size and order have to be of type int")
+
+    if window_size % 2 != 1 or window_size < 1:
+        raise TypeError("window_size size must be a positive odd number")
+
+    if window_size < order + 2:
+        raise TypeError("window_size is too small for the polynomials order")
+
+    order_range = range(order+1)
+    half_window = (window_size -1) // 2
+
+    b = np.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
+    m = np.linalg.pinv(b).A[deriv] * rate**deriv * factorial(deriv)
+
+    firstvals = y[0] - np.abs( y[1:half_window+1][::-1] - y[0] )
+    lastvals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
+    y = np.concatenate((firstvals, y, lastvals))
+
+    return np.convolve( m[::-1], y, mode='valid')
+
+
+# The per-pulse inert normalization that workers.normalize_pulses replaced,
+# without writing its results to disk
+def inert_normalization_loop(amu_inert, pulses_data_all, times):
+    from scipy.integrate import trapz
+
+    amus = pulses_data_all.keys()
+    pulses_combined = [pulses_data_all[amu] for amu in amus]
+
+    inert_index = amus.index(amu_inert)
+    pulses_areas = [np.array([trapz(pulse, times) for pulse in pulses]) for pulses in pulses_combined]
+    inert_areas = pulses_areas[inert_index]
+    inert_coeffs = np.array(inert_areas / max(inert_areas))
+
+    return dict((amu, np.array([pulse/k for (pulse, k) in zip(pulses, inert_coeffs)]))
+                for (pulses, amu) in zip(np.array(pulses_combined), amus))
+
+
+######################################################################################
+
+# Benchmarks
+
+######################################################################################
+
+def bench_read_raw():
+    for n_pulses in [50, 500, 2000]:
+        raw = scaled_raw_file(n_pulses)
+        repeat = 3 if n_pulses > 500 else 5
+
+        t_old = best_of(lambda: read_raw_loadtxt(io.BytesIO(raw)), repeat=repeat)
+        t_new = best_of(lambda: workers.read_raw(io.BytesIO(raw)), repeat=repeat)
+        report('read_raw ({0} pulses)'.format(n_pulses), t_old, t_new)
+
+
+# Parsing, correction and areas in float32 against float64, on the test data
+# scaled up. Memory is the size of the pulse array.
+def bench_precision():
+    for n_pulses in [500, 2000]:
+        raw = scaled_raw_file(n_pulses)
+        results = {}
+        for precision in pulseset.PRECISIONS:
+            pulseset.set_precision(precision)
+            pulse_set = workers.read_raw(io.BytesIO(raw))
+            times = pulse_set.times
+            timespan = [times[-1]*0.8, times[-1]]
+
+            results[precision] = (
+                pulse_set.nbytes,
+                best_of(lambda: workers.read_raw(io.BytesIO(raw)), repeat=3),
+                best_of(lambda: workers.correct_data(pulse_set, timespan, True, False, 11, 3)),
+                best_of(lambda: workers.get_areas(pulse_set.pulses, times)))
+
+        pulseset.set_precision('float64')
+        old, new = results['float64'], results['float32']
+        print('{0:<40s} {1:10.1f} MB {2:10.1f} MB {3:8.1f}x'.format(
+            'pulse memory ({0} pulses)'.format(n_pulses), old[0]/2.0**20, new[0]/2.0**20, float(old[0])/new[0]))
+        for i, stage in enumerate(['read_raw', 'baseline correction', 'areas'], 1):
+            report('float32 {0} ({1} pulses)'.format(stage, n_pulses), old[i], new[i])
+
+
+def bench_baseline():
+    for n_pulses in [500, 2000, 5000]:
+        pulse_set = workers.read_raw(io.BytesIO(scaled_raw_file(n_pulses)))
+        times = pulse_set.times
+        timespan = [times[-1]*0.8, times[-1]]
+        pulse_list = list(pulse_set.pulses)
+
+        t_old = best_of(lambda: correct_baseline_loop(pulse_list, times, timespan))
+        t_new = best_of(lambda: workers.correct_baseline(pulse_set.pulses, times, timespan))
+        report('baseline correction ({0} pulses)'.format(n_pulses), t_old, t_new)
+
+        drift = [times[0], times[-1]*0.05, times[-1]*0.8, times[-1]]
+        t_drift = best_of(lambda: workers.correct_baseline(pulse_set.pulses, times, drift))
+        report('two-window baseline ({0} pulses)'.format(n_pulses), t_old, t_drift)
+
+
+def bench_savitzky_golay():
+    for n_pulses in [500, 2000]:
+        pulses = workers.read_raw(io.BytesIO(scaled_raw_file(n_pulses))).pulses
+        for window_size, order in [(11, 3), (51, 5)]:
+            t_old = best_of(lambda: np.array([savitzky_golay_pinv(pulse, window_size, order)
+                                              for pulse in pulses]), repeat=3)
+            t_new = best_of(lambda: workers.savitzky_golay_pulses(pulses, window_size, order))
+            report('savitzky-golay w={0} o={1} ({2} pulses)'.format(window_size, order, n_pulses),
+                   t_old, t_new)
+
+
+# Apply-all on 10 AMUs, serial against the process pool. The speedup depends on
+# the number of cores; a single-core box only shows the overhead of the pool.
+def bench_correct_full():
+    from store import correction_cache, datastore, stage_cache
+
+    pulse_set = workers.read_raw(io.BytesIO(scaled_raw_file(2000)))
+    raw_data, temp_data = {}, {}
+    for k in range(10):
+        amu = '{0:0.1f}'.format(k)
+        raw_data[amu] = datastore.put('benchmarks', 'raw/{0}'.format(amu),
+                                      pulse_set.with_pulses(pulse_set.pulses * (k + 1)))
+        temp_data[amu] = [amu, 'baseline corr smooth pulses', [0.8, 1.0], True, True, 21, 3]
+    raw_data_dict = [{'props': {'data': raw_data}}]
+
+    def run(pool):
+        correction_cache.clear()
+        stage_cache.clear()
+        workers.correct_full_data(temp_data, raw_data_dict, None, 'benchmarks', pool=pool)
+
+    processes = max(multiprocessing.cpu_count(), 2)
+    pool = multiprocessing.Pool(processes)
+    t_old = best_of(lambda: run(None), repeat=3)
+    t_new = best_of(lambda: run(pool), repeat=3)
+    pool.terminate()
+    report('apply-all, 10 AMUs ({0} processes, {1} cores)'.format(
+        processes, multiprocessing.cpu_count()), t_old, t_new)
+    datastore.drop_session('benchmarks')
+
+
+def bench_inert_normalization():
+    pulse_set = workers.read_raw(io.BytesIO(scaled_raw_file(2000)))
+    for n_amus in [3, 10]:
+        pulse_sets = dict(('{0:0.1f}'.format(k), pulse_set.with_pulses(pulse_set.pulses * (k + 1)))
+                          for k in range(n_amus))
+        pulses = dict((amu, ps.pulses) for amu, ps in pulse_sets.items())
+
+        t_old = best_of(lambda: inert_normalization_loop('0.0', pulses, pulse_set.times), repeat=3)
+        t_new = best_of(lambda: workers.normalize_pulses('0.0', pulse_sets), repeat=3)
+        report('inert normalization ({0} AMUs x 2000 pulses)'.format(n_amus), t_old, t_new)
+
+
+# Generation time and size of every export format against xlsx, for one corrected
+# AMU of the test data scaled up, with noise so that the tiled pulses do not
+# compress better than real ones
+def bench_export():
+    pulse_set = workers.read_raw(io.BytesIO(scaled_raw_file(500)))
+    pulse_set = pulse_set.with_pulses(pulse_set.pulses + np.random.RandomState(0).normal(
+        0, 1e-4, pulse_set.pulses.shape))
+    metas = [exports.dataset_meta(pulse_set)]
+
+    # Function that generates an export and returns its size in bytes
+    def generate(fmt):
+        return sum(len(data) for data in exports.export(fmt, ['{0:0.1f}'.format(pulse_set.amu)], [pulse_set], metas)[2])
+
+    size_xlsx = generate('xlsx')
+    t_xlsx = best_of(lambda: generate('xlsx'), repeat=3)
+    for fmt in exports.FORMATS:
+        if fmt != 'xlsx':
+            size = generate(fmt)
+            report('export {0} vs xlsx (500 pulses)'.format(fmt), t_xlsx,
+                   best_of(lambda: generate(fmt), repeat=3))
+            print('{0:<40s} {1:10.1f} MB {2:10.1f} MB {3:8.1f}x'.format(
+                'export {0} size vs xlsx'.format(fmt), size_xlsx/2.0**20, size/2.0**20, float(size_xlsx)/size))
+
+# Zoom windows of a long trace served from its pyramid against min/max
+# decimation of the full-resolution data, for the whole trace and a zoomed-in
+# tenth of it
+def bench_pyramid():
+    for n in [10**5, 10**6]:
+        x = np.linspace(0, 1, n)
+        y = np.exp(-((x - 0.1) / 0.01)**2) + np.random.RandomState(0).normal(0, 1e-3, n)
+        tree = pyramid.Pyramid(y, x[0], x[1] - x[0])
+        for x_range in [None, (0.05, 0.15)]:
+            t_old = best_of(lambda: decimation.decimate(x, y, 2000, x_range, method='minmax'))
+            t_new = best_of(lambda: tree.envelope(2000, x_range))
+            report('zoom {0} ({1} points)'.format('whole' if x_range is None else 'tenth', n),
+                   t_old, t_new)
+
+
+# Pulse heatmap of 2000 pulses as a PNG raster served from the pyramid of the
+# pulses, against a plotly heatmap of the whole pulse matrix serialized to JSON
+def bench_heatmap():
+    pulse_set = workers.read_raw(io.BytesIO(scaled_raw_file(2000)))
+    tree = pyramid.Pyramid(pulse_set.pulses, pulse_set.t0, pulse_set.dt)
+
+    # Function that renders the raster and returns its size in bytes
+    def raster():
+        means = tree.window(figures.RASTER_WIDTH, None, figures.RASTER_HEIGHT)[4]
+        return len(figures.raster_png(means[::-1], pulse_set.pulses.min(), pulse_set.pulses.max()))
+
+    # Function that serializes the heatmap figure and returns its size in bytes
+    def heatmap_json():
+        return len(json.dumps(go.Heatmap(z=pulse_set.pulses, x=pulse_set.times).to_plotly_json(),
+                              cls=plotly.utils.PlotlyJSONEncoder))
+
+    report('heatmap (2000 pulses)', best_of(heatmap_json, repeat=1), best_of(raster, repeat=3))
+    size_old, size_new = heatmap_json(), raster()
+    print('{0:<40s} {1:10.2f} MB {2:10.2f} MB {3:8.1f}x'.format(
+        'heatmap size', size_old/2.0**20, size_new/2.0**20, float(size_old)/size_new))
+
+benchmarks = [('read_raw', bench_read_raw),
+              ('baseline', bench_baseline),
+              ('savitzky_golay', bench_savitzky_golay),
+              ('correct_full', bench_correct_full),
+              ('inert_normalization', bench_inert_normalization),
+              ('precision', bench_precision),
+              ('export', bench_export),
+              ('pyramid', bench_pyramid),
+              ('heatmap', bench_heatmap)]
+
+
+if __name__ == '__main__':
+    selected = sys.argv[1:]
+    print('{0:<40s} {1:>13s} {2:>13s} {3:>9s}'.format('benchmark', 'before', 'after', 'speedup'))
+    for name, bench in benchmarks:
+        if not selected or name in selected:
+            bench()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# Native TAPPy dataset container (.tap).
+#
+# A .tap file holds any number of datasets, one per AMU, and is laid out as
+#
+#     offset 0   magic         8 bytes  b'TAPPY\x00\x00\x00'
+#     offset 8   version       uint32, little-endian
+#     offset 12  header size   uint32, little-endian, in bytes
+#     offset 16  header        UTF-8 JSON, padded with spaces
+#     data start               first multiple of ALIGN after the header
+#
+# The JSON header is
+#
+#     {"version": 1,
+#      "datasets": [{"name": "28.0",
+#                    "meta": {"amu": 28.0, "gain": 9, ...},
+#                    "arrays": {"pulses": {"offset": 0, "shape": [50, 1000], "dtype": "<f8"},
+#                               "times": {...}, ...}},
+#                   ...]}
+#
+# where "meta" holds every JSON-serializable value of the dataset dict and
+# "arrays" every array, stored C-ordered at "offset" bytes from the data start.
+# Offsets are multiples of ALIGN. Pulse arrays are (n_pulses, n_datapoints), so
+# a range of pulses is one contiguous block and can be memory-mapped on its own.
+
+import io
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'TAPPY\x00\x00\x00'
+VERSION = 1
+ALIGN = 64
+
+_prefix = struct.Struct('<8sII')
+
+
+# Function that rounds `n` up to the next multiple of ALIGN
+def _aligned(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+# Function that writes datasets, a dict of name (AMU label) to dataset dict, into
+# a .tap container at `fil`, a path or a writable binary file object
+def write_container(fil, datasets):
+    entries = []
+    arrays = []
+    offset = 0
+    for name in sorted(datasets.keys()):
+        meta = {}
+        entry_arrays = {}
+        for k, v in datasets[name].items():
+            if isinstance(v, np.ndarray):
+                arr = np.ascontiguousarray(v)
+                entry_arrays[k] = {'offset': offset,
+                                   'shape': list(arr.shape),
+                                   'dtype': arr.dtype.newbyteorder('<').str}
+                arrays.append((offset, arr.astype(arr.dtype.newbyteorder('<'), copy=False)))
+                offset = _aligned(offset + arr.nbytes)
+            else:
+                meta[k] = v
+
+        entries.append({'name': name, 'meta': meta, 'arrays': entry_arrays})
+
+    header = json.dumps({'version': VERSION, 'datasets': entries}).encode('utf-8')
+    data_start = _aligned(_prefix.size + len(header))
+    header = header.ljust(data_start - _prefix.size, b' ')
+
+    own = not hasattr(fil, 'write')
+    f = open(fil, 'wb') if own else fil
+    try:
+        start = f.tell()
+        f.write(_prefix.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        for arr_offset, arr in arrays:
+            pos = f.tell() - start - data_start
+            f.write(b'\x00' * (arr_offset - pos))
+            if own:
+                arr.tofile(f)
+            else:
+                f.write(arr.tobytes())
+    finally:
+        if own:
+            f.close()
+
+
+# Function that reads the header of a container. Returns the parsed JSON header
+# and the absolute offset of the data start.
+def read_header(fil):
+    prefix = fil.read(_prefix.size)
+    if len(prefix) < _prefix.size:
+        raise ValueError('Not a TAPPy container: file is too short')
+
+    magic, version, header_size = _prefix.unpack(prefix)
+    if magic != MAGIC:
+        raise ValueError('Not a TAPPy container: bad magic {0!r}'.format(magic))
+    if version > VERSION:
+        raise ValueError('TAPPy container version {0} is newer than the supported '
+                         'version {1}'.format(version, VERSION))
+
+    header = json.loads(fil.read(header_size).decode('utf-8'))
+
+    return header, _aligned(_prefix.size + header_size)
+
+
+# Function that reads datasets from a container, a path or a binary file object.
+# `amus` restricts the datasets read and `pulses` (a slice) the range of pulses.
+# From a path the arrays are read-only np.memmap views of the file; from a file
+# object they are views of its bytes. Either way nothing is parsed or copied.
+def read_container(fil, amus=None, pulses=None):
+    if hasattr(fil, 'read'):
+        fil.seek(0)
+        buf = fil.read()
+        header, data_start = read_header(io.BytesIO(buf))
+        path = None
+    else:
+        with open(fil, 'rb') as f:
+            header, data_start = read_header(f)
+        path = fil
+
+    datasets = {}
+    for entry in header['datasets']:
+        name = entry['name']
+        if amus is not None and name not in amus:
+            continue
+
+        dataset = dict(entry['meta'])
+        n_pulses = dataset.get('n_pulses')
+        for k, spec in entry['arrays'].items():
+            dtype = np.dtype(str(spec['dtype']))
+            shape = tuple(spec['shape'])
+            offset = data_start + spec['offset']
+
+            # Only arrays with one row per pulse are cut to the pulse range
+            if pulses is not None and len(shape) == 2 and shape[0] == n_pulses:
+                start, stop, step = pulses.indices(shape[0])
+                offset += start * shape[1] * dtype.itemsize
+                shape = (max(stop - start, 0), shape[1])
+                row_step = step
+            else:
+                row_step = 1
+
+            count = int(np.prod(shape))
+            if count == 0:
+                arr = np.empty(shape, dtype=dtype)
+            elif path is not None:
+                arr = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+            else:
+                arr = np.frombuffer(buf, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+            dataset[k] = arr[::row_step] if row_step != 1 else arr
+
+        if pulses is not None and 'pulses' in dataset:
+            dataset['n_pulses'] = len(dataset['pulses'])
+
+        datasets[name] = dataset
+
+    return datasets
+
+
+# Function that lists the dataset names in a container without reading any array
+def list_datasets(fil):
+    if hasattr(fil, 'read'):
+        fil.seek(0)
+        header, _ = read_header(fil)
+    else:
+        with open(fil, 'rb') as f:
+            header, _ = read_header(f)
+
+    return [entry['name'] for entry in header['datasets']]
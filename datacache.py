@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# Persistent on-disk cache of parsed pulse files.
+#
+# Each parsed file is stored in its own directory, named after a hash of the raw
+# file contents, as .npy files of the arrays of every PulseSet, its pulses and
+# the corrected pulses of a saved session, plus a meta.json sidecar holding the
+# metadata. Arrays are loaded back memory-mapped, so a cache hit costs a
+# few file opens instead of a full parse. The cache lives outside the
+# TAPSuite-data folder, which the app clears at every startup, and is capped in
+# size with least-recently-used entries evicted first.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import pulseset
+from pulseset import PulseSet
+
+home = os.path.expanduser('~')
+cachedir = os.environ.get('TAPPY_CACHE_DIR', os.path.join(home, 'TAPSuite-cache'))
+
+# Maximum total size of the cache in bytes
+max_cache_bytes = int(float(os.environ.get('TAPPY_CACHE_MAX_MB', 2048)) * 2**20)
+
+# Bumped whenever the parsers or the layout below change, so that stale entries
+# are treated as misses instead of being loaded
+CACHE_VERSION = 3
+
+META_FILE = 'meta.json'
+
+
+# Function that returns the cache key of a raw file. The file extension is part
+# of the key because it decides which parser is used.
+def content_key(raw, extn):
+    h = _new_hash(extn)
+    h.update(raw)
+
+    return h.hexdigest()
+
+
+# Function that returns the cache key of a raw file on disk, hashed in blocks
+def file_key(path, extn, block_size=1 << 20):
+    h = _new_hash(extn)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+# Function that starts a content hash, salted with the cache version, the extension
+# and the precision of the pulse arrays, so that files parsed at one precision are
+# never served to a run at another
+def _new_hash(extn):
+    h = hashlib.sha1()
+    h.update('{0}:{1}:{2}:'.format(CACHE_VERSION, extn, pulseset.dtype.name).encode('ascii'))
+
+    return h
+
+
+# Function that returns the cache entry directory for a key
+def entry_path(key):
+    return os.path.join(cachedir, key)
+
+
+# Function that stores a parsed file under `key`. A TAP-1 file parses into a
+# single PulseSet, a TAP-2/3 workbook into a dict of PulseSets keyed by AMU; both
+# are written into the same layout with one sub-name per PulseSet.
+def store(key, data):
+    if not os.path.exists(cachedir):
+        try:
+            os.makedirs(cachedir)
+        except OSError:
+            if not os.path.isdir(cachedir):
+                raise
+
+    combined = not isinstance(data, PulseSet)
+    datasets = data if combined else {'': data}
+
+    # Entries are written to a temporary directory first and renamed into place,
+    # so concurrent readers never see a half-written entry.
+    tmp = tempfile.mkdtemp(prefix='.tmp-', dir=cachedir)
+    try:
+        meta = {'version': CACHE_VERSION, 'combined': combined, 'datasets': {}}
+        for i, (name, pulse_set) in enumerate(sorted(datasets.items())):
+            ds_meta = pulse_set.to_dict()
+            arrays = [k for k, v in ds_meta.items() if isinstance(v, np.ndarray)]
+            for k in arrays:
+                np.save(os.path.join(tmp, '{0}-{1}.npy'.format(i, k)), ds_meta.pop(k))
+            meta['datasets'][name] = {'file index': i, 'arrays': arrays, 'meta': ds_meta}
+
+        with open(os.path.join(tmp, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+        try:
+            os.rename(tmp, entry_path(key))
+        except OSError:
+            # Another process stored the same file first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    evict()
+
+
+# Function that loads a cached parsed file, or returns None on a miss.
+# Pulses are memory-mapped read-only.
+def load(key, mmap_mode='r'):
+    path = entry_path(key)
+    try:
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if meta.get('version') != CACHE_VERSION:
+        return None
+
+    datasets = {}
+    try:
+        for name, entry in meta['datasets'].items():
+            ds_meta = dict(entry['meta'])
+            for k in entry['arrays']:
+                ds_meta[k] = np.load(os.path.join(path, '{0}-{1}.npy'.format(entry['file index'], k)),
+                                     mmap_mode=mmap_mode)
+            datasets[name] = PulseSet.from_dict(ds_meta)
+
+    except (IOError, OSError, ValueError):
+        # Entry evicted or damaged while reading
+        return None
+
+    # Directory mtime records the last access for LRU eviction
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+    if meta['combined']:
+        return datasets
+    else:
+        return datasets['']
+
+
+# Function that returns the size on disk of a cache entry
+def entry_size(path):
+    size = 0
+    for fname in os.listdir(path):
+        size += os.path.getsize(os.path.join(path, fname))
+
+    return size
+
+
+# Function that removes least-recently-used entries until the cache fits in
+# `max_bytes`
+def evict(max_bytes=None):
+    if max_bytes is None:
+        max_bytes = max_cache_bytes
+
+    entries = []
+    for name in os.listdir(cachedir):
+        path = os.path.join(cachedir, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        try:
+            entries.append((os.path.getmtime(path), entry_size(path), path))
+        except OSError:
+            continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+# Function that empties the cache
+def clear():
+    if os.path.exists(cachedir):
+        shutil.rmtree(cachedir)
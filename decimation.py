@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# Decimation of traces for plotting.
+#
+# A plot is a few hundred to a few thousand pixels wide, so sending every time
+# point of a 10k+ point pulse to the browser only costs bandwidth and rendering
+# time. Traces are reduced to a target number of points before they are plotted,
+# with methods that keep the shape of the peak and the extrema of the signal
+# rather than every n-th point:
+#
+#     lttb     Largest-Triangle-Three-Buckets: one point per bucket, the one
+#              spanning the largest triangle with its neighbours. Follows the
+#              visual shape of the trace closely.
+#     minmax   the minimum and maximum of every bin, in the order they occur.
+#              Keeps every extremum exactly, at two points per bin.
+#
+# The method of the 2D plots is chosen with TAPPY_DECIMATION; 3D plots of many
+# pulses always use min/max bins on a shared time axis, see minmax_pulses. The
+# plots of tab 2 serve min/max bins from the pyramids of pyramid.py instead of
+# the data, so they are the default.
+
+import os
+
+import numpy as np
+
+METHODS = ('lttb', 'minmax')
+
+# Number of points of the 2D plots, for the whole trace or the zoomed-in range
+PLOT_POINTS = int(os.environ.get('TAPPY_PLOT_POINTS', 2000))
+
+# Method of decimate when none is given
+default_method = os.environ.get('TAPPY_DECIMATION', 'minmax')
+
+
+# Function that returns the indices of the `n_out` points of (x, y) selected by
+# Largest-Triangle-Three-Buckets. The first and last points are always kept.
+def lttb(x, y, n_out):
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # Boundaries of the n_out - 2 buckets between the first and the last point
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    edges = np.append(edges, n)
+
+    inds = np.empty(n_out, dtype=np.intp)
+    inds[0] = 0
+    inds[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_x = x[hi:edges[i + 2]].mean()
+        next_y = y[hi:edges[i + 2]].mean()
+
+        # Twice the area of the triangle of the previous point, each point of the
+        # bucket and the average of the next bucket
+        area = np.abs((x[a] - next_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y - y[a]))
+        a = lo + int(area.argmax())
+        inds[i + 1] = a
+
+    return inds
+
+
+# Function that returns the index of the minimum and the maximum of the bins of
+# `y` along its last axis, `width` points wide, each pair in the order they occur.
+# The last bin is padded with its last point.
+def _minmax_bins(y, width):
+    n = y.shape[-1]
+    n_bins = -(-n // width)
+    pad = n_bins * width - n
+    if pad:
+        y = np.pad(y, [(0, 0)] * (y.ndim - 1) + [(0, pad)], mode='edge')
+
+    bins = y.reshape(y.shape[:-1] + (n_bins, width))
+    imin = bins.argmin(axis=-1)
+    imax = bins.argmax(axis=-1)
+    offsets = np.arange(n_bins) * width
+
+    first = np.minimum(imin, imax) + offsets
+    second = np.maximum(imin, imax) + offsets
+
+    return np.minimum(first, n - 1), np.minimum(second, n - 1)
+
+
+# Function that returns the indices of the minimum and maximum of n_out/2 bins of
+# `y`, at most `n_out` points, and of its first and last points
+def minmax(y, n_out):
+    n = len(y)
+    if n_out >= n or n_out < 4:
+        return np.arange(n)
+
+    width = -(-n // (n_out // 2))
+    first, second = _minmax_bins(y, width)
+    inds = np.stack([first, second], axis=-1).ravel()
+
+    return np.unique(np.concatenate([[0], inds, [n - 1]]))
+
+
+# Function that reduces the trace (x, y) to about `n_out` points with `method`,
+# 'lttb' or 'minmax', default_method if None. `x_range`, (x0, x1), restricts the
+# trace to the points in the range and the first point on either side of it, so
+# that a zoomed-in trace reaches the edges of the plot. Returns the decimated x
+# and y.
+def decimate(x, y, n_out, x_range=None, method=None):
+    if method is None:
+        method = default_method
+    if method not in METHODS:
+        raise ValueError('Unknown decimation method {0!r}, expected one of {1}'.format(
+            method, ', '.join(METHODS)))
+
+    if x_range is not None:
+        start = max(int(np.searchsorted(x, x_range[0], side='left')) - 1, 0)
+        stop = int(np.searchsorted(x, x_range[1], side='right')) + 1
+        x = x[start:stop]
+        y = y[start:stop]
+
+    if len(x) <= n_out:
+        return x, y
+
+    if method == 'lttb':
+        inds = lttb(x, y, n_out)
+    else:
+        inds = minmax(y, n_out)
+
+    return x[inds], y[inds]
+
+
+# Function that reduces every pulse of `pulses`, an (n_pulses, n_datapoints)
+# array on the time axis `times`, to the minimum and maximum of at most n_out/2
+# bins, so that all pulses share one decimated time axis as 3D plots need. Each
+# pair of points is placed at the start and the middle of its bin. Returns the
+# decimated times and pulses.
+def minmax_pulses(times, pulses, n_out):
+    n = pulses.shape[-1]
+    if n_out >= n or n_out < 4:
+        return times, pulses
+
+    width = -(-n // (n_out // 2))
+    first, second = _minmax_bins(pulses, width)
+    inds = np.stack([first, second], axis=-1).reshape(pulses.shape[0], -1)
+
+    starts = np.arange(0, n, width)
+    bin_times = np.stack([times[starts], times[np.minimum(starts + width // 2, n - 1)]], axis=-1)
+
+    return bin_times.ravel(), np.take_along_axis(pulses, inds, axis=-1)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+# Export files of processed pulses for the download links.
+#
+# Every format is generated as a sequence of byte strings straight from the pulse
+# arrays of PulseSets, a block at a time, so an export takes memory bounded by
+# the block size whatever the number of pulses, and is streamed in the response
+# while it is generated:
+#
+#     xlsx     one sheet per AMU, see xlsxstream.py
+#     csv      one CSV file per AMU, zipped together when there are several
+#     npz      numpy archive with the 'times', 'avg' and 'pulses' arrays of every
+#              AMU under '<name>/', and 'meta', a JSON string with the name,
+#              metadata and correction params of every AMU. Read it with np.load.
+#     parquet  one table in long form, a row per AMU, pulse and time point, for
+#              dataframe and SQL tools, with the same metadata in the schema.
+#              Only offered when pyarrow is installed.
+#
+# Sheets, files and arrays are named after the keys of the datasets in the
+# dataset store ('28.0', or '28.0-2' for the second file with that AMU), so that
+# AMUs uploaded more than once do not overwrite each other. xlsx sheets and csv
+# files have a row per time point with the time, the average pulse and every
+# pulse.
+
+import io
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+import xlsxstream
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Number of time points per block of xlsx and csv rows, and of pulses per block
+# of npz arrays
+BLOCK_ROWS = 256
+
+# Deflate level of npz archives. Pulse arrays barely compress at higher levels,
+# which take several times longer.
+NPZ_COMPRESS_LEVEL = 1
+
+# Number of rows per row group of parquet files
+PARQUET_ROW_GROUP = 2**20
+
+# Sheet name of the xlsx file of a single AMU, which readers of the files of
+# the single-AMU download link look the pulses up by
+SINGLE_SHEET = 'Pulses'
+
+# Formats offered by the download links, with their labels
+FORMATS = OrderedDict([('xlsx', 'Excel (.xlsx)'),
+                       ('csv', 'CSV'),
+                       ('npz', 'NumPy (.npz)')])
+if pa is not None:
+    FORMATS['parquet'] = 'Parquet'
+
+
+# Function that returns the metadata of an exported PulseSet as a JSON-serializable
+# dict. `params` are the correction params as stored in 'temp-data', and
+# `normalized_by` the name of the inert AMU of inert normalized data.
+def dataset_meta(pulse_set, params=None, normalized_by=None):
+    meta = dict((key, getattr(pulse_set, attr)) for attr, key in pulse_set.META_KEYS)
+    meta['n_pulses'] = pulse_set.n_pulses
+    meta['n_datapoints'] = pulse_set.n_datapoints
+
+    if params is not None:
+        amu, x, timespan, corr, smooth, window_size, order = params
+        meta['baseline timespan'] = [float(t) for t in timespan] if corr is True else None
+        meta['smoothing'] = ({'window size': int(window_size), 'order': int(order)}
+                             if smooth is True else None)
+    if normalized_by is not None:
+        meta['normalized by'] = normalized_by
+
+    return meta
+
+
+# Function that yields the export rows of a PulseSet, one row per time point with
+# the time, the average pulse and every pulse, in blocks of BLOCK_ROWS rows
+def pulse_rows(pulse_set):
+    times = pulse_set.times
+    avg = pulse_set.avg_pulse().astype(pulse_set.pulses.dtype)
+
+    for start in range(0, pulse_set.n_datapoints, BLOCK_ROWS):
+        stop = start + BLOCK_ROWS
+        block = np.empty((len(times[start:stop]), pulse_set.n_pulses + 2), dtype=pulse_set.pulses.dtype)
+        block[:, 0] = times[start:stop]
+        block[:, 1] = avg[start:stop]
+        block[:, 2:] = pulse_set.pulses[:, start:stop].T
+        yield block
+
+
+# Function that returns the column names of the rows of a PulseSet
+def pulse_header(pulse_set):
+    return ['Time', 'Avg'] + [str(i) for i in range(1, pulse_set.n_pulses + 1)]
+
+
+# Function that returns the header and rows of a PulseSet as a sheet for
+# xlsxstream, named `name`
+def pulse_sheet(name, pulse_set):
+    return name, pulse_header(pulse_set), pulse_rows(pulse_set)
+
+
+# Function that returns `metas` with the name of each dataset added
+def _named_metas(names, metas):
+    return [dict(meta, name=name) for name, meta in zip(names, metas)]
+
+
+# Function that yields the lines of a CSV file of a PulseSet, a block of rows at a
+# time. Values are written with as many digits as their precision needs.
+def _csv_lines(pulse_set):
+    yield (','.join(pulse_header(pulse_set)) + '\r\n').encode('ascii')
+
+    value_fmt = '%.9g' if pulse_set.pulses.dtype == np.float32 else '%r'
+    row_fmt = ','.join([value_fmt] * (pulse_set.n_pulses + 2)) + '\r\n'
+    for block in pulse_rows(pulse_set):
+        yield ''.join(row_fmt % tuple(values) for values in block.tolist()).encode('ascii')
+
+
+# Function that yields the bytes of an .npy file of `arr`, a block of rows at a time
+def _npy_chunks(arr):
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, np.lib.format.header_data_from_array_1_0(arr))
+    yield header.getvalue()
+
+    if arr.ndim == 2:
+        for start in range(0, arr.shape[0], BLOCK_ROWS):
+            yield np.ascontiguousarray(arr[start:start + BLOCK_ROWS]).tobytes()
+    else:
+        yield np.ascontiguousarray(arr).tobytes()
+
+
+def write_csv(names, pulse_sets, metas):
+    if len(pulse_sets) == 1:
+        for data in _csv_lines(pulse_sets[0]):
+            yield data
+        return
+
+    archive = xlsxstream.ZipStream()
+    for name, pulse_set in zip(names, pulse_sets):
+        for data in archive.part('{0}.csv'.format(name), _csv_lines(pulse_set)):
+            yield data
+    for data in archive.close():
+        yield data
+
+
+def write_npz(names, pulse_sets, metas):
+    archive = xlsxstream.ZipStream(NPZ_COMPRESS_LEVEL)
+    meta = np.array(json.dumps({'datasets': _named_metas(names, metas)}).decode('utf-8'))
+    for data in archive.part('meta.npy', _npy_chunks(meta)):
+        yield data
+
+    for name, pulse_set in zip(names, pulse_sets):
+        for key, arr in (('times', pulse_set.times),
+                         ('avg', pulse_set.avg_pulse()),
+                         ('pulses', pulse_set.pulses)):
+            for data in archive.part('{0}/{1}.npy'.format(name, key), _npy_chunks(arr)):
+                yield data
+
+    for data in archive.close():
+        yield data
+
+
+# File object handed to pyarrow, that keeps what is written until it is drained
+class _ParquetSink(object):
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    # Function that returns and forgets the bytes written since the last call
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+
+        return data
+
+
+def write_parquet(names, pulse_sets, metas):
+    dtype = pulse_sets[0].pulses.dtype if pulse_sets else np.float64
+    schema = pa.schema([pa.field('dataset', pa.string()),
+                        pa.field('amu', pa.float64()),
+                        pa.field('pulse', pa.int32()),
+                        pa.field('time', pa.float64()),
+                        pa.field('value', pa.from_numpy_dtype(dtype))],
+                       metadata={'tappy': json.dumps({'datasets': _named_metas(names, metas)})})
+
+    sink = _ParquetSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for name, pulse_set in zip(names, pulse_sets):
+        times = pulse_set.times
+        step = max(1, PARQUET_ROW_GROUP // max(1, pulse_set.n_datapoints))
+        for start in range(0, pulse_set.n_pulses, step):
+            pulses = pulse_set.pulses[start:start + step]
+            n_rows = pulses.size
+            columns = [np.full(n_rows, name, dtype=object),
+                       np.full(n_rows, pulse_set.amu),
+                       np.repeat(np.arange(start + 1, start + len(pulses) + 1, dtype=np.int32),
+                                 pulse_set.n_datapoints),
+                       np.tile(times, len(pulses)),
+                       pulses.astype(dtype, copy=False).ravel()]
+            writer.write_table(pa.Table.from_arrays([pa.array(c) for c in columns], schema=schema))
+            yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+# Function that exports PulseSets, with `names` their keys in the dataset store and
+# `metas` their dataset_meta dicts, in format `fmt`. xlsx sheets are named
+# `sheet_names`, `names` by default. Returns the file extension, the mimetype and
+# an iterator of the bytes of the file. Raises ValueError for a format that is not
+# in FORMATS, which leaves out parquet without pyarrow.
+def export(fmt, names, pulse_sets, metas, sheet_names=None):
+    if fmt not in FORMATS:
+        raise ValueError('Unknown export format {0!r}, expected one of {1}'.format(
+            fmt, ', '.join(FORMATS)))
+    if len(set(names)) != len(names):
+        raise ValueError('Export names are not unique: {0}'.format(', '.join(names)))
+
+    if fmt == 'xlsx':
+        return 'xlsx', xlsxstream.MIMETYPE, xlsxstream.write_workbook(
+            [pulse_sheet(name, pulse_set) for name, pulse_set in zip(sheet_names or names, pulse_sets)])
+    elif fmt == 'csv':
+        if len(pulse_sets) == 1:
+            return 'csv', 'text/csv', write_csv(names, pulse_sets, metas)
+        return 'zip', 'application/zip', write_csv(names, pulse_sets, metas)
+    elif fmt == 'npz':
+        return 'npz', 'application/octet-stream', write_npz(names, pulse_sets, metas)
+    else:
+        return 'parquet', 'application/octet-stream', write_parquet(names, pulse_sets, metas)
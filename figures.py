@@ -3,57 +3,121 @@
 import dash_html_components as html
 import dash_core_components as dcc
 
+import base64
+import os
+import struct
+import zlib
+
 import numpy as np
 import plotly.graph_objs as go
 import matplotlib.pyplot as plt
 
+import decimation
+
 colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
 
-def scatter3d(pulse_data, k):
-    n_time_pts = len(pulse_data['times'])
-    index = pulse_data['index']
-    n_pulses = len(pulse_data['pulses'])
+# Largest number of time points per pulse sent to 3D figures. Longer pulses are
+# decimated to the minimum and maximum of bins, since a 3D view has no room for
+# more.
+MAX_POINTS_3D = int(os.environ.get('TAPPY_3D_POINTS', 250))
+
+# Number of significant digits of the signal sent to 3D figures
+DIGITS_3D = 4
+
+# Number of 3D figures of tab 1 that keep their place in the page, and are only
+# sent again when their data or mode changes. Figures of further AMUs are all
+# sent again whenever one of them changes.
+SLOTS_3D = int(os.environ.get('TAPPY_3D_SLOTS', 16))
+
+
+# Function that rounds `arr` to `digits` significant digits of its largest value,
+# so that the figure JSON carries short numbers instead of full doubles
+def round_values(arr, digits):
+    arr = np.asarray(arr, dtype=np.float64)
+    scale = np.nanmax(np.abs(arr)) if arr.size else 0.0
+    if not np.isfinite(scale) or scale == 0:
+        return arr
+
+    return np.round(arr, digits - 1 - int(np.floor(np.log10(scale))))
+
+
+# Function that returns the trace of a 3D figure of all the pulses of a PulseSet.
+# 'lines' packs the pulses into one Scatter3d trace, separated by gaps; 'surface'
+# draws them as a surface, with the time axis and pulse numbers sent once.
+# `pulse_numbers` label the pulses on the pulse axis, 1 to n_pulses by default.
+# Pulses are decimated with `pyramid`, the Pyramid of the PulseSet, if given.
+def pulse_trace3d(pulse_set, mode='lines', pulse_numbers=None, pyramid=None):
+    if pyramid is not None:
+        times, _, signal = pyramid.envelope(MAX_POINTS_3D)
+    else:
+        times, signal = decimation.minmax_pulses(pulse_set.times, pulse_set.pulses, MAX_POINTS_3D)
+    times = round_values(times, 6)
+    signal = round_values(signal, DIGITS_3D)
+    if pulse_numbers is None:
+        pulse_numbers = np.arange(1, pulse_set.n_pulses + 1)
+    pulse_numbers = np.asarray(pulse_numbers, dtype=np.float64)
+
+    if mode == 'surface':
+        return go.Surface(x=times, y=pulse_numbers, z=signal,
+                          name='AMU={0:0.1f}'.format(pulse_set.amu),
+                          colorscale='Viridis',
+                          showscale=False)
+
+    # One column of NaN after every pulse breaks the line between pulses
+    shape = (pulse_set.n_pulses, len(times) + 1)
+    xdata = np.empty(shape)
+    xdata[:, :-1] = times
+    ydata = np.empty(shape)
+    ydata[:] = pulse_numbers[:, np.newaxis]
+    zdata = np.empty(shape)
+    zdata[:, :-1] = signal
+    xdata[:, -1] = ydata[:, -1] = zdata[:, -1] = np.nan
 
-    xdata = np.array([pulse_data['times'],]*n_pulses)
-    zdata = pulse_data['pulses']
-    ydata = np.array([[i+1]*n_time_pts for i in range(n_pulses)])
-    
+    return go.Scatter3d(x=xdata.ravel(), z=zdata.ravel(), y=ydata.ravel(),
+                        mode='lines',
+                        connectgaps=False,
+                        name='AMU={0:0.1f}'.format(pulse_set.amu),
+                        showlegend=False,
+                        line={'width':1.0,
+                              'color':colors[pulse_set.index % len(colors)]},
+                        opacity=1)
 
+
+# Function that returns the 3D figure of all the pulses of a PulseSet, see
+# pulse_trace3d, as a dict of plain values and arrays so that it can be cached
+def figure3d(pulse_set, mode='lines', pulse_numbers=None, pyramid=None):
+    return {'data': [pulse_trace3d(pulse_set, mode, pulse_numbers, pyramid).to_plotly_json()],
+
+            'layout': go.Layout(scene={'xaxis': {'title': {'text': 'Time (s)',
+                                                           'font': {'size': 20}},
+                                                 'visible': True,
+                                                 'type': 'linear',
+                                                 'tickmode': 'auto',
+                                                 'nticks': 6},
+                                       'yaxis': {'title': {'text': 'Pulse #',
+                                                           'font': {'size': 20}},
+                                                 'visible': True,
+                                                 'type': 'linear'},
+                                       'zaxis': {'title': {'text': 'Signal (V)',
+                                                           'font': {'size': 20}},
+                                                 'visible': True,
+                                                 'type': 'linear',
+                                                 'tickmode': 'auto',
+                                                 'nticks': 6,
+                                                 'exponentformat': 'E'}},
+                                autosize=True,
+                                height=600, width=800,
+                                margin={'l': 20, 'b': 20, 't': 0, 'r': 0}).to_plotly_json()}
+
+
+# Function that returns the plot of a 3D figure made by figure3d, for the data
+# stored under `k` in tab 1
+def scatter3d(k, figure):
     fig = html.Div([
         html.H5('AMU={0}'.format(k)),
         dcc.Graph(
             id='3d_fig-{0}'.format(k),
-            
-            figure={'data': [go.Scatter3d(x=x1, z=z1, y=y1,
-                                          mode='lines',
-                                          name='AMU={0:0.1f}'.format(pulse_data['amu']),
-                                          showlegend=False,
-                                          line={'width':1.0,
-                                                'color':colors[index]},
-                                          opacity=1)
-                             for x1, z1, y1 in zip(xdata, zdata, ydata)],
-                    
-                    'layout': go.Layout(scene={'xaxis': {'title': {'text': 'Time (s)',
-                                                                   'font': {'size': 20}},
-                                                         'visible': True,
-                                                         'type': 'linear',
-                                                         'tickmode': 'auto',
-                                                         'nticks': 6},
-                                               'yaxis': {'title': {'text': 'Pulse #',
-                                                                   'font': {'size': 20}},
-                                                         'visible': True,
-                                                         'type': 'linear'},
-                                               'zaxis': {'title': {'text': 'Signal (V)',
-                                                                   'font': {'size': 20}},
-                                                         'visible': True,
-                                                         'type': 'linear',
-                                                         'tickmode': 'auto',
-                                                         'nticks': 6,
-                                                         'exponentformat': 'E'}},
-                                        autosize=True,
-                                        height=600, width=800,
-                                        margin={'l': 20, 'b': 20, 't': 0, 'r': 0})
-            },
+            figure=figure,
             config={'showSendToCloud': True}),
         html.Hr()],
                     
@@ -61,35 +125,168 @@ def scatter3d(pulse_data, k):
 
     return fig
 
-def scatter(pulse_data, type_of_pulse):
-    k = pulse_data['index']
-    fig = html.Div([
+# Function that returns the figure of the average pulse of a PulseSet, with
+# `times` and `avg_pulse` already decimated. `x_range` is the zoomed-in range of
+# the time axis, if any.
+def avg_figure(pulse_set, times, avg_pulse, x_range=None):
+    xaxis = {'title': {'text': 'Time (s)',
+                       'font': {'size': 20}},
+             'ticks': 'outside',
+             'tickwidth': 2,
+             'showgrid': True}
+    if x_range is not None:
+        xaxis['range'] = list(x_range)
+
+    return {'data': [go.Scattergl(x=times,
+                                  y=avg_pulse,
+                                  name='{0:0.1f}'.format(pulse_set.amu),
+                                  mode='lines',
+                                  opacity=1.0,
+                                  line={'color':colors[pulse_set.index % len(colors)]})],
+
+            # Zoom is kept while the data of the plot is replaced
+            'layout': go.Layout(xaxis=xaxis,
+                                yaxis={'title': {'text': 'Signal (V)',
+                                                 'font': {'size': 20}},
+                                       'ticks': 'outside',
+                                       'exponentformat': 'E',
+                                       'tickwidth': 2,
+                                       'showgrid': True},
+                                hovermode='closest',
+                                showlegend=True,
+                                uirevision='{0:0.1f}'.format(pulse_set.amu),
+                                height=450,
+                                margin={'l': 80, 'b': 80, 't': 40, 'r': 0})}
+
+
+# Function that returns the (x0, x1) range of an axis, 'xaxis' or 'yaxis', zoomed
+# into from the relayoutData of a plot, None when it was reset to the whole data,
+# or False when the axis did not change
+def relayout_range(relayout_data, axis='xaxis'):
+    if not relayout_data:
+        return False
+    if axis + '.range[0]' in relayout_data and axis + '.range[1]' in relayout_data:
+        return (float(relayout_data[axis + '.range[0]']), float(relayout_data[axis + '.range[1]']))
+    if axis + '.range' in relayout_data:
+        return tuple(float(x) for x in relayout_data[axis + '.range'])
+    if relayout_data.get(axis + '.autorange'):
+        return None
+
+    return False
+
+
+# Function that returns the range of an axis, 'xaxis' or 'yaxis', of a figure
+# sent to a graph before, if the figure has revision `uirevision` and was zoomed
+# into, and None otherwise
+def figure_range(figure, uirevision, axis='xaxis'):
+    layout = (figure or {}).get('layout') or {}
+    if layout.get('uirevision') != uirevision or not layout.get(axis, {}).get('range'):
+        return None
+
+    return tuple(float(x) for x in layout[axis]['range'])
+
+
+# Function that returns the container of a graph of tab 2, hidden until the
+# graph has a figure, see graph_style. The graph stays in the page for the whole
+# session so that new data only replaces its figure.
+def graph_container(container_id, graph_id):
+    return html.Div([
         dcc.Graph(
-            id='avg_fig-{0}'.format(pulse_data['index']),
-            figure={'data': [go.Scattergl(x=pulse_data['times'],
-                                        y=np.mean(pulse_data[type_of_pulse], axis=0),
-                                        name='{0:0.1f}'.format(pulse_data['amu']),
-                                        mode='lines',
-                                        opacity=1.0,
-                                        line={'color':colors[k]})],
-                    
-                    'layout': go.Layout(xaxis={'title': {'text': 'Time (s)',
-                                                         'font': {'size': 20}},
-                                               'ticks': 'outside',
-                                               'tickwidth': 2,
-                                               'showgrid': True},
-                                        yaxis={'title': {'text': 'Signal (V)',
-                                                         'font': {'size': 20}},
-                                               'ticks': 'outside',
-                                               'exponentformat': 'E',
-                                               'tickwidth': 2,
-                                               'showgrid': True},
-                                        hovermode='closest',
-                                        showlegend=True,
-                                        height=450,
-                                        margin={'l': 80, 'b': 80, 't': 40, 'r': 0})},
+            id=graph_id,
             config={'showSendToCloud': True})],
-                   
-        style={'width': '99%', 'display': 'inline-block'})
 
-    return fig
+        id=container_id,
+        style=graph_style(False))
+
+
+# Function that returns the style of a container made by graph_container
+def graph_style(visible):
+    return {'width': '99%', 'display': 'inline-block' if visible else 'none'}
+
+
+# Size in pixels the pulse heatmap is rendered at, and its colormap
+RASTER_WIDTH = int(os.environ.get('TAPPY_RASTER_WIDTH', 1000))
+RASTER_HEIGHT = int(os.environ.get('TAPPY_RASTER_HEIGHT', 500))
+RASTER_CMAP = 'viridis'
+
+
+# Function that returns a PNG chunk
+def _png_chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+
+# Function that encodes a 2D array of values as an indexed-colour PNG with the
+# colormap RASTER_CMAP from `vmin` to `vmax`, the first row at the top, and
+# returns it as a data URI. Rows and columns are repeated up to about the raster
+# size so that small arrays stay sharp when the browser scales them.
+def raster_png(values, vmin, vmax):
+    scale = 255.0 / (vmax - vmin) if vmax > vmin else 0.0
+    pixels = np.clip((np.nan_to_num(values) - vmin) * scale, 0, 255).astype(np.uint8)
+    pixels = np.repeat(pixels, max(1, RASTER_HEIGHT // pixels.shape[0]), axis=0)
+    pixels = np.repeat(pixels, max(1, RASTER_WIDTH // pixels.shape[1]), axis=1)
+    height, width = pixels.shape
+
+    # Every row starts with filter type 0, none
+    rows = np.zeros((height, width + 1), dtype=np.uint8)
+    rows[:, 1:] = pixels
+    palette = plt.get_cmap(RASTER_CMAP)(np.linspace(0, 1, 256), bytes=True)[:, :3]
+
+    png = b''.join([b'\x89PNG\r\n\x1a\n',
+                    _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)),
+                    _png_chunk(b'PLTE', palette.astype(np.uint8).tobytes()),
+                    _png_chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)),
+                    _png_chunk(b'IEND', b'')])
+
+    return 'data:image/png;base64,' + base64.b64encode(png).decode('ascii')
+
+
+# Function that returns the figure of the pulse heatmap of a PulseSet, a raster
+# image made by raster_png that spans `extent`, (x0, x1, y0, y1) in time and
+# pulse number, with the colour bar of `vmin` to `vmax`. `x_range` and `y_range`
+# are the ranges zoomed into, if any.
+def heatmap_figure(pulse_set, image, extent, vmin, vmax, x_range=None, y_range=None):
+    x0, x1, y0, y1 = extent
+    xaxis = {'title': {'text': 'Time (s)',
+                       'font': {'size': 20}},
+             'ticks': 'outside',
+             'tickwidth': 2,
+             'showgrid': False,
+             'zeroline': False}
+    yaxis = {'title': {'text': 'Pulse #',
+                       'font': {'size': 20}},
+             'ticks': 'outside',
+             'tickwidth': 2,
+             'showgrid': False,
+             'zeroline': False}
+    if x_range is not None:
+        xaxis['range'] = list(x_range)
+    if y_range is not None:
+        yaxis['range'] = list(y_range)
+
+    # Invisible markers at the corners span the axes and carry the colour bar
+    return {'data': [go.Scatter(x=[x0, x1], y=[y0, y1],
+                                mode='markers',
+                                hoverinfo='none',
+                                showlegend=False,
+                                marker={'color': [vmin, vmax],
+                                        'colorscale': RASTER_CMAP.capitalize(),
+                                        'showscale': True,
+                                        'colorbar': {'title': {'text': 'Signal (V)'},
+                                                     'exponentformat': 'E'},
+                                        'opacity': 0})],
+
+            'layout': go.Layout(xaxis=xaxis,
+                                yaxis=yaxis,
+                                images=[{'source': image,
+                                         'xref': 'x',
+                                         'yref': 'y',
+                                         'x': x0,
+                                         'y': y1,
+                                         'sizex': x1 - x0,
+                                         'sizey': y1 - y0,
+                                         'sizing': 'stretch',
+                                         'layer': 'below'}],
+                                uirevision='{0:0.1f}'.format(pulse_set.amu),
+                                height=450,
+                                margin={'l': 80, 'b': 80, 't': 40, 'r': 0})}
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+# Background jobs for the long operations of tab 2.
+#
+# Operations that can take longer than an HTTP request, applying corrections to
+# all AMUs and inert normalization, are submitted to a JobQueue instead of
+# running inside the Dash callback. The queue hands out a job id right away and
+# runs the jobs on a pool of worker threads in the server process, where the
+# dataset store lives; jobs that need more than one core use the process pools
+# of workers.py. The app polls the job status with a dcc.Interval; since jobs are
+# only known to the process that runs them, polls must reach that process, as
+# they do when the app is served by threads.
+#
+# A job function is called as func(job, *args) and reports its progress with
+# job.report(done, total), which raises JobCancelled once the job has been
+# cancelled. Finished jobs and their results are kept for `retain` seconds.
+
+import os
+import Queue
+import threading
+import time
+import traceback
+import uuid
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+# Exception raised by Job.report in a job that has been cancelled
+class JobCancelled(Exception):
+    pass
+
+
+# Class that holds the state of one job
+class Job(object):
+
+    def __init__(self, name, func, args):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.func = func
+        self.args = args
+        self.status = QUEUED
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.collected = False
+        self.submitted = time.time()
+        self.finished = None
+        self._cancel = threading.Event()
+
+    # Function called by job functions to report progress, as `done` of `total`
+    # steps. Raises JobCancelled if the job has been cancelled meanwhile.
+    def report(self, done, total):
+        if self._cancel.is_set():
+            raise JobCancelled(self.id)
+        self.progress = 100.0 * done / total if total else 100.0
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    # Dict describing the job, as shown to the app
+    def info(self):
+        return {'id': self.id,
+                'name': self.name,
+                'status': self.status,
+                'progress': self.progress,
+                'error': self.error,
+                'collected': self.collected}
+
+
+# Class that runs submitted jobs on `workers` threads, in submission order. The
+# threads are started by the first submit, so that importing the queue starts no
+# thread before the process pools of workers.start_pools are forked.
+class JobQueue(object):
+
+    def __init__(self, workers=2, retain=3600):
+        self.retain = retain
+        self.workers = workers
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._started = False
+
+    # Function that submits `func(job, *args)` and returns the job id
+    def submit(self, name, func, *args):
+        job = Job(name, func, args)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+            if not self._started:
+                for i in range(self.workers):
+                    worker = threading.Thread(target=self._work, name='tappy-job-{0}'.format(i))
+                    worker.daemon = True
+                    worker.start()
+                self._started = True
+        self._queue.put(job)
+
+        return job.id
+
+    # Function that returns the info dict of a job, or None for an unknown id
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+
+        return job.info() if job is not None else None
+
+    # Function that returns the result of a finished job, or None
+    def result(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+
+        return job.result if job is not None and job.status == DONE else None
+
+    # Function that returns the result of a job that finished successfully the
+    # first time it is asked for, and None before that and afterwards, so that a
+    # polling callback delivers each result once
+    def collect(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != DONE or job.collected:
+                return None
+            job.collected = True
+
+        return job.result
+
+    # Function that cancels a job. Queued jobs never start; running jobs stop at
+    # their next progress report.
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED:
+                return False
+            job._cancel.set()
+            if job.status == QUEUED:
+                self._finish(job, CANCELLED)
+
+        return True
+
+    # Function that drops finished jobs older than `retain` seconds
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished is not None and now - job.finished > self.retain:
+                del self._jobs[job_id]
+
+    def _finish(self, job, status):
+        job.status = status
+        job.finished = time.time()
+        if status == DONE:
+            job.progress = 100.0
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                if job.status != QUEUED:
+                    continue
+                job.status = RUNNING
+
+            try:
+                result = job.func(job, *job.args)
+            except JobCancelled:
+                with self._lock:
+                    self._finish(job, CANCELLED)
+            except Exception:
+                with self._lock:
+                    job.error = traceback.format_exc().strip().splitlines()[-1]
+                    self._finish(job, FAILED)
+                traceback.print_exc()
+            else:
+                with self._lock:
+                    job.result = result
+                    self._finish(job, CANCELLED if job.cancelled else DONE)
+
+
+# Queue shared by the app
+job_queue = JobQueue(workers=int(os.environ.get('TAPPY_JOB_WORKERS', 2)),
+                     retain=float(os.environ.get('TAPPY_JOB_RETAIN', 3600)))
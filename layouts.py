@@ -3,6 +3,11 @@
 import dash_html_components as html
 import dash_core_components as dcc
 
+import uuid
+
+import exports
+import figures
+
 
 # App Layout
 def app_layout():
@@ -25,7 +30,7 @@ def app_layout():
 
                          
                          # Tab 1: Uploads all TAP pulse response files to the app for further analysis.
-                         #       Displays a 3D scatter plot of 25 random pulses for simple visualization
+                         #       Displays a 3D plot of evenly spaced pulses for simple visualization
                          #       of all uploaded files.
                          dcc.Tab(label='Upload Pulse Files', value=1, children=tab1()),
 
@@ -44,7 +49,11 @@ def app_layout():
                                       'primary': '#c8102e',
                                       'background': 'mistyrose'}),
                        
-                     html.Div(id='tab-layout')
+                     html.Div(id='tab-layout'),
+
+                     # Identifies the browser session, e.g. for streamed uploads.
+                     # A new id is generated each time the page is loaded.
+                     html.Div(id='session-id', children=uuid.uuid4().hex, style={'display': 'none'})
     ])
 
 # Layout for Tab 1
@@ -76,10 +85,36 @@ def tab1():
                    # Allow multiple files to be uploaded
                    multiple=True),
 
+        # Chunked upload for large files. The button is handled by
+        # assets/stream_upload.js, which posts the files to the /dash/upload route
+        # and clicks the hidden "stream-upload-started" button once the server has
+        # an upload, so that the interval only polls while uploads are pending
+        html.Div([html.Button('Stream Large Files', id='stream-upload-button'),
+                  html.Button(id='stream-upload-started', style={'display': 'none'}),
+                  html.Div(id='stream-upload-progress'),
+                  dcc.Interval(id='stream-upload-interval', interval=1000, disabled=True),
+                  dcc.Store(id='streamed-uploads')],
+                 style={'margin': '10px'}),
+
+        # Files that could not be read
+        html.Div(id='upload-status', style={'color': '#c8102e'}),
+
         html.Hr(),
 
         # Second section showing 3D scatter plots of all uploaded files
+        dcc.RadioItems(id='3d-mode-radioitems',
+                       options=[{'label': 'Surface', 'value': 'surface'},
+                                {'label': 'Lines', 'value': 'lines'}],
+                       value='surface',
+                       labelStyle={'display': 'inline-block'}),
+
+        # One slot per 3D figure, and the figures of the AMUs beyond the slots
+        html.Div([html.Div(id='3d-fig-slot-{0}'.format(i), style={'display': 'inline'})
+                  for i in range(figures.SLOTS_3D)]),
+
         html.Div(id='3d-pulse-figs'),
+
+        html.Div(dcc.Store(id='3d-fig-keys')),
         
         html.Div(id='data-tab1', style={'display': 'none'}),
 
@@ -123,8 +158,23 @@ def tab2():
                     html.Br(),
                     
                     html.Label('Average Pulse', style={'font-weight': 'bold'}),
+
+                    # While the sliders move, corrections are previewed on a
+                    # subset of the pulses and refined in the background
+                    dcc.RadioItems(id='preview-radioitems',
+                                   options=[
+                                       {'label': 'Preview while adjusting', 'value': True},
+                                       {'label': 'Always full resolution', 'value': False}],
+                                   value=True,
+                                   labelStyle={'display': 'inline-block'}),
+
+                    html.Div(id='preview-status', style={'color': '#c8102e'}),
+
+                    dcc.Interval(id='full-res-interval', interval=250, disabled=True),
     
-                    html.Div(id='avg-fig-tab2'),
+                    figures.graph_container('avg-fig-tab2', 'avg-pulse-graph'),
+
+                    figures.graph_container('heatmap-fig-tab2', 'heatmap-graph'),
 
                     html.Div(id='temp-data', style={'display': 'none'}),
 
@@ -155,7 +205,16 @@ def tab2():
                                        options=[
                                            {'label': 'Enabled', 'value': True},
                                            {'label': 'Disabled', 'value': False}],
-                                       value=False)
+                                       value=False),
+
+                        # Two disjoint windows fit a straight baseline through
+                        # both, for pulses with a drifting baseline
+                        dcc.RadioItems(id='baseline-windows-radioitems',
+                                       options=[
+                                           {'label': 'One window', 'value': 1},
+                                           {'label': 'Two windows (drift)', 'value': 2}],
+                                       value=1,
+                                       labelStyle={'display': 'inline-block'})
                     ]),
 
                     html.Div(id='baseline-corr-slider'),
@@ -199,6 +258,15 @@ def tab2():
 
                     html.Br(),
                     
+                    # Format of the files of both download links, see exports.py
+                    html.Label('Export Format', style={'font-weight': 'bold'}),
+
+                    dcc.RadioItems(id='export-format-radioitems',
+                                   options=[{'label': label, 'value': fmt}
+                                            for fmt, label in exports.FORMATS.items()],
+                                   value='xlsx',
+                                   labelStyle={'display': 'inline-block'}),
+
                     html.Div(id='button-container',
                              children=[html.A(html.Button('Download',
                                                           id='download-button-1'),
@@ -227,6 +295,10 @@ def tab2():
 
                     html.Div(id='apply-all', style={'color': '#c8102e'}),
 
+                    html.Button('Cancel', id='cancel-apply-all-button'),
+
+                    dcc.Store(id='apply-all-job'),
+
                     html.Hr(),
 
                     html.Label('Inert Normalization',
@@ -240,13 +312,37 @@ def tab2():
 
                     html.Div(id='inert-output', style={'color': '#c8102e'}),
 
+                    html.Button('Cancel', id='cancel-norm-button'),
+
+                    dcc.Store(id='norm-job'),
+
+                    # Polls the background jobs of apply-all and inert normalization
+                    dcc.Interval(id='job-interval', interval=500, disabled=True),
+
                     html.Div(children=[html.A(html.Button('Download', id='download-button-2'),
                                               id='download-link-2',
                                               target='_blank')],
                              style={'width': '49%',
                                     'display': 'inline-block',
                                     'lineHeight': '90px',
-                                    'height': '60px'}),                
+                                    'height': '60px'}),
+
+                    html.Hr(),
+
+                    # Save raw and corrected data of the session in a .tap container,
+                    # which can be uploaded again in tab 1
+                    html.Label('Save Session',
+                               style={'font-weight': 'bold'}),
+
+                    html.Div(children=[html.Button('Save', id='save-session-button'),
+                                       html.A('Download session file',
+                                              id='session-link',
+                                              target='_blank',
+                                              style={'margin': '10px'})],
+                             style={'width': '99%',
+                                    'display': 'inline-block',
+                                    'lineHeight': '60px',
+                                    'height': '60px'}),
                 ],
 
                          className='six columns')],
@@ -256,17 +352,19 @@ def tab2():
     ])]
 
 
-# Layout for creating the baseline correction RangeSlider in Tab 2
-def baseline_corr_slider(dataset, disable=False):
-    times = dataset['times']
-    tmin = min(times)
-    tmax = max(times)
+# Layout for creating the baseline correction RangeSlider in Tab 2, with one pair
+# of handles per baseline window
+def baseline_corr_slider(dataset, disable=False, n_windows=1):
+    times = dataset.times
+    tmin = float(times.min())
+    tmax = float(times.max())
     
     return [html.Div([dcc.RangeSlider(id='time-range-slider',
                                       min=tmin,
                                       max=tmax,
                                       step=0.05,
-                                      value=[1, 1],
+                                      value=[1, 1]*n_windows,
+                                      allowCross=False,
                                       disabled=disable,
                                       marks={tmin: '{0:0.1f}'.format(tmin),
                                              tmax: '{0:0.1f}'.format(tmax)}),
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+# PulseSet: the pulses of one AMU and their metadata.
+#
+# The pulses are held in a single C-ordered (n_pulses, n_datapoints) float array
+# and the time axis as (t0, dt, n) instead of a materialized list, since every
+# TAP instrument samples on a uniform grid. PulseSets are what the parsers
+# return, what the dataset store holds and what all processing in workers.py
+# operates on.
+#
+# Pulses are stored as float64 by default. The detector is digitized to about 6
+# significant figures, which float32 holds exactly, so TAPPY_PRECISION=float32
+# halves the memory and bandwidth of every pulse array from parsing to export.
+# Areas and averages are accumulated in float64 either way.
+
+import os
+
+import numpy as np
+
+PRECISIONS = ('float64', 'float32')
+
+
+# Function that sets the floating point type of the pulse arrays of every PulseSet
+# created from now on
+def set_precision(name):
+    global dtype
+    if name not in PRECISIONS:
+        raise ValueError('Unknown precision {0!r}, expected one of {1}'.format(
+            name, ', '.join(PRECISIONS)))
+    dtype = np.dtype(name)
+
+
+# Floating point type of the pulse arrays
+dtype = None
+set_precision(os.environ.get('TAPPY_PRECISION', 'float64'))
+
+
+# Class that holds the pulses of one AMU on a uniform time axis, as an array of
+# the configured precision
+class PulseSet(object):
+    __slots__ = ('pulses', 't0', 'dt', 'amu', 'gain', 'collection_time',
+                 'pulse_spacing', 'index', 'source', 'correction')
+
+    # Metadata written by to_dict, with the dict keys used by the app
+    META_KEYS = (('amu', 'amu'),
+                 ('gain', 'gain'),
+                 ('collection_time', 'collection time'),
+                 ('pulse_spacing', 'pulse spacing'),
+                 ('index', 'index'),
+                 ('t0', 't0'),
+                 ('dt', 'dt'))
+
+    def __init__(self, pulses, t0, dt, amu, gain=0, collection_time=0.0,
+                 pulse_spacing=0.0, index=0, source=None):
+        pulses = np.asarray(pulses)
+        if pulses.ndim == 1:
+            pulses = pulses.reshape(1, -1)
+        if pulses.dtype != dtype or not pulses.flags.c_contiguous:
+            pulses = np.ascontiguousarray(pulses, dtype=dtype)
+
+        self.pulses = pulses
+        self.t0 = float(t0)
+        self.dt = float(dt)
+        self.amu = float(amu)
+        self.gain = int(gain)
+        self.collection_time = float(collection_time)
+        self.pulse_spacing = float(pulse_spacing)
+        self.index = int(index)
+
+        # [datacache key, dataset name] of the file the pulses were parsed from
+        self.source = source
+
+        # (params, corrected pulses) of a dataset loaded from a saved session,
+        # see workers.save_session
+        self.correction = None
+
+    # Function that builds a PulseSet from a sampled time axis. Only the first
+    # and last times are kept.
+    @classmethod
+    def from_times(cls, pulses, times, **meta):
+        n = len(times)
+        t0 = float(times[0]) if n else 0.0
+        dt = (float(times[-1]) - t0)/(n - 1) if n > 1 else 0.0
+
+        return cls(pulses, t0, dt, **meta)
+
+    @property
+    def n_pulses(self):
+        return self.pulses.shape[0]
+
+    @property
+    def n_datapoints(self):
+        return self.pulses.shape[1]
+
+    # Compact description of the time axis
+    @property
+    def time_axis(self):
+        return self.t0, self.dt, self.n_datapoints
+
+    # Materialized time axis, for plotting and integration
+    @property
+    def times(self):
+        return self.t0 + self.dt*np.arange(self.n_datapoints)
+
+    @property
+    def nbytes(self):
+        return self.pulses.nbytes
+
+    # Average pulse, accumulated and returned in float64
+    def avg_pulse(self):
+        return np.mean(self.pulses, axis=0, dtype=np.float64)
+
+    # Function that returns a PulseSet with the same metadata and new pulses on
+    # the same time axis, e.g. the result of a correction
+    def with_pulses(self, pulses):
+        return PulseSet(pulses, self.t0, self.dt, self.amu, self.gain,
+                        self.collection_time, self.pulse_spacing, self.index, self.source)
+
+    # Function that returns the pulses selected by `inds`, a slice or index array.
+    # Ranges of consecutive pulses are views of this PulseSet's array; stepped
+    # slices and index arrays are copied, as the pulses are kept C-contiguous.
+    def subset(self, inds):
+        return self.with_pulses(self.pulses[inds])
+
+    # Function that returns every `step`-th data point of the pulses on a coarser
+    # time axis, a contiguous copy for any `step` above 1
+    def decimate(self, step):
+        return PulseSet(self.pulses[:, ::step], self.t0, self.dt*step, self.amu, self.gain,
+                        self.collection_time, self.pulse_spacing, self.index, self.source)
+
+    # Function that serializes the PulseSet into a dict of metadata and the pulse
+    # array, the layout used by the datacache and .tap containers
+    def to_dict(self):
+        data = dict((key, getattr(self, attr)) for attr, key in self.META_KEYS)
+        data['n_pulses'] = self.n_pulses
+        data['n_datapoints'] = self.n_datapoints
+        data['pulses'] = self.pulses
+        if self.correction is not None:
+            data['params'], data['corrected pulses'] = self.correction
+
+        return data
+
+    # Function that rebuilds a PulseSet from to_dict output. Dataset dicts with a
+    # 'times' list, as written by earlier versions of the app, are accepted too,
+    # as are sessions that stored the corrected pulses under the name of the
+    # correction, params[1].
+    @classmethod
+    def from_dict(cls, data):
+        meta = dict((attr, data[key]) for attr, key in cls.META_KEYS
+                    if key in data and attr not in ('t0', 'dt'))
+
+        if 't0' in data:
+            pulse_set = cls(data['pulses'], data['t0'], data['dt'], **meta)
+        else:
+            pulse_set = cls.from_times(data['pulses'], data['times'], **meta)
+
+        params = data.get('params')
+        if params is not None:
+            corrected = data.get('corrected pulses', data.get(params[1]))
+            if corrected is not None:
+                pulse_set.correction = (list(params), np.asarray(corrected))
+
+        return pulse_set
+
+    # Pickling support for the dataset store and worker processes
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        self.correction = None
+        for attr, value in zip(self.__slots__, state):
+            setattr(self, attr, value)
+
+    def __repr__(self):
+        return 'PulseSet(amu={0:0.1f}, n_pulses={1}, n_datapoints={2})'.format(
+            self.amu, self.n_pulses, self.n_datapoints)
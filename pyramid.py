@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+# Multi-resolution pyramid of pulse data, for zooming and panning plots.
+#
+# A Pyramid holds the minimum, maximum and mean of a pulse array, an average
+# pulse or all the pulses of a dataset, over bins of FACTOR**t time points for
+# every level t, down to MIN_BINS bins per pulse. For arrays of several pulses,
+# the levels coarser than the data are also reduced over bins of FACTOR**p
+# pulses. A window of the data at a given resolution is sliced from the coarsest
+# level that still has that resolution and merged by less than FACTOR, so it
+# takes time in the size of the window that is returned, whatever the size of
+# the data.
+#
+# The levels take about as much memory as the data, a third more for arrays of
+# several pulses. Pyramids are built once per dataset version and kept in the
+# dataset store next to the dataset, see workers.get_pyramid, so a new
+# correction, which is a new version, gets a new pyramid. They are kept without
+# their full-resolution level, the data itself, which is put back from the
+# dataset when they are used.
+
+import copy
+
+import numpy as np
+
+FACTOR = 4
+MIN_BINS = 64
+
+
+# Function that reduces the (minimum, maximum, mean) arrays of a level over bins
+# of `factor` along `axis`. `counts` are the numbers of data points in the bins
+# of the level along the axis, which weight the means. Returns the reduced
+# arrays and counts.
+def _reduce(level, counts, factor, axis):
+    mins, maxs, means = level
+    starts = np.arange(0, mins.shape[axis], factor)
+    shape = [1, 1]
+    shape[axis] = -1
+
+    new_counts = np.add.reduceat(counts, starts)
+    sums = np.add.reduceat(means * counts.reshape(shape), starts, axis=axis, dtype=np.float64)
+
+    return ((np.minimum.reduceat(mins, starts, axis=axis),
+             np.maximum.reduceat(maxs, starts, axis=axis),
+             (sums / new_counts.reshape(shape)).astype(means.dtype)),
+            new_counts)
+
+
+# Class that holds the pyramid of a 1D or 2D (n_pulses, n_datapoints) array on the
+# time axis t0 + dt*i
+class Pyramid(object):
+
+    def __init__(self, data, t0=0.0, dt=1.0, factor=FACTOR, min_bins=MIN_BINS):
+        data = np.asarray(data)
+        self.ndim = data.ndim
+        if data.ndim == 1:
+            data = data[np.newaxis]
+
+        self.shape = data.shape
+        self.t0 = float(t0)
+        self.dt = float(dt)
+        self.factor = factor
+
+        # Levels keyed by (time level, pulse level), and the numbers of data points
+        # and pulses in their bins
+        self.levels = {(0, 0): (data, data, data)}
+        self.time_counts = [np.ones(data.shape[1], dtype=np.int64)]
+        self.pulse_counts = [np.ones(data.shape[0], dtype=np.int64)]
+
+        t = 0
+        while self.levels[(t, 0)][0].shape[1] > min_bins:
+            level, counts = _reduce(self.levels[(t, 0)], self.time_counts[t], factor, axis=1)
+            t += 1
+            self.levels[(t, 0)] = level
+            self.time_counts.append(counts)
+
+            p = 0
+            while self.levels[(t, p)][0].shape[0] > 1:
+                level, counts = _reduce(self.levels[(t, p)], self.pulse_counts[p], factor, axis=0)
+                p += 1
+                self.levels[(t, p)] = level
+                if len(self.pulse_counts) == p:
+                    self.pulse_counts.append(counts)
+
+    # Bytes held by the levels and their bin counts, without the data itself
+    @property
+    def nbytes(self):
+        return (sum(a.nbytes for key, level in self.levels.items() if key != (0, 0) for a in level) +
+                sum(counts.nbytes for counts in self.time_counts + self.pulse_counts))
+
+    # Function that returns the pyramid without its full-resolution level, the
+    # data it was built from, to be kept next to that data. Windows of it need the
+    # data back first, see with_data.
+    def without_data(self):
+        pyramid = copy.copy(self)
+        pyramid.levels = dict((key, level) for key, level in self.levels.items() if key != (0, 0))
+
+        return pyramid
+
+    # Function that returns the pyramid with `data`, the array it was built from,
+    # as its full-resolution level
+    def with_data(self, data):
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data[np.newaxis]
+        if data.shape != self.shape:
+            raise ValueError('The pyramid was built from data of shape {0}, not {1}'.format(
+                self.shape, data.shape))
+
+        pyramid = copy.copy(self)
+        pyramid.levels = dict(self.levels)
+        pyramid.levels[(0, 0)] = (data, data, data)
+
+        return pyramid
+
+    # Function that returns the bins covering the data points in `x_range`, (x0,
+    # x1) on the time axis, and the pulses in `pulse_range`, (first, stop): between
+    # n_out/2 and `n_out` bins of time points and between n_pulses/2 and `n_pulses`
+    # bins of pulses, or single data points and pulses where there are fewer.
+    # Returns the times of the bin centres, the first pulse of every bin of pulses,
+    # and the minimum, maximum and mean of every bin, (n_pulse_bins, n_time_bins)
+    # arrays, or 1D for a 1D pyramid.
+    def window(self, n_out, x_range=None, n_pulses=None, pulse_range=None):
+        n_rows, n = self.shape
+        i0, i1 = 0, n
+        if x_range is not None:
+            i0 = min(max(int(np.floor((x_range[0] - self.t0) / self.dt)), 0), n - 1)
+            i1 = min(max(int(np.ceil((x_range[1] - self.t0) / self.dt)) + 1, i0 + 1), n)
+        r0, r1 = (0, n_rows) if pulse_range is None else pulse_range
+        if n_pulses is None:
+            n_pulses = r1 - r0
+
+        t = 0
+        while (t + 1, 0) in self.levels and (i1 - i0) // self.factor**(t + 1) >= n_out:
+            t += 1
+        p = 0
+        while (t, p + 1) in self.levels and (r1 - r0) // self.factor**(p + 1) >= n_pulses:
+            p += 1
+
+        width, height = self.factor**t, self.factor**p
+        b0, b1 = i0 // width, -(-i1 // width)
+        c0, c1 = r0 // height, -(-r1 // height)
+        level = tuple(a[c0:c1, b0:b1] for a in self.levels[(t, p)])
+        time_counts = self.time_counts[t][b0:b1]
+        pulse_counts = self.pulse_counts[p][c0:c1]
+
+        # Merge the bins of the level down to the requested numbers
+        merge = -(-(b1 - b0) // n_out)
+        if merge > 1:
+            level, time_counts = _reduce(level, time_counts, merge, axis=1)
+            width *= merge
+        merge = -(-(c1 - c0) // n_pulses)
+        if merge > 1:
+            level, pulse_counts = _reduce(level, pulse_counts, merge, axis=0)
+            height *= merge
+
+        starts = b0 * self.factor**t + width * np.arange(len(time_counts))
+        times = self.t0 + self.dt * (starts + (time_counts - 1) / 2.0)
+        pulses = c0 * self.factor**p + height * np.arange(len(pulse_counts))
+
+        if self.ndim == 1:
+            level = tuple(a[0] for a in level)
+
+        return (times, pulses) + level
+
+    # Function that returns a window, see `window`, as a trace of two points per
+    # bin of time points, the minimum and the maximum in the order the trace
+    # rises or falls through the bin, a quarter of a bin either side of its
+    # centre. Bins of single data points are returned as they are. Returns the
+    # times, the first pulse of every bin of pulses and the values.
+    def envelope(self, n_out, x_range=None, n_pulses=None, pulse_range=None):
+        times, pulses, mins, maxs, means = self.window(n_out // 2, x_range, n_pulses, pulse_range)
+        if len(times) < 2 or times[1] - times[0] <= 1.5 * self.dt:
+            return times, pulses, means
+
+        rising = np.gradient(means, axis=-1) >= 0
+        values = np.empty(mins.shape[:-1] + (2 * mins.shape[-1],), dtype=mins.dtype)
+        values[..., 0::2] = np.where(rising, mins, maxs)
+        values[..., 1::2] = np.where(rising, maxs, mins)
+
+        quarter = (times[1] - times[0]) / 4.0
+        times = np.stack([times - quarter, times + quarter], axis=-1).ravel()
+
+        return times, pulses, values
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+
+# Server-side store for the pulse data of every browser session.
+#
+# Datasets stay on the server and the dcc.Store components in the app only carry
+# small handles, {'id': ..., 'version': ...}, so pulse matrices are never
+# serialized into the browser and back on each callback. Every value is stored
+# with its version, and a handle whose value has since been replaced under the
+# same id no longer resolves. Entries are scoped per
+# session (the 'session-id' of the page) and evicted when a session has been
+# idle for longer than `session_ttl` seconds, or least-recently-used first when
+# the store grows beyond `max_bytes`.
+#
+# Storage is delegated to a backend. MemoryBackend keeps the values in memory;
+# DiskBackend pickles them under a directory, which keeps large sessions out of
+# memory. The backend is chosen with the TAPPY_STORE_BACKEND environment
+# variable. Either way the app runs as one threaded process, since the jobs of
+# jobs.py and the result caches below live in the server process.
+
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import datacache
+
+
+# Function that estimates the memory held by a value: the bytes of every array and
+# string in it, looking into dicts, lists and objects that define `nbytes`
+def value_nbytes(value):
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sum(value_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(value_nbytes(v) for v in value)
+    if isinstance(value, basestring):
+        return len(value)
+
+    return 0
+
+
+# Backend that keeps values in a dict in this process, in least-recently-used order
+class MemoryBackend(object):
+
+    def __init__(self):
+        self._values = OrderedDict()
+        self._sizes = {}
+
+    # Function that returns the version and value stored under `key`
+    def get(self, key):
+        entry = self._values.pop(key)
+        self._values[key] = entry
+
+        return entry
+
+    def put(self, key, version, value, nbytes):
+        self._values.pop(key, None)
+        self._values[key] = (version, value)
+        self._sizes[key] = nbytes
+
+    def delete(self, key):
+        self._values.pop(key, None)
+        self._sizes.pop(key, None)
+
+    # Function that returns the version stored under `key`, or None
+    def version(self, key):
+        entry = self._values.get(key)
+
+        return entry[0] if entry is not None else None
+
+    # Keys from least to most recently used
+    def keys(self):
+        return list(self._values.keys())
+
+    def nbytes(self, key):
+        return self._sizes.get(key, 0)
+
+
+# Backend that pickles each value into its own file under `path`, after its
+# version so that the version can be read on its own. File mtimes record the
+# last access.
+class DiskBackend(object):
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def _file(self, key):
+        return os.path.join(self.path, key.replace('/', '%'))
+
+    # Function that returns the version and value stored under `key`
+    def get(self, key):
+        fname = self._file(key)
+        try:
+            with open(fname, 'rb') as f:
+                version = pickle.load(f)
+                value = pickle.load(f)
+        except (IOError, OSError, EOFError):
+            raise KeyError(key)
+        os.utime(fname, None)
+
+        return version, value
+
+    def put(self, key, version, value, nbytes):
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(version, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self._file(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    # Function that returns the version stored under `key`, or None
+    def version(self, key):
+        try:
+            with open(self._file(key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError):
+            return None
+
+    def keys(self):
+        files = []
+        for fname in os.listdir(self.path):
+            if not fname.startswith('.'):
+                full = os.path.join(self.path, fname)
+                try:
+                    files.append((os.path.getmtime(full), fname.replace('%', '/')))
+                except OSError:
+                    continue
+
+        return [key for _, key in sorted(files)]
+
+    def nbytes(self, key):
+        try:
+            return os.path.getsize(self._file(key))
+        except OSError:
+            return 0
+
+
+# Class that scopes values per session on top of a backend, hands out handles and
+# applies the eviction policy
+class DatasetStore(object):
+
+    def __init__(self, backend, max_bytes, session_ttl):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.session_ttl = session_ttl
+        self._last_seen = {}
+        self._lock = threading.RLock()
+
+    # Function that stores `value` under `name` in a session and returns its handle.
+    # `source` optionally names the datacache entry the value was loaded from,
+    # [cache key, dataset name], so it can be reloaded if it is evicted. Every put
+    # gets a new random version, so that server processes that share a
+    # DiskBackend never hand out the same version for different values.
+    def put(self, session, name, value, source=None):
+        key = '{0}/{1}'.format(session, name)
+        version = uuid.uuid4().hex
+        with self._lock:
+            self._last_seen[session] = time.time()
+
+            self.backend.put(key, version, value, value_nbytes(value))
+            self._evict()
+
+        return {'id': key, 'version': version, 'source': source}
+
+    # Function that returns the value of a handle, reloading it from the datacache
+    # if it was evicted and has a source. Handles without a version resolve to the
+    # latest value of their id. Raises KeyError if the value is gone, or has been
+    # replaced by a newer version since the handle was made.
+    def get(self, handle):
+        key = handle['id']
+        version = handle.get('version')
+        with self._lock:
+            self._last_seen[key.split('/', 1)[0]] = time.time()
+            try:
+                stored, value = self.backend.get(key)
+            except KeyError:
+                pass
+            else:
+                if version is None or stored == version:
+                    return value
+                raise KeyError('{0} has been replaced since version {1}'.format(key, version))
+
+        source = handle.get('source')
+        if source is not None and version is not None:
+            value = datacache.load(source[0])
+            if value is not None:
+                value = value[source[1]] if source[1] is not None else value
+                with self._lock:
+                    if self.backend.version(key) is None:
+                        self.backend.put(key, version, value, value_nbytes(value))
+                        self._evict()
+                return value
+
+        raise KeyError('{0} is no longer in the dataset store'.format(key))
+
+    # Function that tells whether the value of a handle is still in the store, at
+    # the version of the handle
+    def __contains__(self, handle):
+        with self._lock:
+            stored = self.backend.version(handle['id'])
+
+        return stored is not None and handle.get('version') in (None, stored)
+
+    # Function that removes every value of a session
+    def drop_session(self, session):
+        prefix = '{0}/'.format(session)
+        with self._lock:
+            for key in self.backend.keys():
+                if key.startswith(prefix):
+                    self.backend.delete(key)
+            self._last_seen.pop(session, None)
+
+    # Function that evicts idle sessions, then least-recently-used values until
+    # the store fits in max_bytes
+    def _evict(self):
+        now = time.time()
+        for session, seen in list(self._last_seen.items()):
+            if now - seen > self.session_ttl:
+                self.drop_session(session)
+
+        keys = self.backend.keys()
+        total = sum(self.backend.nbytes(k) for k in keys)
+        for key in keys:
+            if total <= self.max_bytes:
+                break
+            total -= self.backend.nbytes(key)
+            self.backend.delete(key)
+
+    # Total bytes held by the store
+    def nbytes(self):
+        with self._lock:
+            return sum(self.backend.nbytes(k) for k in self.backend.keys())
+
+
+# Class that holds a value being computed by get_or_compute, for the threads
+# waiting for it
+class _Computation(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.succeeded = False
+        self.value = None
+
+
+# Class that caches computed values in memory under hashable keys, least-recently-
+# used first out once they hold more than `max_bytes`. Used for intermediate
+# results that can always be recomputed, so nothing is ever reloaded.
+class ResultCache(object):
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._sizes = {}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        # Computations in progress, keyed like the values
+        self._computing = {}
+
+    # Function that returns the value cached under `key`, or None
+    def get(self, key):
+        with self._lock:
+            if key not in self._values:
+                self.misses += 1
+                return None
+            self.hits += 1
+            value = self._values.pop(key)
+            self._values[key] = value
+
+            return value
+
+    def put(self, key, value):
+        nbytes = value_nbytes(value)
+        with self._lock:
+            if key in self._values:
+                self._nbytes -= self._sizes[key]
+                del self._values[key]
+            self._values[key] = value
+            self._sizes[key] = nbytes
+            self._nbytes += nbytes
+
+            while self._nbytes > self.max_bytes and len(self._values) > 1:
+                old_key, _ = self._values.popitem(last=False)
+                self._nbytes -= self._sizes.pop(old_key)
+
+    # Function that returns the value cached under `key`, computing it with
+    # `func` and caching it on a miss. A value is computed by one thread at a
+    # time: threads asking for a key being computed wait for that computation,
+    # and compute it again only if it raised.
+    def get_or_compute(self, key, func):
+        while True:
+            with self._lock:
+                if key in self._values:
+                    self.hits += 1
+                    value = self._values.pop(key)
+                    self._values[key] = value
+                    return value
+
+                computation = self._computing.get(key)
+                if computation is None:
+                    self.misses += 1
+                    computation = self._computing[key] = _Computation()
+                    break
+
+            computation.done.wait()
+            if computation.succeeded:
+                with self._lock:
+                    self.hits += 1
+                return computation.value
+
+        try:
+            computation.value = func()
+            computation.succeeded = True
+            self.put(key, computation.value)
+        finally:
+            with self._lock:
+                del self._computing[key]
+            computation.done.set()
+
+        return computation.value
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._values
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._sizes.clear()
+            self._nbytes = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    # Total bytes held by the cache
+    def nbytes(self):
+        return self._nbytes
+
+    # Dict of the hit and miss counters, number of entries and bytes held
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self._values),
+                    'nbytes': self._nbytes}
+
+
+# Function that creates the store configured by the environment
+def create_store():
+    max_bytes = int(float(os.environ.get('TAPPY_STORE_MAX_MB', 4096)) * 2**20)
+    session_ttl = float(os.environ.get('TAPPY_STORE_SESSION_TTL', 6*3600))
+
+    if os.environ.get('TAPPY_STORE_BACKEND', 'memory') == 'disk':
+        path = os.environ.get('TAPPY_STORE_DIR', os.path.join(datacache.home, 'TAPSuite-store'))
+        shutil.rmtree(path, ignore_errors=True)
+        backend = DiskBackend(path)
+    else:
+        backend = MemoryBackend()
+
+    return DatasetStore(backend, max_bytes, session_ttl)
+
+
+# Store shared by the app and workers
+datastore = create_store()
+
+# Outputs of the preprocessing stages of tab 2, see workers.preprocess
+stage_cache = ResultCache(int(float(os.environ.get('TAPPY_STAGE_CACHE_MB', 1024)) * 2**20))
+
+# Corrected datasets keyed by dataset and correction params, see workers.get_corrected
+correction_cache = ResultCache(int(float(os.environ.get('TAPPY_CORRECTION_CACHE_MB', 512)) * 2**20))
+
+# Inert normalized datasets keyed by inert AMU and correction params, see
+# workers.inert_normalization
+normalization_cache = ResultCache(int(float(os.environ.get('TAPPY_NORMALIZATION_CACHE_MB', 512)) * 2**20))
+
+# Average pulses decimated for plotting, keyed by correction and zoom range, see
+# workers.avg_plot_data
+plot_cache = ResultCache(int(float(os.environ.get('TAPPY_PLOT_CACHE_MB', 64)) * 2**20))
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+# Streaming reader for the .xlsx workbooks generated from TAP-2/3 experiments.
+#
+# The first three sheets of a workbook hold experiment settings; every further
+# sheet holds one AMU, with a header row, the metadata in the 'Value' column, the
+# times in the third column and one column per pulse after that. Sheets are
+# read row by row with openpyxl in read-only mode, straight into a float array,
+# so no DataFrame is built. Each parsed sheet is kept in the datacache under the
+# hash of the workbook and the sheet name, so a workbook that was opened before
+# is not parsed again.
+
+import io
+import os
+import tempfile
+import zipfile
+from xml.etree import ElementTree
+
+import numpy as np
+from openpyxl import load_workbook
+
+import datacache
+import pulseset
+from pulseset import PulseSet
+
+FIRST_AMU_SHEET = 3
+SHEET_TAG = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}sheet'
+TIME_COL = 2
+FIRST_PULSE_COL = 3
+
+# Rows are added in blocks of this size when a sheet does not report its dimensions
+ROW_BLOCK = 4096
+
+
+# Function that parses one AMU sheet of a read-only workbook into a PulseSet
+def read_sheet(ws, index):
+    rows = ws.iter_rows(values_only=True)
+    header = next(rows)
+    value_col = list(header).index('Value')
+
+    n_pulses = len(header) - FIRST_PULSE_COL
+    n_rows = ws.max_row - 1 if ws.max_row else ROW_BLOCK
+
+    # Pulses are written column by column into a (n_pulses, n_rows) array, so the
+    # result is already C-ordered per pulse and no transposed copy is needed.
+    pulses = np.empty((n_pulses, max(n_rows, 1)), dtype=pulseset.dtype)
+    times = np.empty(pulses.shape[1])
+    values = []
+
+    n = 0
+    for row in rows:
+        if row[TIME_COL] is None:
+            continue
+
+        if n == pulses.shape[1]:
+            pulses = np.concatenate((pulses, np.empty((n_pulses, ROW_BLOCK), dtype=pulses.dtype)), axis=1)
+            times = np.concatenate((times, np.empty(ROW_BLOCK)))
+
+        pulses[:, n] = row[FIRST_PULSE_COL:FIRST_PULSE_COL+n_pulses]
+        times[n] = row[TIME_COL]
+        if row[value_col] is not None:
+            values.append(row[value_col])
+        n += 1
+
+    if len(values) < 4:
+        raise ValueError('Sheet {0!r} has {1} of 4 metadata values'.format(ws.title, len(values)))
+
+    return PulseSet.from_times(pulses[:, :n], times[:n],
+                               amu=float(values[0]),
+                               gain=int(values[1]),
+                               collection_time=float(values[3]),
+                               pulse_spacing=float(values[2]),
+                               index=index)
+
+
+# Function that returns the AMU of a sheet, the first entry of its 'Value'
+# column, by reading only the first rows
+def read_sheet_amu(ws, max_row=16):
+    rows = ws.iter_rows(max_row=max_row, values_only=True)
+    value_col = list(next(rows)).index('Value')
+    for row in rows:
+        if row[value_col] is not None:
+            return float(row[value_col])
+
+    raise ValueError('Sheet {0!r} has no AMU in its Value column'.format(ws.title))
+
+
+# Class that gives access to the AMU sheets of one workbook. Sheets are parsed
+# lazily, the first time an AMU is asked for, and cached both in memory and in
+# the datacache; `read_all` parses every sheet, in parallel if asked to.
+class Tap2Workbook(object):
+
+    def __init__(self, fil, key=None):
+        # The workbook is kept as a path or as raw bytes, either of which can be
+        # sent to worker processes
+        if hasattr(fil, 'read'):
+            fil.seek(0)
+            self.path, self.raw = None, fil.read()
+        else:
+            self.path, self.raw = fil, None
+
+        if key is None:
+            if self.path is None:
+                key = datacache.content_key(self.raw, 'xlsx')
+            else:
+                key = datacache.file_key(self.path, 'xlsx')
+        self.key = key
+
+        # Opening a workbook can scan every sheet, so the sheet names are read from
+        # the workbook part directly and the workbook is only opened when a sheet
+        # has to be parsed
+        self.sheet_names = read_sheet_names(self.path, self.raw)[FIRST_AMU_SHEET:]
+        self._wb = None
+        self._amus = None
+        self._parsed = {}
+
+    # Read-only workbook, opened on first use
+    @property
+    def wb(self):
+        if self._wb is None:
+            self._wb = open_workbook(self.path, self.raw)
+
+        return self._wb
+
+    # Key of one parsed sheet in the datacache
+    def sheet_key(self, sheet_name):
+        return datacache.content_key(
+            '{0}:{1}'.format(self.key, sheet_name).encode('utf-8'), 'xlsx-sheet')
+
+    # Dict of AMU label ('28.0') to sheet name, read from the first rows of every sheet
+    def amus(self):
+        if self._amus is None:
+            self._amus = {}
+            for sheet_name in self.sheet_names:
+                amu = read_sheet_amu(self.wb[sheet_name])
+                self._amus['{0:0.1f}'.format(amu)] = sheet_name
+
+        return self._amus
+
+    # Dataset of one sheet, parsed on first use
+    def sheet(self, sheet_name):
+        if sheet_name not in self._parsed:
+            key = self.sheet_key(sheet_name)
+            data = datacache.load(key)
+            if data is None:
+                index = self.sheet_names.index(sheet_name)
+                data = read_sheet(self.wb[sheet_name], index)
+                datacache.store(key, data)
+            self._parsed[sheet_name] = data
+
+        return self._parsed[sheet_name]
+
+    # Dataset of one AMU, parsed on first use
+    def dataset(self, amu):
+        return self.sheet(self.amus()[amu])
+
+    # Function that parses all sheets and returns them keyed by AMU label, the
+    # same structure that workers.read_tap2 returns. Sheets that are not cached
+    # yet are parsed across `pool`, a multiprocessing pool, if given. Workbooks
+    # held as bytes are written to a temporary file for the pool to open.
+    def read_all(self, pool=None):
+        missing = []
+        for sheet_name in self.sheet_names:
+            if sheet_name not in self._parsed:
+                data = datacache.load(self.sheet_key(sheet_name))
+                if data is None:
+                    missing.append(sheet_name)
+                else:
+                    self._parsed[sheet_name] = data
+
+        if pool is not None and len(missing) > 1:
+            path = self.path
+            if path is None:
+                fd, path = tempfile.mkstemp(prefix='tappy-', suffix='.xlsx')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(self.raw)
+            try:
+                pool.map(_read_sheet_worker,
+                         [(path, self.key, s, self.sheet_names.index(s), self.sheet_key(s))
+                          for s in missing],
+                         chunksize=1)
+            finally:
+                if path != self.path:
+                    os.remove(path)
+
+        combined = {}
+        for sheet_name in self.sheet_names:
+            data = self.sheet(sheet_name)
+            combined['{0:0.1f}'.format(data.amu)] = data
+
+        return combined
+
+
+# Function that returns the sheet names of a workbook, from a path or raw bytes,
+# in workbook order
+def read_sheet_names(path, raw=None):
+    archive = zipfile.ZipFile(path if path is not None else io.BytesIO(raw))
+    try:
+        root = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+    finally:
+        archive.close()
+
+    return [sheet.get('name') for sheet in root.iter(SHEET_TAG)]
+
+
+# Function that opens a workbook from a path or raw bytes in read-only mode
+def open_workbook(path, raw=None):
+    if path is None:
+        path = io.BytesIO(raw)
+
+    return load_workbook(path, read_only=True, data_only=True)
+
+
+# Key and workbook last opened by a worker process of Tap2Workbook.read_all, so
+# that the sheets of one workbook share it
+_worker_wb = (None, None)
+
+
+# Function run by the worker processes: parses one sheet into the datacache, from
+# where the parent loads it memory-mapped instead of receiving a pickled copy
+def _read_sheet_worker(args):
+    global _worker_wb
+    path, workbook_key, sheet_name, index, key = args
+    if _worker_wb[0] != workbook_key:
+        _worker_wb = (workbook_key, open_workbook(path))
+    datacache.store(key, read_sheet(_worker_wb[1][sheet_name], index))
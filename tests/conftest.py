@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+# The modules of the app are flat top-level modules of the repository
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Parsed files are cached in a directory of their own during the tests
+os.environ.setdefault('TAPPY_CACHE_DIR', tempfile.mkdtemp(prefix='tappy-test-cache-'))
+
+testdir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test-data')
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Baseline correction of all pulses at once gives the same pulses as correcting
+# them one by one
+
+import numpy as np
+import pytest
+
+import benchmarks
+import workers
+
+TIMES = np.linspace(0, 1.0, 200)
+
+
+@pytest.fixture
+def pulses():
+    random = np.random.RandomState(0)
+    drift = np.multiply.outer(random.uniform(-2, 2, size=12), TIMES)
+    return random.normal(size=(12, len(TIMES))) + random.uniform(-5, 5, size=(12, 1)) + drift
+
+
+# Function that fits, pulse by pulse, a straight line through the points of all
+# baseline windows and subtracts it
+def correct_drift_loop(pulses, times, windows):
+    mask = np.zeros(len(times), dtype=bool)
+    for t1, t2 in zip(windows[::2], windows[1::2]):
+        mask |= (times >= t1) & (times <= t2)
+
+    corrected = []
+    for pulse in pulses:
+        slope, intercept = np.polyfit(times[mask], pulse[mask], 1)
+        corrected.append(pulse - (slope*times + intercept))
+
+    return np.array(corrected)
+
+
+def test_one_window(pulses):
+    expected = benchmarks.correct_baseline_loop(pulses, TIMES, [0.1, 0.3])
+
+    assert np.allclose(workers.correct_baseline(pulses, TIMES, [0.1, 0.3]), expected)
+
+
+def test_two_windows(pulses):
+    windows = [0.0, 0.1, 0.8, 0.95]
+    expected = correct_drift_loop(pulses, TIMES, windows)
+    corrected = workers.correct_baseline(pulses, TIMES, windows)
+
+    assert np.allclose(corrected, expected)
+    # The drift is gone, not only the offset
+    assert np.allclose(corrected[:, TIMES <= 0.1].mean(axis=1), corrected[:, TIMES >= 0.8].mean(axis=1), atol=0.5)
+
+
+def test_empty_window(pulses):
+    corrected = workers.correct_baseline(pulses, TIMES, [2.0, 3.0])
+
+    assert corrected is not pulses
+    assert np.array_equal(corrected, pulses)
+
+
+def test_out(pulses):
+    expected = workers.correct_baseline(pulses, TIMES, [0.0, 0.1, 0.8, 0.95])
+    out = pulses.astype(np.float32)
+    corrected = workers.correct_baseline(out, TIMES, [0.0, 0.1, 0.8, 0.95], out=out)
+
+    assert corrected is out
+    assert np.allclose(out, expected, atol=1e-4)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# .tap containers: datasets written by write_container are read back with the
+# same arrays and metadata, from a path or from a file object
+
+import io
+import struct
+
+import numpy as np
+import pytest
+
+import container
+
+
+@pytest.fixture
+def datasets():
+    random = np.random.RandomState(0)
+    return {'28.0': {'amu': 28.0, 'gain': 9, 'n_pulses': 11, 'source': ['abc', '28.0'],
+                     'pulses': random.normal(size=(11, 37)),
+                     'times': np.linspace(0, 1, 37)},
+            '40.0-2': {'amu': 40.0, 'n_pulses': 3,
+                       'pulses': random.normal(size=(3, 5)).astype(np.float32),
+                       'counts': np.arange(7, dtype='>i4'),
+                       'empty': np.empty((0, 5))}}
+
+
+def check_equal(read, datasets):
+    assert sorted(read.keys()) == sorted(datasets.keys())
+    for name, dataset in datasets.items():
+        assert sorted(read[name].keys()) == sorted(dataset.keys())
+        for k, v in dataset.items():
+            if isinstance(v, np.ndarray):
+                assert read[name][k].dtype == v.dtype.newbyteorder('<')
+                assert read[name][k].shape == v.shape
+                assert np.array_equal(read[name][k], v)
+            else:
+                assert read[name][k] == v
+
+
+def test_round_trip_path(datasets, tmpdir):
+    path = str(tmpdir.join('data.tap'))
+    container.write_container(path, datasets)
+    read = container.read_container(path)
+
+    check_equal(read, datasets)
+    assert isinstance(read['28.0']['pulses'], np.memmap)
+    assert container.list_datasets(path) == ['28.0', '40.0-2']
+
+
+def test_round_trip_file(datasets):
+    fil = io.BytesIO()
+    container.write_container(fil, datasets)
+
+    check_equal(container.read_container(fil), datasets)
+    assert container.list_datasets(fil) == ['28.0', '40.0-2']
+
+
+def test_alignment(datasets):
+    fil = io.BytesIO()
+    container.write_container(fil, datasets)
+    fil.seek(0)
+    header, data_start = container.read_header(fil)
+
+    assert data_start % container.ALIGN == 0
+    for entry in header['datasets']:
+        for spec in entry['arrays'].values():
+            assert spec['offset'] % container.ALIGN == 0
+
+
+def test_pulse_range(datasets, tmpdir):
+    path = str(tmpdir.join('data.tap'))
+    container.write_container(path, datasets)
+    read = container.read_container(path, amus=['28.0'], pulses=slice(2, 9, 3))
+
+    assert list(read.keys()) == ['28.0']
+    assert np.array_equal(read['28.0']['pulses'], datasets['28.0']['pulses'][2:9:3])
+    assert read['28.0']['n_pulses'] == 3
+    assert np.array_equal(read['28.0']['times'], datasets['28.0']['times'])
+
+
+def test_not_a_container(datasets):
+    with pytest.raises(ValueError):
+        container.read_container(io.BytesIO(b'TAPPY'))
+    with pytest.raises(ValueError):
+        container.read_container(io.BytesIO(b'NOTTAPPY' + b'\x00'*64))
+
+    fil = io.BytesIO()
+    container.write_container(fil, datasets)
+    data = fil.getvalue()
+    newer = struct.pack('<I', container.VERSION + 1)
+    with pytest.raises(ValueError):
+        container.read_container(io.BytesIO(data[:8] + newer + data[12:]))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+# Apply-all: correcting the AMUs across a process pool gives the same datasets as
+# correcting them in this process
+
+import multiprocessing
+import os
+
+import numpy as np
+
+import workers
+from conftest import testdir
+
+SESSION = 'test-correct'
+
+
+def test_parallel_equals_serial():
+    with open(os.path.join(testdir, sorted(os.listdir(testdir))[0]), 'rb') as f:
+        raw = workers.read_raw(f)
+
+    raw_data, temp_data = {}, {}
+    for k, (corr, smooth) in enumerate([(True, True), (True, False), (False, True)]):
+        amu = '{0:0.1f}'.format(k)
+        raw_data[amu] = workers.datastore.put(SESSION, 'raw/{0}'.format(amu),
+                                              raw.with_pulses(raw.pulses * (k + 1)))
+        temp_data[amu] = [amu, 'baseline corr smooth pulses', [0.1, 0.3], corr, smooth, 11 + 2*k, 3]
+    raw_data_dict = [{'props': {'data': raw_data}}]
+
+    def run(pool):
+        workers.correction_cache.clear()
+        workers.stage_cache.clear()
+        result = workers.correct_full_data(temp_data, raw_data_dict, None, SESSION, pool=pool)
+        return dict((amu, np.array(workers.get_dataset(result[amu]['handle']).pulses))
+                    for amu in result)
+
+    serial = run(None)
+    pool = multiprocessing.Pool(2)
+    try:
+        parallel = run(pool)
+    finally:
+        pool.terminate()
+
+    assert sorted(parallel.keys()) == sorted(temp_data.keys())
+    for amu in temp_data:
+        assert np.array_equal(parallel[amu], serial[amu])
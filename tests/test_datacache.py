@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+import datacache
+import pulseset
+
+
+def test_key_depends_on_precision():
+    raw = b'0 1 2 3'
+    try:
+        pulseset.set_precision('float32')
+        key32 = datacache.content_key(raw, 'raw')
+        pulseset.set_precision('float64')
+        key64 = datacache.content_key(raw, 'raw')
+    finally:
+        pulseset.set_precision('float64')
+
+    assert key32 != key64
+
+
+def test_store_load_round_trip():
+    pulse_set = pulseset.PulseSet(np.random.RandomState(0).normal(size=(5, 40)), 0.0, 0.01, 28.0, gain=9)
+    key = datacache.content_key(b'round trip', 'raw')
+    datacache.store(key, {'28.0': pulse_set})
+
+    loaded = datacache.load(key)['28.0']
+    assert np.array_equal(loaded.pulses, pulse_set.pulses)
+    assert loaded.pulses.dtype == pulseset.dtype
+    assert (loaded.time_axis, loaded.amu, loaded.gain) == (pulse_set.time_axis, 28.0, 9)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# Decimation of traces for plotting: the ends of a trace and its extrema survive
+
+import numpy as np
+import pytest
+
+import decimation
+
+
+@pytest.fixture
+def trace():
+    random = np.random.RandomState(0)
+    x = np.linspace(0, 1.0, 10007)
+    y = np.exp(-20*x) + 0.01*random.normal(size=len(x))
+    y[1234], y[8765] = 3.0, -2.0
+
+    return x, y
+
+
+@pytest.mark.parametrize('method', decimation.METHODS)
+def test_endpoints_kept(trace, method):
+    x, y = trace
+    xd, yd = decimation.decimate(x, y, 500, method=method)
+
+    assert len(xd) <= 500 + 2
+    assert (xd[0], yd[0]) == (x[0], y[0])
+    assert (xd[-1], yd[-1]) == (x[-1], y[-1])
+    assert np.all(np.diff(xd) > 0)
+
+
+@pytest.mark.parametrize('method', decimation.METHODS)
+def test_extrema_kept(trace, method):
+    x, y = trace
+    xd, yd = decimation.decimate(x, y, 500, method=method)
+
+    assert yd.max() == y.max()
+    assert yd.min() == y.min()
+
+
+def test_minmax_bins(trace):
+    x, y = trace
+    inds = decimation.minmax(y, 500)
+    width = -(-len(y) // 250)
+
+    kept = set(inds)
+    for start in range(0, len(y), width):
+        bin_y = y[start:start + width]
+        assert start + bin_y.argmin() in kept
+        assert start + bin_y.argmax() in kept
+
+
+def test_short_trace(trace):
+    x, y = trace
+    xd, yd = decimation.decimate(x[:100], y[:100], 500)
+
+    assert np.array_equal(xd, x[:100])
+    assert np.array_equal(yd, y[:100])
+
+
+@pytest.mark.parametrize('method', decimation.METHODS)
+def test_x_range(trace, method):
+    x, y = trace
+    xd, yd = decimation.decimate(x, y, 500, x_range=(0.25, 0.5), method=method)
+    inside = x[(x >= 0.25) & (x <= 0.5)]
+
+    # One point either side of the range, so the trace reaches the plot edges
+    assert xd[0] < 0.25 and xd[-1] > 0.5
+    assert xd[1] >= inside[0] and xd[-2] <= inside[-1]
+
+
+def test_unknown_method(trace):
+    with pytest.raises(ValueError):
+        decimation.decimate(trace[0], trace[1], 500, method='every-nth')
+
+
+def test_minmax_pulses():
+    random = np.random.RandomState(1)
+    times = np.linspace(0, 1.0, 3001)
+    pulses = random.normal(size=(6, len(times)))
+    t, decimated = decimation.minmax_pulses(times, pulses, 200)
+
+    assert decimated.shape == (6, len(t))
+    assert len(t) <= 200 + 2
+    assert np.array_equal(decimated.max(axis=1), pulses.max(axis=1))
+    assert np.array_equal(decimated.min(axis=1), pulses.min(axis=1))
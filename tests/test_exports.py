@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# Export formats: datasets are named after their store keys, so two files with
+# the same AMU are both exported
+
+import io
+import json
+import os
+import zipfile
+
+import flask
+import numpy as np
+import openpyxl
+import pytest
+
+import exports
+import workers
+from conftest import testdir
+
+NAMES = ['27.7', '27.7-2']
+
+
+@pytest.fixture(scope='module')
+def datasets():
+    with open(os.path.join(testdir, sorted(os.listdir(testdir))[0]), 'rb') as f:
+        raw = workers.read_raw(f)
+    pulse_sets = [raw, raw.with_pulses(2*raw.pulses)]
+    metas = [exports.dataset_meta(pulse_set) for pulse_set in pulse_sets]
+
+    return pulse_sets, metas
+
+
+def generate(fmt, datasets):
+    pulse_sets, metas = datasets
+    return b''.join(exports.export(fmt, NAMES, pulse_sets, metas)[2])
+
+
+def test_xlsx_names(datasets):
+    workbook = openpyxl.load_workbook(io.BytesIO(generate('xlsx', datasets)), read_only=True)
+    assert workbook.sheetnames == NAMES
+
+
+def test_csv_names(datasets):
+    archive = zipfile.ZipFile(io.BytesIO(generate('csv', datasets)))
+    assert archive.namelist() == ['27.7.csv', '27.7-2.csv']
+
+    rows = archive.read('27.7-2.csv').decode('ascii').splitlines()
+    assert float(rows[1].split(',')[2]) == 2*datasets[0][0].pulses[0, 0]
+
+
+def test_npz_names(datasets):
+    pulse_sets, metas = datasets
+    npz = np.load(io.BytesIO(generate('npz', datasets)))
+    meta = json.loads(npz['meta'].item())
+
+    assert [m['name'] for m in meta['datasets']] == NAMES
+    for name, pulse_set in zip(NAMES, pulse_sets):
+        assert np.array_equal(npz['{0}/pulses'.format(name)], pulse_set.pulses)
+
+
+def test_parquet_names(datasets):
+    pq = pytest.importorskip('pyarrow.parquet')
+    pulse_sets, metas = datasets
+    table = pq.read_table(io.BytesIO(generate('parquet', datasets))).to_pandas()
+
+    for name, pulse_set in zip(NAMES, pulse_sets):
+        values = table[table['dataset'] == name]['value'].values
+        assert np.array_equal(values, pulse_set.pulses.ravel())
+
+
+def test_parquet_needs_pyarrow(datasets):
+    if exports.pa is not None:
+        pytest.skip('pyarrow is installed')
+
+    assert 'parquet' not in exports.FORMATS
+    with pytest.raises(ValueError):
+        generate('parquet', datasets)
+
+
+def test_duplicate_names(datasets):
+    pulse_sets, metas = datasets
+    with pytest.raises(ValueError):
+        exports.export('csv', ['27.7', '27.7'], pulse_sets, metas)
+
+
+def test_single_amu_link_sheet(datasets):
+    pulse_sets, metas = datasets
+    workers.datastore.put('export-test', 'export/27.7-2',
+                          {'data': pulse_sets[1], 'params': None, 'key': ('export-test', 1)})
+    with flask.Flask(__name__).test_request_context():
+        response = workers.create_download_link('27.7-2', 'export-test', 'xlsx')
+        workbook = openpyxl.load_workbook(io.BytesIO(b''.join(response.response)), read_only=True)
+
+    assert workbook.sheetnames == [exports.SINGLE_SHEET]
+    assert 'AMU=27.7-2.xlsx' in response.headers['Content-Disposition']
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# Figures of the app
+
+import base64
+import struct
+import zlib
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+import figures
+from pulseset import PulseSet
+
+
+def test_colors_cycle():
+    pulses = np.random.RandomState(0).normal(size=(5, 100))
+    n = len(figures.colors)
+    for index in [0, n - 1, n, 3*n + 2]:
+        pulse_set = PulseSet(pulses, 0.0, 1e-3, 28.0, index=index)
+        color = figures.colors[index % n]
+
+        assert figures.figure3d(pulse_set)['data'][0]['line']['color'] == color
+        figure = figures.avg_figure(pulse_set, pulse_set.times, pulse_set.avg_pulse())
+        assert figure['data'][0]['line']['color'] == color
+
+
+# Function that decodes a PNG data URI made by figures.raster_png into its
+# chunks, checking their CRCs
+def png_chunks(uri):
+    prefix = 'data:image/png;base64,'
+    assert uri.startswith(prefix)
+    png = base64.b64decode(uri[len(prefix):])
+    assert png[:8] == b'\x89PNG\r\n\x1a\n'
+
+    chunks = []
+    pos = 8
+    while pos < len(png):
+        length, = struct.unpack('>I', png[pos:pos + 4])
+        kind, data = png[pos + 4:pos + 8], png[pos + 8:pos + 8 + length]
+        crc, = struct.unpack('>I', png[pos + 8 + length:pos + 12 + length])
+        assert crc == zlib.crc32(kind + data) & 0xFFFFFFFF
+        chunks.append((kind, data))
+        pos += 12 + length
+
+    return chunks
+
+
+def test_raster_png(monkeypatch):
+    monkeypatch.setattr(figures, 'RASTER_WIDTH', 10)
+    monkeypatch.setattr(figures, 'RASTER_HEIGHT', 9)
+    values = np.array([[0.0, 1.0, 2.0, 3.0, 4.0],
+                       [4.0, np.nan, -1.0, 5.0, 2.0],
+                       [1.0, 1.0, 1.0, 1.0, 1.0]])
+
+    chunks = png_chunks(figures.raster_png(values, 0.0, 4.0))
+    assert [kind for kind, _ in chunks] == [b'IHDR', b'PLTE', b'IDAT', b'IEND']
+
+    width, height, depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', chunks[0][1])
+    assert (width, height, depth, color_type, interlace) == (10, 9, 8, 3, 0)
+
+    palette = np.frombuffer(chunks[1][1], dtype=np.uint8).reshape(-1, 3)
+    assert np.array_equal(palette, plt.get_cmap(figures.RASTER_CMAP)(np.linspace(0, 1, 256), bytes=True)[:, :3])
+
+    rows = np.frombuffer(zlib.decompress(chunks[2][1]), dtype=np.uint8).reshape(height, width + 1)
+    assert not rows[:, 0].any()
+    expected = np.array([[0, 63, 127, 191, 255],
+                         [255, 0, 0, 255, 127],
+                         [63, 63, 63, 63, 63]], dtype=np.uint8)
+    assert np.array_equal(rows[:, 1:], np.repeat(np.repeat(expected, 3, axis=0), 2, axis=1))
+
+
+def test_raster_png_flat():
+    chunks = png_chunks(figures.raster_png(np.ones((4, 4)), 1.0, 1.0))
+    width, height = struct.unpack('>II', chunks[0][1][:8])
+    rows = np.frombuffer(zlib.decompress(chunks[2][1]), dtype=np.uint8).reshape(height, width + 1)
+
+    assert not rows.any()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Parsing uploads across a process pool gives the same datasets as parsing them
+# in this process
+
+import base64
+import io
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+import tap2
+import workers
+import xlsxstream
+from conftest import testdir
+
+AMUS = [28.0, 40.0, 44.0]
+
+
+@pytest.fixture(scope='module')
+def pool():
+    pool = multiprocessing.Pool(2)
+    yield pool
+    pool.terminate()
+
+
+# Function that writes a TAP-2 workbook of three settings sheets and one sheet of
+# `pulses` per AMU, with the AMU, gain, pulse spacing and collection time in the
+# 'Value' column. A seed keeps workbooks apart in the datacache.
+def tap2_workbook(seed, n_pulses=4, n_datapts=30):
+    random = np.random.RandomState(seed)
+    sheets = [('Settings {0}'.format(i), ['Setting'], []) for i in range(tap2.FIRST_AMU_SHEET)]
+    expected = {}
+    for amu in AMUS:
+        pulses = random.normal(size=(n_pulses, n_datapts))
+        rows = np.full((n_datapts, n_pulses + 3), np.nan)
+        rows[:4, 1] = [amu, 9, 0.5, 1.0]
+        rows[:, 2] = np.linspace(0, 1.0, n_datapts)
+        rows[:, 3:] = pulses.T
+        sheets.append(('AMU {0}'.format(amu), ['Name', 'Value', 'Time'] +
+                       [str(i) for i in range(1, n_pulses + 1)], [rows]))
+        expected['{0:0.1f}'.format(amu)] = pulses
+
+    return b''.join(xlsxstream.write_workbook(sheets)), expected
+
+
+def check_workbook(datasets, expected):
+    assert sorted(datasets.keys()) == sorted(expected.keys())
+    for amu, pulses in expected.items():
+        assert np.array_equal(datasets[amu].pulses, pulses.astype(datasets[amu].pulses.dtype))
+        assert datasets[amu].amu == float(amu)
+
+
+@pytest.mark.parametrize('use_pool', [False, True])
+def test_tap2_bytes(pool, use_pool):
+    data, expected = tap2_workbook(1 + use_pool)
+    workbook = tap2.Tap2Workbook(io.BytesIO(data))
+
+    check_workbook(workbook.read_all(pool if use_pool else None), expected)
+
+
+def test_tap2_path(pool, tmpdir):
+    data, expected = tap2_workbook(3)
+    path = str(tmpdir.join('tap2.xlsx'))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    check_workbook(tap2.Tap2Workbook(path).read_all(pool), expected)
+
+
+def test_load_all_data(pool):
+    names = sorted(os.listdir(testdir))
+    contents = []
+    for name in names:
+        with open(os.path.join(testdir, name), 'rb') as f:
+            contents.append('data:application/octet-stream;base64,' + base64.b64encode(f.read()))
+
+    serial, serial_errors = workers.load_all_data(contents, names)
+    pooled, pooled_errors = workers.load_all_data(contents, names, pool)
+
+    assert serial_errors == pooled_errors == []
+    assert len(pooled) == len(names)
+    for a, b in zip(serial, pooled):
+        assert a.amu == b.amu
+        assert np.array_equal(a.pulses, b.pulses)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+# Background jobs: progress is reported while a job runs, results are collected
+# once, and cancelled jobs stop at their next progress report
+
+import threading
+import time
+
+import jobs
+
+
+# Function that waits for a job to reach `status` and returns its info
+def wait_for(queue, job_id, status, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        info = queue.status(job_id)
+        if info['status'] == status:
+            return info
+        time.sleep(0.005)
+
+    raise AssertionError('job {0} is {1}, not {2}'.format(job_id, queue.status(job_id)['status'], status))
+
+
+# Function of a job that reports `done` of 4 steps each time `step` is set and
+# sets `proceed` after each, and returns 'result' once `step` is set a fifth time
+def stepped(job, step, proceed):
+    for done in range(4):
+        step.wait()
+        step.clear()
+        job.report(done, 4)
+        proceed.set()
+    step.wait()
+
+    return 'result'
+
+
+# Function that lets a stepped job take its next step and waits until it has
+def advance(step, proceed):
+    proceed.clear()
+    step.set()
+    assert proceed.wait(5.0)
+
+
+def test_progress():
+    queue = jobs.JobQueue(workers=1)
+    step, proceed = threading.Event(), threading.Event()
+    job_id = queue.submit('stepped', stepped, step, proceed)
+
+    for done in range(4):
+        advance(step, proceed)
+        assert queue.status(job_id)['status'] == jobs.RUNNING
+        assert queue.status(job_id)['progress'] == 25.0*done
+    assert queue.collect(job_id) is None
+
+    step.set()
+    info = wait_for(queue, job_id, jobs.DONE)
+    assert info['progress'] == 100.0
+    assert queue.collect(job_id) == 'result'
+    assert queue.collect(job_id) is None
+    assert queue.status(job_id)['collected']
+
+
+def test_cancel_running():
+    queue = jobs.JobQueue(workers=1)
+    step, proceed = threading.Event(), threading.Event()
+    job_id = queue.submit('stepped', stepped, step, proceed)
+
+    advance(step, proceed)
+    assert queue.cancel(job_id)
+    step.set()
+
+    info = wait_for(queue, job_id, jobs.CANCELLED)
+    assert info['progress'] == 0.0
+    assert queue.collect(job_id) is None
+    assert not queue.cancel(job_id)
+
+
+def test_cancel_queued():
+    queue = jobs.JobQueue(workers=1)
+    step, proceed = threading.Event(), threading.Event()
+    first = queue.submit('stepped', stepped, step, proceed)
+    ran = []
+    second = queue.submit('queued', lambda job: ran.append(job))
+
+    assert queue.status(second)['status'] == jobs.QUEUED
+    assert queue.cancel(second)
+    assert queue.status(second)['status'] == jobs.CANCELLED
+
+    for done in range(4):
+        advance(step, proceed)
+    step.set()
+    wait_for(queue, first, jobs.DONE)
+    # Jobs run in submission order, so the worker has skipped the cancelled job
+    wait_for(queue, queue.submit('after', lambda job: None), jobs.DONE)
+
+    assert ran == []
+    assert queue.status(second)['status'] == jobs.CANCELLED
+
+
+def test_failed():
+    queue = jobs.JobQueue(workers=1)
+    job_id = queue.submit('failing', lambda job: 1 // 0)
+
+    info = wait_for(queue, job_id, jobs.FAILED)
+    assert 'ZeroDivisionError' in info['error']
+    assert queue.collect(job_id) is None
+
+
+def test_unknown_job():
+    queue = jobs.JobQueue(workers=1)
+
+    assert queue.status('nope') is None
+    assert not queue.cancel('nope')
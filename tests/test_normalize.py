@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+# Inert normalization of all AMUs at once gives the same pulses as normalizing
+# them one by one
+
+import numpy as np
+import pytest
+
+import benchmarks
+import workers
+from pulseset import PulseSet
+
+AMUS = ['28.0', '40.0', '44.0']
+
+
+# Function that returns PulseSets of positive random pulses, one per AMU, with
+# `n_datapts` data points over one second
+def pulse_sets(n_pulses=8, n_datapts=(60, 60, 60)):
+    random = np.random.RandomState(0)
+    return dict((amu, PulseSet(random.uniform(0.5, 2.0, size=(n_pulses, n)), 0.0, 1.0/(n - 1), float(amu)))
+                for amu, n in zip(AMUS, n_datapts))
+
+
+def test_equals_per_pulse():
+    datasets = pulse_sets()
+    times = datasets['40.0'].times
+    expected = benchmarks.inert_normalization_loop(
+        '40.0', dict((amu, datasets[amu].pulses.astype(np.float64)) for amu in AMUS), times)
+    normalized = workers.normalize_pulses('40.0', datasets)
+
+    assert sorted(normalized.keys()) == AMUS
+    for amu in AMUS:
+        assert normalized[amu].amu == float(amu)
+        assert np.allclose(normalized[amu].pulses, expected[amu], rtol=1e-5)
+    # Every inert pulse now has the area of the largest one
+    areas = np.trapz(normalized['40.0'].pulses, times, axis=1)
+    assert np.allclose(areas, areas.max())
+
+
+def test_different_data_points():
+    datasets = pulse_sets(n_datapts=(60, 45, 80))
+    inert = datasets['40.0']
+    coeffs = np.array([np.trapz(pulse.astype(np.float64), inert.times) for pulse in inert.pulses])
+    coeffs /= coeffs.max()
+    normalized = workers.normalize_pulses('40.0', datasets)
+
+    for amu in AMUS:
+        assert normalized[amu].pulses.shape == datasets[amu].pulses.shape
+        assert np.allclose(normalized[amu].pulses, datasets[amu].pulses / coeffs[:, np.newaxis], rtol=1e-5)
+
+
+def test_different_pulse_counts():
+    datasets = pulse_sets()
+    datasets['44.0'] = pulse_sets(n_pulses=5)['44.0']
+
+    with pytest.raises(ValueError):
+        workers.normalize_pulses('40.0', datasets)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# Previews of tab 2: the middle pulse of equal strata of the experiment on a
+# decimated time axis, smoothed with the window scaled to that axis
+
+import numpy as np
+import pytest
+
+import workers
+from pulseset import PulseSet
+
+SESSION = 'test-preview'
+
+
+@pytest.fixture(autouse=True)
+def preview_size(monkeypatch):
+    monkeypatch.setattr(workers, 'PREVIEW_PULSES', 25)
+    monkeypatch.setattr(workers, 'PREVIEW_POINTS', 500)
+
+
+# Function that stores a dataset of `n_pulses` pulses of `n_datapts` points, each
+# pulse offset by its pulse number so previews show which pulses they picked
+def dataset(n_pulses, n_datapts):
+    random = np.random.RandomState(0)
+    pulses = 1000.0*np.arange(n_pulses)[:, np.newaxis] + random.normal(size=(n_pulses, n_datapts))
+    pulse_set = PulseSet(pulses, 0.0, 1e-4, 28.0)
+
+    return pulse_set, workers.datastore.put(SESSION, 'raw/28.0', pulse_set)
+
+
+def params(corr, smooth, window_size, order):
+    return ['28.0', 'baseline corr smooth pulses', [0.0, 0.01], corr, smooth, window_size, order]
+
+
+def test_stratified_subset():
+    pulse_set, handle = dataset(1000, 5000)
+    assert workers.preview_size(pulse_set) == (25, 10)
+
+    preview = workers.preview_stage(pulse_set, 25, 10)
+    picked = np.round(preview.pulses[:, 0] / 1000.0).astype(int)
+
+    # One pulse from the middle of each stratum of 40 pulses
+    assert np.array_equal(picked, 40*np.arange(25) + 20)
+    assert preview.n_datapoints == 500
+    assert preview.dt == 10*pulse_set.dt
+    assert np.array_equal(preview.pulses, pulse_set.pulses[picked, ::10])
+
+
+def test_fewer_pulses_than_strata():
+    pulse_set, handle = dataset(10, 5000)
+    preview = workers.preview_stage(pulse_set, *workers.preview_size(pulse_set))
+
+    assert preview.n_pulses == 10
+    assert preview.n_datapoints == 500
+
+
+def test_small_dataset_not_previewed():
+    pulse_set, handle = dataset(25, 500)
+    assert workers.preview_size(pulse_set) is None
+
+    expected = workers.preprocess(handle, params(True, True, 51, 3))
+    preview = workers.preprocess(handle, params(True, True, 51, 3), preview=True)
+    assert np.array_equal(preview.pulses, expected.pulses)
+
+
+# Windows of 101, 11 and 41 points on the full axis cover 11, 1 and 5 points of
+# the axis decimated by 10; 1 is widened to the smallest window valid for order 4
+@pytest.mark.parametrize('window_size, order, scaled', [(101, 2, 11), (11, 4, 7), (41, 3, 5)])
+def test_window_scaling(window_size, order, scaled):
+    pulse_set, handle = dataset(1000, 5000)
+    preview = workers.preprocess(handle, params(True, True, window_size, order), preview=True)
+
+    subset = workers.preview_stage(pulse_set, 25, 10)
+    corrected = workers.correct_baseline(subset.pulses, subset.times, [0.0, 0.01])
+    expected = workers.savitzky_golay_pulses(corrected, scaled, order)
+
+    assert preview.n_pulses == 25
+    assert np.allclose(preview.pulses, expected)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+# Pyramids of pulse data: every level and every window holds the minimum,
+# maximum and mean of its bins of the data, and pyramids are stored without the
+# data
+
+import pickle
+
+import numpy as np
+import pytest
+
+import store
+import workers
+from pulseset import PulseSet
+from pyramid import FACTOR, Pyramid
+
+T0, DT = 0.5, 1e-3
+
+
+@pytest.fixture(scope='module')
+def data():
+    return np.random.RandomState(0).normal(size=(37, 1000))
+
+
+# Function that returns the minimum, maximum and mean of the bins of `data`
+# starting at the rows `row_starts` and columns `col_starts`, `height` rows and
+# `width` columns each, or up to the end of the data
+def brute_force(data, row_starts, height, col_starts, width):
+    blocks = [[data[r:r + height, c:c + width] for c in col_starts] for r in row_starts]
+    return (np.array([[b.min() for b in row] for row in blocks]),
+            np.array([[b.max() for b in row] for row in blocks]),
+            np.array([[b.mean() for b in row] for row in blocks]))
+
+
+def check_bins(actual, expected):
+    mins, maxs, means = actual
+    assert np.array_equal(mins, expected[0])
+    assert np.array_equal(maxs, expected[1])
+    assert np.allclose(means, expected[2])
+
+
+def test_levels(data):
+    pyramid = Pyramid(data, T0, DT)
+    assert max(t for t, p in pyramid.levels) == 2
+    assert max(p for t, p in pyramid.levels) == 3
+
+    for (t, p), level in pyramid.levels.items():
+        width, height = FACTOR**t, FACTOR**p
+        check_bins(level, brute_force(data, range(0, data.shape[0], height), height,
+                                      range(0, data.shape[1], width), width))
+
+
+@pytest.mark.parametrize('n_out, x_range, n_pulses, pulse_range', [
+    (100, None, None, None),
+    (100, None, 5, None),
+    (30, (T0 + 0.1, T0 + 0.7), 4, (3, 30)),
+    (400, (T0 + 0.2, T0 + 0.3), 37, None),
+    (10, (T0 + 0.9, T0 + 5.0), 1, (36, 37))])
+def test_window(data, n_out, x_range, n_pulses, pulse_range):
+    times, pulses, mins, maxs, means = Pyramid(data, T0, DT).window(n_out, x_range, n_pulses, pulse_range)
+
+    assert len(times) <= n_out
+    assert len(pulses) <= (n_pulses or data.shape[0])
+
+    # Bins of time points are `width` points wide, centred on `times`, and the
+    # last one stops at the end of the data
+    width = int(round((times[1] - times[0]) / DT))
+    first = int(round((times[0] - T0) / DT - (width - 1) / 2.0))
+    col_starts = first + width * np.arange(len(times))
+    height = pulses[1] - pulses[0] if len(pulses) > 1 else data.shape[0]
+
+    check_bins((mins, maxs, means), brute_force(data, pulses, height, col_starts, width))
+    if x_range is not None:
+        assert times[0] - width*DT/2.0 <= x_range[0]
+        assert times[-1] + width*DT/2.0 >= min(x_range[1], T0 + DT*(data.shape[1] - 1))
+
+
+def test_window_1d(data):
+    avg = data.mean(axis=0)
+    times, pulses, mins, maxs, means = Pyramid(avg, T0, DT).window(50)
+
+    assert mins.ndim == 1
+    width = int(round((times[1] - times[0]) / DT))
+    check_bins((mins, maxs, means), tuple(a[0] for a in brute_force(
+        avg[np.newaxis], [0], 1, range(0, len(avg), width), width)))
+
+
+def test_without_data(data):
+    pyramid = Pyramid(data, T0, DT)
+    stored = pyramid.without_data()
+
+    assert (0, 0) not in stored.levels
+    assert (0, 0) in pyramid.levels
+    assert stored.nbytes == pyramid.nbytes
+    assert len(pickle.dumps(stored, 2)) < stored.nbytes + data.nbytes // 2
+
+    restored = stored.with_data(data)
+    for args in [(2000,), (100, (T0 + 0.2, T0 + 0.21))]:
+        for a, b in zip(pyramid.window(*args), restored.window(*args)):
+            assert np.array_equal(a, b)
+
+    with pytest.raises(ValueError):
+        stored.with_data(data[1:])
+
+
+@pytest.mark.parametrize('average', [False, True])
+def test_stored_without_pulses(data, average):
+    pulse_set = PulseSet(data, T0, DT, 28.0)
+    handle = workers.datastore.put('test-pyramid', 'corrected/28.0', pulse_set)
+    built = workers.get_pyramid(handle, average)
+
+    entry = workers.datastore.get({'id': 'test-pyramid/corrected/28.0/{0}'.format(
+        'avg-pyramid' if average else 'pyramid')})
+    assert (0, 0) not in entry['pyramid'].levels
+    # What the store counts is what it keeps, without a second copy of the pulses
+    assert len(pickle.dumps(entry, 2)) < 1.1 * store.value_nbytes(entry)
+    assert ('data' in entry) == average
+
+    loaded = workers.get_pyramid(handle, average)
+    assert loaded is not built
+    for a, b in zip(built.window(2000), loaded.window(2000)):
+        assert np.array_equal(a, b)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+# TAP-1 raw files: pulses written in the raw layout are parsed back exactly,
+# across block boundaries, and broken files raise ValueError
+
+import io
+import os
+
+import numpy as np
+import pytest
+
+import workers
+from conftest import testdir
+
+
+# Function that writes pulses as a TAP-1 raw file: a title line, the numeric
+# header and then one value per line, pulse after pulse
+def raw_file(pulses, collection_time=0.5, amu=28.0, gain=7, spacing=0.25, index=3):
+    header = [0.0] * workers.RAW_HEADER_LEN
+    header[3] = pulses.shape[1]
+    header[5] = collection_time
+    header[6] = gain
+    header[7] = pulses.shape[0]
+    header[13] = amu / 30
+    header[15] = spacing
+    header[16] = index
+
+    lines = ['TAP-1 test file'] + [repr(v) for v in header] + [repr(v) for v in pulses.ravel().tolist()]
+    return io.BytesIO(('\r\n'.join(lines) + '\r\n').encode('ascii'))
+
+
+@pytest.fixture
+def pulses():
+    return np.random.RandomState(0).normal(size=(7, 53))
+
+
+@pytest.mark.parametrize('chunk_size', [64, 1000, workers.RAW_CHUNK_SIZE])
+def test_round_trip(pulses, chunk_size, monkeypatch):
+    monkeypatch.setattr(workers, 'RAW_CHUNK_SIZE', chunk_size)
+    pulse_set = workers.read_raw(raw_file(pulses))
+
+    assert np.array_equal(pulse_set.pulses, pulses.astype(pulse_set.pulses.dtype))
+    assert np.allclose(pulse_set.times, np.linspace(0, 0.5, pulses.shape[1]))
+    assert pulse_set.amu == 28.0
+    assert pulse_set.gain == 7
+    assert pulse_set.pulse_spacing == 0.25
+    assert pulse_set.index == 3
+
+
+def test_test_data():
+    for fname in sorted(os.listdir(testdir)):
+        with open(os.path.join(testdir, fname), 'rb') as f:
+            d = np.loadtxt(f, skiprows=1)
+            f.seek(0)
+            pulse_set = workers.read_raw(f)
+
+        n_pulses, n_datapts = int(d[7]), int(d[3])
+        expected = d[18:18 + n_pulses*n_datapts].reshape(n_pulses, n_datapts)
+        assert np.array_equal(pulse_set.pulses, expected.astype(pulse_set.pulses.dtype))
+
+
+def test_truncated_body(pulses):
+    fil = raw_file(pulses)
+    truncated = io.BytesIO(fil.getvalue()[:-200])
+
+    with pytest.raises(ValueError):
+        workers.read_raw(truncated)
+
+
+def test_truncated_header():
+    with pytest.raises(ValueError):
+        workers.read_raw(io.BytesIO(b'TAP-1 test file\r\n1\r\n2\r\n'))
+
+
+def test_malformed_value(pulses):
+    data = raw_file(pulses).getvalue().split(b'\r\n')
+    data[40] = b'oops'
+
+    with pytest.raises(ValueError):
+        workers.read_raw(io.BytesIO(b'\r\n'.join(data)))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# Saved sessions: raw data and the corrections of tab 2 written by
+# workers.save_session come back when the file is uploaded again
+
+import base64
+import os
+
+import numpy as np
+import pytest
+
+import workers
+from conftest import testdir
+
+SESSION = 'test-session'
+PARAMS = ['27.7', 'baseline corr smooth pulses', [0.1, 0.3], True, True, 11, 3]
+
+
+@pytest.fixture
+def saved_session(tmpdir):
+    with open(os.path.join(testdir, sorted(os.listdir(testdir))[0]), 'rb') as f:
+        raw = workers.read_raw(f)
+    raw_handle = workers.datastore.put(SESSION, 'raw/27.7', raw)
+    corrected = workers.get_corrected(raw_handle, PARAMS)
+
+    raw_pulse_data = [{'props': {'data': {'27.7': raw_handle}}}]
+    current_data = {'27.7': {'handle': workers.datastore.put(SESSION, 'full/27.7', corrected),
+                             'raw handle': raw_handle,
+                             'params': PARAMS}}
+    path = str(tmpdir.join('session.tap'))
+    workers.save_session(raw_pulse_data, current_data, path)
+
+    return path, raw, corrected
+
+
+def check_restored(list_of_data, raw, corrected):
+    workers.correction_cache.clear()
+    raw_store, restored = workers.update_database(list_of_data, None, SESSION)
+
+    raw_handle = raw_store.data['27.7']
+    assert np.array_equal(workers.get_dataset(raw_handle).pulses, raw.pulses)
+    assert workers.get_dataset(raw_handle).correction is None
+
+    entry = restored['27.7']
+    assert entry['params'] == PARAMS
+    assert entry['raw handle'] == raw_handle
+    assert np.array_equal(workers.get_dataset(entry['handle']).pulses, corrected.pulses)
+
+    # The restored correction is served without computing it again
+    assert workers.correction_key(raw_handle, PARAMS) in workers.correction_cache
+    assert np.array_equal(workers.get_corrected(raw_handle, PARAMS).pulses, corrected.pulses)
+
+
+def test_upload_round_trip(saved_session):
+    path, raw, corrected = saved_session
+    with open(path, 'rb') as f:
+        contents = 'data:application/octet-stream;base64,' + base64.b64encode(f.read())
+
+    list_of_data, errors = workers.load_all_data([contents], ['session.tap'])
+    assert errors == []
+    check_restored(list_of_data, raw, corrected)
+
+
+def test_streamed_round_trip(saved_session):
+    path, raw, corrected = saved_session
+    key = workers.load_file_key(path, 'session.tap')
+
+    check_restored([workers.load_cached(key)], raw, corrected)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+# Smoothing all pulses in one filtering pass gives the same pulses as the
+# per-pulse Savitzky-Golay filter, and filter coefficients are cached
+
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+import benchmarks
+import workers
+
+
+@pytest.fixture
+def pulses():
+    times = np.linspace(0, 1.0, 150)
+    random = np.random.RandomState(0)
+    return np.exp(-np.multiply.outer(random.uniform(2, 8, size=9), times)) + 0.05*random.normal(size=(9, 150))
+
+
+@pytest.mark.parametrize('window_size, order, deriv', [(5, 2, 0), (11, 3, 0), (31, 5, 0),
+                                                       (11, 3, 1), (21, 4, 2)])
+def test_equals_per_pulse(pulses, window_size, order, deriv):
+    expected = np.array([benchmarks.savitzky_golay_pinv(pulse, window_size, order, deriv)
+                         for pulse in pulses])
+    smoothed = workers.savitzky_golay_pulses(pulses, window_size, order, deriv)
+
+    assert smoothed.shape == pulses.shape
+    assert np.allclose(smoothed, expected)
+    assert np.allclose(workers.savitzky_golay(pulses[3], window_size, order, deriv), expected[3])
+
+
+def test_bad_window():
+    with pytest.raises(TypeError):
+        workers.savgol_coeffs(10, 2)
+    with pytest.raises(TypeError):
+        workers.savgol_coeffs(3, 2)
+
+
+def test_coeffs_lru(monkeypatch):
+    monkeypatch.setattr(workers, 'SG_CACHE_SIZE', 3)
+    monkeypatch.setattr(workers, '_sg_coeffs', OrderedDict())
+
+    first = workers.savgol_coeffs(5, 2)
+    assert workers.savgol_coeffs(5, 2) is first
+    assert workers.savgol_coeffs(5, 2, deriv=1) is not first
+
+    workers.savgol_coeffs(7, 2)
+    workers.savgol_coeffs(5, 2)
+    workers.savgol_coeffs(9, 2)
+    assert list(workers._sg_coeffs.keys()) == [(7, 2, 0, 1), (5, 2, 0, 1), (9, 2, 0, 1)]
+    assert workers.savgol_coeffs(5, 2) is first
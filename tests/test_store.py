@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import store
+import workers
+from conftest import testdir
+
+
+def test_versions_differ_across_processes(tmpdir):
+    # Two stores on the same directory stand for two server processes
+    path = str(tmpdir.join('store'))
+    first = store.DatasetStore(store.DiskBackend(path), 2**30, 3600)
+    second = store.DatasetStore(store.DiskBackend(path), 2**30, 3600)
+
+    old = first.put('s', 'corrected/27.7', np.zeros(3))
+    new = second.put('s', 'corrected/27.7', np.ones(3))
+
+    assert old['id'] == new['id']
+    assert old['version'] != new['version']
+    assert new in first
+    assert np.array_equal(first.get(new), np.ones(3))
+
+
+def test_versions_differ_after_fork(tmpdir):
+    datastore = store.DatasetStore(store.DiskBackend(str(tmpdir)), 2**30, 3600)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        os.write(write_fd, datastore.put('s', 'x', np.zeros(3))['version'].encode('ascii'))
+        os._exit(0)
+
+    os.close(write_fd)
+    os.waitpid(pid, 0)
+    child_version = os.read(read_fd, 64).decode('ascii')
+    os.close(read_fd)
+
+    assert datastore.put('s', 'x', np.ones(3))['version'] != child_version
+
+
+@pytest.mark.parametrize('disk', [False, True])
+def test_superseded_handle_rejected(tmpdir, disk):
+    backend = store.DiskBackend(str(tmpdir)) if disk else store.MemoryBackend()
+    datastore = store.DatasetStore(backend, 2**30, 3600)
+
+    old = datastore.put('s', 'corrected/27.7', np.zeros(3))
+    new = datastore.put('s', 'corrected/27.7', np.ones(3))
+
+    assert old not in datastore
+    assert new in datastore
+    with pytest.raises(KeyError):
+        datastore.get(old)
+    assert np.array_equal(datastore.get(new), np.ones(3))
+    assert np.array_equal(datastore.get({'id': new['id']}), np.ones(3))
+
+
+# A render for params A that arrives after params B were stored must not cache
+# the average pulse of B under the correction of A
+def test_stale_render_not_cached():
+    with open(os.path.join(testdir, sorted(os.listdir(testdir))[0]), 'rb') as f:
+        raw = workers.read_raw(f)
+    raw_handle = workers.datastore.put('stale', 'raw/27.7', raw)
+    params_a = ['27.7', 'baseline corr smooth pulses', [0.1, 0.3], True, False, 11, 3]
+    params_b = ['27.7', 'baseline corr smooth pulses', [0.5, 0.9], True, True, 31, 3]
+
+    handle_a = workers.datastore.put('stale', 'corrected/27.7', workers.get_corrected(raw_handle, params_a))
+    workers.datastore.put('stale', 'corrected/27.7', workers.get_corrected(raw_handle, params_b))
+
+    temp_a = {'handle': handle_a, 'raw handle': raw_handle, 'params': params_a, 'preview': False}
+    with pytest.raises(KeyError):
+        workers.avg_plot_data(temp_a)
+
+    temp_a['handle'] = workers.datastore.put('stale', 'corrected/27.7',
+                                             workers.get_corrected(raw_handle, params_a))
+    times, avg_pulse = workers.avg_plot_data(temp_a)
+    assert np.allclose(avg_pulse, workers.get_corrected(raw_handle, params_a).avg_pulse())
+    assert not np.allclose(avg_pulse, workers.get_corrected(raw_handle, params_b).avg_pulse())
+
+
+# Threads asking for a correction while it is being computed wait for it, so it
+# is computed once
+def test_computed_once():
+    cache = store.ResultCache(2**20)
+    calls = []
+    started, release = threading.Event(), threading.Event()
+
+    def compute():
+        calls.append(None)
+        started.set()
+        release.wait(5.0)
+        return np.arange(3)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute('k', compute)))
+               for i in range(8)]
+    threads[0].start()
+    started.wait(5.0)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5.0)
+
+    assert len(calls) == 1
+    assert len(results) == 8
+    assert all(result is results[0] for result in results)
+    assert cache.stats()['misses'] == 1
+
+
+def test_failed_computation_not_cached():
+    cache = store.ResultCache(2**20)
+
+    with pytest.raises(ZeroDivisionError):
+        cache.get_or_compute('k', lambda: 1 // 0)
+    assert 'k' not in cache
+    assert cache.get_or_compute('k', lambda: 2) == 2
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Chunked uploads: chunks are parsed by a background job once complete, and
+# failed or stalled uploads end in the 'error' state
+
+import io
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+import pytest
+
+import uploads
+import workers
+from conftest import testdir
+
+
+@pytest.fixture
+def session():
+    session = uuid.uuid4().hex
+    yield session
+    shutil.rmtree(uploads.session_dir(session))
+
+
+def wait_finished(session, upload_id, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = uploads.read_status(session, upload_id)
+        if status['state'] in ('ready', 'error'):
+            return status
+        time.sleep(0.05)
+
+    raise AssertionError('upload {0} was not parsed'.format(upload_id))
+
+
+def test_chunks_parsed_by_job(session):
+    path = os.path.join(testdir, sorted(os.listdir(testdir))[0])
+    with open(path, 'rb') as f:
+        contents = f.read()
+
+    size = len(contents)//3
+    for offset in range(0, len(contents), size):
+        status = uploads.write_chunk(session, 'upload-1', os.path.basename(path), offset,
+                                     len(contents), io.BytesIO(contents[offset:offset + size]))
+    assert status['state'] == 'parsing'
+
+    status = wait_finished(session, 'upload-1')
+    assert status['state'] == 'ready'
+    assert not os.path.exists(os.path.join(uploads.session_dir(session), 'upload-1.part'))
+
+    with open(path, 'rb') as f:
+        raw = workers.read_raw(f)
+    pulse_data = workers.load_cached(status['handle'])
+    assert np.array_equal(pulse_data.pulses, raw.pulses)
+
+
+def test_parse_error(session):
+    uploads.write_chunk(session, 'upload-1', 'bad.01p', 0, 4, io.BytesIO(b'oops'))
+
+    status = wait_finished(session, 'upload-1')
+    assert status['state'] == 'error'
+    assert status['error']
+
+
+@pytest.mark.parametrize('offset, total', [(0, 0), (-1, 100), (100, 100), (0, -5)])
+def test_invalid_chunk(session, offset, total):
+    with pytest.raises(ValueError):
+        uploads.write_chunk(session, 'upload-1', 'a.01p', offset, total, io.BytesIO(b'x'*10))
+
+    assert uploads.read_status(session, 'upload-1') is None
+    assert os.listdir(uploads.session_dir(session)) == []
+
+
+def test_reported_failure(session):
+    uploads.write_chunk(session, 'upload-1', 'a.01p', 0, 100, io.BytesIO(b'x'*10))
+    uploads.fail_upload(session, 'upload-1', 'a.01p', 'upload failed with HTTP status 500')
+
+    status, = uploads.consume_finished(session)
+    assert status['state'] == 'error'
+    assert status['error'] == 'upload failed with HTTP status 500'
+    assert os.listdir(uploads.session_dir(session)) == []
+
+
+def test_stalled_upload(session, monkeypatch):
+    uploads.write_chunk(session, 'upload-1', 'a.01p', 0, 100, io.BytesIO(b'x'*10))
+    assert uploads.list_uploads(session)[0]['state'] == 'uploading'
+
+    monkeypatch.setattr(uploads, 'UPLOAD_TIMEOUT', -1)
+    status, = uploads.list_uploads(session)
+    assert status['state'] == 'error'
+    assert not os.path.exists(os.path.join(uploads.session_dir(session), 'upload-1.part'))
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+# Round trips of streamed workbooks through openpyxl, the reader of tap2.py
+
+import io
+import warnings
+
+import numpy as np
+import openpyxl
+import pytest
+
+import xlsxstream
+
+
+def workbook_bytes(sheets):
+    return b''.join(xlsxstream.write_workbook(sheets))
+
+
+def sheet_values(data, name, read_only):
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        workbook = openpyxl.load_workbook(io.BytesIO(data), read_only=read_only)
+    return [tuple(cell.value for cell in row) for row in workbook[name].iter_rows()]
+
+
+def test_column_letters():
+    assert [xlsxstream._column(i) for i in [0, 25, 26, 27, 701, 702]] == ['A', 'Z', 'AA', 'AB', 'ZZ', 'AAA']
+
+
+@pytest.mark.parametrize('read_only', [True, False])
+def test_round_trip(read_only):
+    rows = np.random.RandomState(0).normal(size=(600, 30))
+    blocks = [rows[:256], rows[256:512], rows[512:]]
+    header = ['Time', 'Avg'] + [str(i) for i in range(1, 29)]
+    data = workbook_bytes([('27.7', header, blocks), ('28.0-2', ['a'], [np.ones((1, 1))])])
+
+    values = sheet_values(data, '27.7', read_only)
+    assert values[0] == tuple(header)
+    assert len(values) == 601
+    assert np.array_equal(np.array(values[1:], dtype=np.float64), rows)
+    assert sheet_values(data, '28.0-2', read_only) == [(u'a',), (1.0,)]
+
+
+@pytest.mark.parametrize('read_only', [True, False])
+def test_missing_values_and_float32(read_only):
+    rows = np.array([[1.5, np.nan, 3.0], [1.0 / 3, 2.0, 4.0]], dtype=np.float32)
+    data = workbook_bytes([('s', ['a', 'b', 'c'], [rows])])
+
+    values = sheet_values(data, 's', read_only)
+    assert values[1] == (1.5, None, 3.0)
+    assert np.float32(values[2][0]) == rows[1, 0]
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# Server side of the chunked upload route.
+#
+# The browser posts each selected file in chunks (see assets/stream_upload.js).
+# Chunks are written straight to a partial file under TAPSuite-data/uploads/<session>,
+# without base64 encoding or buffering the whole file in memory. Once the last
+# chunk arrives the file is parsed from disk into the datacache by a background
+# job, and the cache key becomes the dataset handle passed on to the Dash layer.
+# Progress is recorded in one small JSON status file per upload, which the app
+# polls to show progress in the UI while uploads are pending. Uploads that the
+# browser reports as failed, or that receive no chunk for UPLOAD_TIMEOUT seconds,
+# end in the 'error' state.
+
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from werkzeug.utils import secure_filename
+
+import jobs
+import workers
+
+uploaddir = os.path.join(workers.savedir, 'uploads')
+
+_id_pattern = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+COPY_BLOCK_SIZE = 1 << 20
+
+# Seconds after which an upload that receives no more chunks is given up
+UPLOAD_TIMEOUT = float(os.environ.get('TAPPY_UPLOAD_TIMEOUT', 120))
+
+
+# Function that checks a client-supplied session or upload id before it is
+# used as part of a path
+def check_id(value):
+    if not value or not _id_pattern.match(value):
+        raise ValueError('Invalid upload id: {0!r}'.format(value))
+
+    return value
+
+
+# Function that returns the upload directory of a session, creating it if needed
+def session_dir(session):
+    path = os.path.join(uploaddir, check_id(session))
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+    return path
+
+
+# Function that atomically writes the status file of an upload
+def write_status(session, upload_id, status):
+    path = session_dir(session)
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=path)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(status, f)
+    os.rename(tmp, os.path.join(path, '{0}.json'.format(upload_id)))
+
+
+# Function that reads the status file of an upload, or None if it does not exist
+def read_status(session, upload_id):
+    path = os.path.join(session_dir(session), '{0}.json'.format(check_id(upload_id)))
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+# Function that writes one chunk of an upload at `offset` and, when the last
+# chunk has arrived, submits the parse of the file to the job queue. Returns the
+# status of the upload: filename, bytes received and total, state ('uploading',
+# 'parsing', 'ready' or 'error'), the dataset handle once ready and the error
+# message on failure. Raises ValueError for an empty upload or a chunk that
+# does not start inside the file.
+def write_chunk(session, upload_id, filename, offset, total, stream):
+    check_id(upload_id)
+    if total <= 0:
+        raise ValueError('Invalid upload size: {0}'.format(total))
+    if not 0 <= offset < total:
+        raise ValueError('Invalid chunk offset {0} for an upload of {1} bytes'.format(offset, total))
+    filename = secure_filename(filename) or 'upload'
+    path = os.path.join(session_dir(session), '{0}.part'.format(upload_id))
+
+    mode = 'r+b' if os.path.exists(path) else 'wb'
+    with open(path, mode) as f:
+        f.seek(offset)
+        shutil.copyfileobj(stream, f, COPY_BLOCK_SIZE)
+        received = f.tell()
+
+    status = {'filename': filename,
+              'received': received,
+              'total': total,
+              'state': 'uploading',
+              'handle': None,
+              'error': None}
+
+    if received >= total:
+        status['state'] = 'parsing'
+        write_status(session, upload_id, status)
+        jobs.job_queue.submit('parse-upload', parse_upload, session, upload_id, path, dict(status))
+    else:
+        write_status(session, upload_id, status)
+
+    return status
+
+
+# Function run as a job that parses a complete upload from disk into the
+# datacache and records the dataset handle, or the error, in its status
+def parse_upload(job, session, upload_id, path, status):
+    try:
+        status['handle'] = workers.load_file_key(path, status['filename'])
+        status['state'] = 'ready'
+    except Exception as e:
+        status['state'] = 'error'
+        status['error'] = str(e)
+    finally:
+        os.remove(path)
+
+    write_status(session, upload_id, status)
+
+
+# Function that ends an upload in the 'error' state with `message`, as reported by
+# the browser when a chunk could not be sent, and removes its partial file
+def fail_upload(session, upload_id, filename, message):
+    check_id(upload_id)
+    status = read_status(session, upload_id) or {'filename': secure_filename(filename) or 'upload',
+                                                 'received': 0,
+                                                 'total': 0,
+                                                 'handle': None}
+    if status.get('state') in ('parsing', 'ready'):
+        return status
+
+    status['state'] = 'error'
+    status['error'] = message
+    try:
+        os.remove(os.path.join(session_dir(session), '{0}.part'.format(upload_id)))
+    except OSError:
+        pass
+    write_status(session, upload_id, status)
+
+    return status
+
+
+# Function that returns the seconds since a file was last written, 0 if it is gone
+def _idle_time(path):
+    try:
+        return time.time() - os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+
+# Function that returns the status of every upload in a session that has not been
+# handed to the Dash layer yet, ordered by filename. Uploads that stalled are
+# failed on the way.
+def list_uploads(session):
+    path = session_dir(session)
+    uploads = []
+    for fname in os.listdir(path):
+        if fname.endswith('.json') and not fname.startswith('.'):
+            upload_id = fname[:-len('.json')]
+            status = read_status(session, upload_id)
+            if status is None:
+                continue
+            if status['state'] == 'uploading' and _idle_time(os.path.join(path, fname)) > UPLOAD_TIMEOUT:
+                status = fail_upload(session, upload_id, status['filename'],
+                                     'no data received for {0:0.0f} s'.format(UPLOAD_TIMEOUT))
+            status['upload_id'] = upload_id
+            uploads.append(status)
+
+    return sorted(uploads, key=lambda s: s['filename'])
+
+
+# Function that marks finished uploads as consumed, so that each dataset handle is
+# handed to the Dash layer exactly once. Returns the uploads that were consumed.
+def consume_finished(session):
+    finished = [s for s in list_uploads(session) if s['state'] in ('ready', 'error')]
+    for status in finished:
+        os.remove(os.path.join(session_dir(session), '{0}.json'.format(status['upload_id'])))
+
+    return finished
+
+
+# Function that loads the datasets of consumed uploads from the datacache.
+# Returns the datasets in filename order and the error messages of failed uploads.
+def load_finished(finished):
+    list_of_data = []
+    errors = []
+    for status in sorted(finished, key=lambda s: s['filename']):
+        if status['state'] == 'error':
+            errors.append('{0}: {1}'.format(status['filename'], status['error']))
+            continue
+
+        pulse_data = workers.load_cached(status['handle'])
+        if pulse_data is None:
+            errors.append('{0}: evicted from the cache before loading'.format(status['filename']))
+        else:
+            list_of_data.append(pulse_data)
+
+    return list_of_data, errors
@@ -6,143 +6,411 @@ import io
 import StringIO
 import base64
 import numpy as np
-import pandas as pd
-from flask import send_file
+from flask import Response, send_file
 import os
-from pandas import ExcelWriter
 from scipy.integrate import trapz
 import cPickle as pickle
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 from math import factorial
+from scipy.ndimage import correlate1d
+
+import artifacts
+import container
+import datacache
+import decimation
+import exports
+import figures
+import pulseset
+import tap2
+from pulseset import PulseSet
+from pyramid import Pyramid
+from store import correction_cache, datastore, normalization_cache, plot_cache, stage_cache
 
 home = os.path.expanduser('~')
 savedir = os.path.join(home, 'TAPSuite-data')
 
+# Number of processes used to parse uploaded files, defaults to one per core
+ingest_workers = int(os.environ.get('TAPPY_INGEST_WORKERS', 0)) or multiprocessing.cpu_count()
+
+# Pools of processes parsing uploaded files and correcting datasets, see start_pools
+_ingest_pool = None
+_correct_pool = None
+
+# Number of processes used to correct all AMUs at once. The pool is opt-in:
+# corrections run in the server process unless this is set above 1, since the
+# pool has only been measured on a single core, where it costs more than it
+# saves; 0 means one per core.
+correct_workers = int(os.environ.get('TAPPY_CORRECT_WORKERS', 1)) or multiprocessing.cpu_count()
+
+# Directory of the arrays shared with the correction processes, in memory where
+# the system has a tmpfs
+shmdir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# Number of numeric header values that precede the pulse data in a TAP-1 raw file,
+# and the block size used when streaming the numeric body into memory
+RAW_HEADER_LEN = 18
+RAW_CHUNK_SIZE = 1 << 22
+
+# Number of Savitzky-Golay filters kept in the coefficient cache
+SG_CACHE_SIZE = 32
+
+# Size of the previews corrected while the sliders of tab 2 move: the number of
+# pulses, and the number of data points per pulse the time axis is decimated to.
+# The full-resolution correction starts once the sliders have been still for
+# PREVIEW_DELAY seconds.
+PREVIEW_PULSES = int(os.environ.get('TAPPY_PREVIEW_PULSES', 25))
+PREVIEW_POINTS = int(os.environ.get('TAPPY_PREVIEW_POINTS', 500))
+PREVIEW_DELAY = float(os.environ.get('TAPPY_PREVIEW_DELAY', 0.5))
+
+
+# Function that reads the title line and the numeric header of a TAP-1 raw file.
+# Returns the header values and the number of lines consumed, leaving the file
+# positioned at the first pulse data point.
+def read_raw_header(fil):
+    fil.readline()
+    n_lines = 1
+
+    header = []
+    while len(header) < RAW_HEADER_LEN:
+        line = fil.readline()
+        n_lines += 1
+        if not line:
+            raise ValueError('Truncated TAP-1 header: found {0} of {1} values'.format(
+                len(header), RAW_HEADER_LEN))
+        try:
+            header.extend(float(v) for v in line.split())
+        except ValueError:
+            raise ValueError('Malformed TAP-1 header on line {0}: {1!r}'.format(
+                n_lines, line.strip()))
+
+    return header[:RAW_HEADER_LEN], n_lines
+
+
+# Function that bulk-converts the numeric body of a TAP-1 raw file into a
+# preallocated (n_pulses, n_datapts) array. The body is read in blocks that end
+# on a line break so that memory use does not depend on the file size.
+def read_raw_body(fil, n_pulses, n_datapts, first_line=1):
+    n_values = n_pulses * n_datapts
+
+    # Every value takes at least one character and one line break, so files that
+    # are too short can be rejected before any of the body is read.
+    if hasattr(fil, 'seek') and hasattr(fil, 'tell'):
+        start = fil.tell()
+        fil.seek(0, os.SEEK_END)
+        n_bytes = fil.tell() - start
+        fil.seek(start)
+        if n_bytes < 2*n_values - 1:
+            raise ValueError('Truncated TAP-1 file: header declares {0} pulses x {1} points '
+                             'but only {2} bytes of pulse data follow'.format(
+                                 n_pulses, n_datapts, n_bytes))
+
+    pulses = np.empty((n_pulses, n_datapts), dtype=pulseset.dtype)
+    flat = pulses.reshape(-1)
+
+    pos = 0
+    tail = b''
+    while pos < n_values:
+        block = fil.read(RAW_CHUNK_SIZE)
+        eof = not block
+        block = tail + block
+        if eof:
+            tail = b''
+        else:
+            cut = block.rfind(b'\n') + 1
+            block, tail = block[:cut], block[cut:]
+
+        if block.strip():
+            n_lines = block.count(b'\n') + (1 if eof and not block.endswith(b'\n') else 0)
+            remaining = n_values - pos
+            values = np.fromstring(block, dtype=flat.dtype, sep=' ')[:remaining]
+            n = values.size
+            flat[pos:pos+n] = values
+            pos += n
+
+            if n < min(n_lines, remaining):
+                raise ValueError('Malformed value in TAP-1 file near line {0}'.format(
+                    first_line + pos + 1))
+
+        if eof:
+            break
+
+    if pos < n_values:
+        raise ValueError('Truncated TAP-1 file: expected {0} pulse data points, found {1}'.format(
+            n_values, pos))
+
+    return pulses
+
+
 # Function to process raw TAP-1 files generated from experiments
 def read_raw(fil):
-    data = {}
-    d = np.loadtxt(fil, skiprows=1)
+    d, n_lines = read_raw_header(fil)
 
     n_datapts = int(d[3])
     n_pulses = int(d[7])
     ct = d[5]
 
-    data['amu'] = float(d[13])*30
-    data['gain'] = int(d[6])
-    data['n_datapoints'] = n_datapts
-    data['n_pulses'] = n_pulses
-    data['collection time'] = ct
-    data['pulse spacing'] = d[15]
-    data['index'] = int(d[16])
+    if n_datapts < 1 or n_pulses < 1:
+        raise ValueError('Malformed TAP-1 header: {0} pulses x {1} points'.format(
+            n_pulses, n_datapts))
 
-    pulse_data = d[18:]
-    data['pulses'] = np.array([pulse_data[i*n_datapts:(i+1)*n_datapts:1] for i in range(n_pulses)])
-    data['times'] = np.linspace(0, ct, n_datapts)
+    pulses = read_raw_body(fil, n_pulses, n_datapts, first_line=n_lines)
 
-    avg = np.mean(data['pulses'], axis=0)
-    data['avg pulse'] = avg
+    # Pulses are sampled on np.linspace(0, ct, n_datapts)
+    dt = ct/(n_datapts - 1) if n_datapts > 1 else 0.0
 
-    return data
+    return PulseSet(pulses, 0.0, dt,
+                    amu=float(d[13])*30,
+                    gain=int(d[6]),
+                    collection_time=ct,
+                    pulse_spacing=d[15],
+                    index=int(d[16]))
     
     
 # Function that processes processes TAP-1 files based on file type
 def read_tap1(fil, file_type):
     if file_type == 'pkl':
         data = pickle.load(fil)
-        return data
+        return as_pulse_sets(data)
 
     else:
         data = read_raw(fil)
         return data
 
 
-# Function that processes .xlsx files generated from TAP-2/3 experiments
-def read_tap2(fil, file_type):
-    x1 = pd.ExcelFile(fil)
-    data = [x1.parse(sheet_name, skiprows=0, index_col=None) for sheet_name in x1.sheet_names[3:]]
+# Function that converts dataset dicts, as pickled or stored in .tap containers,
+# into a PulseSet or a dict of PulseSets keyed by AMU
+def as_pulse_sets(data):
+    if isinstance(data, PulseSet):
+        return data
+    if 'pulses' in data:
+        return PulseSet.from_dict(data)
+
+    return dict((name, as_pulse_sets(d)) for name, d in data.items())
 
-    combined = {}
-    for i, d in enumerate(data):
 
-        data = {}
-        pulses = np.transpose(d.as_matrix(columns=d.columns[3:]))
-        times = d[d.columns[2]].values.tolist()
-        values = d['Value'].dropna().tolist()
+# Function that processes .xlsx files generated from TAP-2/3 experiments.
+# Sheets are streamed by tap2.Tap2Workbook and parsed in parallel unless this is
+# already running inside a worker process, which cannot start a pool of its own.
+def read_tap2(fil, file_type):
+    workbook = tap2.Tap2Workbook(fil)
 
-        n_datapts, n_pulses = pulses.shape
-        ct = float(values[2])
+    return workbook.read_all(None if multiprocessing.current_process().daemon else _ingest_pool)
 
-        data['amu'] = float(values[0])
-        data['gain'] = int(values[1])
-        data['n_datapoints'] = n_datapts
-        data['n_pulses'] = n_pulses
-        data['collection time'] = float(values[3])
-        data['pulse spacing'] = ct
-        data['index'] = i
 
-        data['pulses'] = pulses
-        data['times'] = times
+# Function that makes sure an uploaded file is parsed into the datacache and
+# returns its cache key. Files that are not cached (.pkl, and .tap containers,
+# which need no parsing) are returned parsed, with a key of None.
+def load_data_key(contents, filename):
+    content_type, content_string = contents.split(',')
+    decoded = base64.b64decode(content_string)
 
-        avg = np.mean(data['pulses'], axis=0)
-        data['avg pulse'] = avg
+    extn = filename.split('.')[-1]
 
-        amu_s = '{0:0.1f}'.format(float(values[0]))
-        combined[amu_s] = data
+    if extn in ('pkl', 'tap'):
+        return None, parse_data(decoded, extn)
 
-    return combined
+    key = datacache.content_key(decoded, extn)
+    if not os.path.exists(datacache.entry_path(key)):
+        datacache.store(key, parse_data(decoded, extn))
 
+    return key, None
 
-# Function that obtains the filepath from the STATE of the callback and reads
-# the pulse files using the TAPSuite.read_raw() function
-def load_data(contents, filename):
-    content_type, content_string = contents.split(',')
-    decoded = base64.b64decode(content_string)
 
+# Function that parses a file already on disk into the datacache and returns its
+# cache key. Used for streamed uploads, which never hold the whole file in memory.
+def load_file_key(path, filename):
     extn = filename.split('.')[-1]
 
+    key = datacache.file_key(path, extn)
+    if not os.path.exists(datacache.entry_path(key)):
+        with open(path, 'rb') as fil:
+            if extn == 'xlsx':
+                pulse_data = read_tap2(path, extn)
+            elif extn == 'pkl':
+                pulse_data = read_tap1(fil, 'pkl')
+            elif extn == 'tap':
+                pulse_data = as_pulse_sets(container.read_container(path))
+            else:
+                pulse_data = read_tap1(fil, 'raw')
+
+        datacache.store(key, pulse_data)
+
+    return key
+
+
+# Function run by the ingest pool. Parsed arrays stay in the datacache and only
+# the key travels back to the parent process; errors are returned as messages
+# so that one bad file does not fail the others.
+def _ingest_file(args):
+    contents, filename = args
+    try:
+        key, pulse_data = load_data_key(contents, filename)
+        return key, pulse_data, None
+    except Exception as e:
+        return None, None, '{0}: {1}'.format(filename, e)
+
+
+# Function that parses a batch of uploaded files across `pool`, the ingest pool
+# by default, or in this process without one. Results are returned in filename
+# order, so that append_data assigns AMU keys the same way regardless of which
+# file finished first, together with a list of error messages for the files that
+# could not be read.
+def load_all_data(list_of_contents, list_of_names, pool=None):
+    order = sorted(range(len(list_of_names)), key=lambda i: (list_of_names[i], list_of_contents[i]))
+    files = [(list_of_contents[i], list_of_names[i]) for i in order]
+
+    if pool is None:
+        pool = _ingest_pool
+
+    if pool is not None and len(files) > 1:
+        results = pool.map(_ingest_file, files, chunksize=1)
+    else:
+        results = [_ingest_file(f) for f in files]
+
+    list_of_data = []
+    errors = []
+    for key, pulse_data, error in results:
+        if error is not None:
+            errors.append(error)
+            continue
+
+        if pulse_data is None:
+            pulse_data = load_cached(key)
+            if pulse_data is None:
+                # Evicted between parsing and loading
+                errors.append('{0}: evicted from the cache before loading'.format(key))
+                continue
+
+        list_of_data.append(pulse_data)
+
+    return list_of_data, errors
+
+
+# Function that starts the process pools used by the app, once. app.py calls it
+# at startup, before the server and the job queue start any thread: Python 2 can
+# only fork the pool processes, and a process forked while another thread holds a
+# lock deadlocks when it takes that lock. Without the pools everything runs in
+# the server process.
+def start_pools():
+    global _ingest_pool, _correct_pool
+    if _ingest_pool is None and ingest_workers > 1:
+        _ingest_pool = multiprocessing.Pool(ingest_workers)
+    if _correct_pool is None and correct_workers > 1:
+        _correct_pool = multiprocessing.Pool(correct_workers)
+
+
+# Function that loads a parsed file from the datacache, recording in each dataset
+# the entry it came from so that the dataset store can reload it after eviction
+def load_cached(key):
+    pulse_data = datacache.load(key)
+    if pulse_data is None:
+        return None
+
+    if isinstance(pulse_data, PulseSet):
+        pulse_data.source = [key, None]
+    else:
+        for name, pulse_set in pulse_data.items():
+            pulse_set.source = [key, name]
+
+    return pulse_data
+
+
+# Function that parses the decoded contents of an uploaded file based on its extension
+def parse_data(decoded, extn):
     if extn == 'xlsx':
-        pulse_data = read_tap2(io.BytesIO(decoded))
+        pulse_data = read_tap2(io.BytesIO(decoded), extn)
 
     elif extn == 'pkl':
         pulse_data = read_tap1(StringIO.StringIO(decoded), 'pkl')
-        
+
+    elif extn == 'tap':
+        pulse_data = as_pulse_sets(container.read_container(io.BytesIO(decoded)))
+
     else:
         pulse_data = read_tap1(io.BytesIO(decoded), 'raw')
 
     return pulse_data
 
 
-# Create or update database of raw data selected through the Upload component in tab 1
-def update_database(list_of_data, current_data):
+# Create or update database of raw data selected through the Upload component in tab 1.
+# New datasets are put in the server-side dataset store and the dcc.Store component
+# only keeps their handles. Returns the component and the corrections restored
+# from saved sessions, keyed by AMU.
+def update_database(list_of_data, current_data, session):
     if current_data is not None:
         temp = dict(current_data[0]['props']['data'])
-        return append_data(temp, list_of_data)
-
     else:
         temp = {}
-        return append_data(temp, list_of_data)
+
+    raw_store = append_data(temp, list_of_data)
+    restored = {}
+    for amu, data in raw_store.data.items():
+        if not is_handle(data):
+            correction, data.correction = data.correction, None
+            raw_store.data[amu] = datastore.put(session, 'raw/{0}'.format(amu), data,
+                                                source=data.source)
+            if correction is not None:
+                restored[amu] = restore_correction(session, amu, raw_store.data[amu], data, correction)
+
+    return raw_store, restored
+
+
+# Function that restores the correction of a dataset loaded from a saved session:
+# the corrected dataset is stored and cached under its params, as if it had just
+# been computed. Returns its entry for the "data-tab2" dcc.Store component.
+def restore_correction(session, amu, raw_handle, pulse_set, correction):
+    params, pulses = correction
+    params = [amu] + list(params[1:])
+    corrected_dataset = pulse_set.with_pulses(pulses)
+    correction_cache.put(correction_key(raw_handle, params), corrected_dataset)
+
+    return {'handle': datastore.put(session, 'full/{0}'.format(amu), corrected_dataset),
+            'raw handle': raw_handle,
+            'params': params}
+
+
+# Function that tells dataset handles from datasets
+def is_handle(data):
+    return isinstance(data, dict) and 'id' in data and 'version' in data
+
+
+# Function that returns the dataset of a handle from the server-side dataset store
+def get_dataset(handle):
+    return datastore.get(handle)
 
     
 # Creates a new or appends to an existing dcc.Store component with raw data from the Upload component
 def append_data(temp, list_of_data):
     if len(list_of_data) is not None:
         if len(list_of_data) > 1:
-            for data in list_of_data:
-                temp_data_amus = temp.keys()
-                amu = '{0:0.1f}'.format(data['amu'])
-                n = temp_data_amus.count(amu)
-                if n > 0:
-                    amu = amu + '-{0}'.format(n+1)
-                temp[amu] = data
+            for data_dict in list_of_data:
+                # Workbooks and containers hold several datasets keyed by AMU
+                if isinstance(data_dict, PulseSet):
+                    datasets = [data_dict]
+                else:
+                    datasets = [data_dict[k] for k in sorted(data_dict.keys())]
+
+                for data in datasets:
+                    temp_data_amus = temp.keys()
+                    amu = '{0:0.1f}'.format(data.amu)
+                    n = temp_data_amus.count(amu)
+                    if n > 0:
+                        amu = amu + '-{0}'.format(n+1)
+                    temp[amu] = data
         
             return dcc.Store(id='raw-data', data=temp)
 
         elif len(list_of_data) == 1:
             temp_data_amus = temp.keys()
             data_dict = list_of_data[0]
-            new_data_keys = data_dict.keys()
 
-            if 'amu' not in new_data_keys:
-                for k in new_data_keys:
+            if not isinstance(data_dict, PulseSet):
+                for k in data_dict.keys():
                     n = temp_data_amus.count(k)
                     if n > 0:
                         amu = k + '-{0}'.format(n + 1)
@@ -150,84 +418,57 @@ def append_data(temp, list_of_data):
                     temp[amu] = data_dict[k]
 
             else:
-                amu = '{0:0.1f}'.format(data_dict['amu'])
+                amu = '{0:0.1f}'.format(data_dict.amu)
                 temp[amu] = data_dict
 
             return dcc.Store(id='raw-data', data=temp)
 
-    else:
-        return dcc.Store(id='raw_data', data=temp)
-    
-
-# Function that stores 25 random pulses in order in the "condensed-data-tab1" dcc.Storage component.
-def store_condensed(raw_pulse_data, current_cond_data):
-    if current_cond_data is not None:
-            raw_data = dict(raw_pulse_data[0]['props']['data'])
-            for amu in raw_data.keys():
-                temp = raw_data[amu].copy()
-                pulses = temp['pulses']
-                inds = np.sort(np.random.randint(0, len(pulses), 25))
-                pulses_i = np.array([pulses[i] for i in inds])
-                temp['pulses'] = pulses_i.tolist()
-
-                current_cond_data[amu] = temp
+        else:
+            return dcc.Store(id='raw-data', data=temp)
 
-            return current_cond_data
-        
     else:
-        cond_data = {}
-        raw_data = dict(raw_pulse_data[0]['props']['data'])
-        for amu in raw_data.keys():
-            temp = raw_data[amu].copy()
-            pulses = temp['pulses']
-            inds = np.sort(np.random.randint(0, len(pulses), 25))
-            pulses_i = np.array([pulses[i] for i in inds])
-            temp['pulses'] = pulses_i.tolist()
-            
-            cond_data[amu] = temp
-
-        return cond_data
-
+        return dcc.Store(id='raw_data', data=temp)
     
-# Appends to or creates a new dcc.Store data object that stores all pre-processed data from tab 2
-def store_data(temp, data):
-    if data is not None:
-        amu = '{0:0.1f}'.format(data[0][0])
-        temp[amu] = data.tolist()
-        return dcc.Store(id='pp-data', data=temp)
-
-    else:
-        return dcc.Store(id='pp-data', data=temp)
-
-
-# Function that stores data on the fly based on pre-processing performed by
-# the user. Updates the overall storage dict if it exists, else creates new dict
-def store_pp_pulses(current_data, data, pulse_type):
-    if data is not None:
-        t = data['times']
-        amu = data['amu']
-        tf = np.array(t).reshape(1, len(t))
-        pulses = np.array(data[pulse_type])
-
-        avg = np.mean(pulses, axis=0)
-        avg1 = avg.reshape(1, len(avg))
-        
-        c1 = np.array([float(amu)] * pulses.shape[1])
-        c1f = c1.reshape(1, len(c1))
-
-        d1 = np.append(c1f, tf, axis=0)
-        d2 = np.append(d1, avg1, axis=0)
-        final_data = np.append(d2, pulses, axis=0)
-
-        if current_data is not None:
-            temp = dict(current_data[0]['props']['data'])
-            return store_data(temp, final_data)
 
+# Number of pulses per AMU shown in the 3D figures of tab 1
+CONDENSED_PULSES = int(os.environ.get('TAPPY_CONDENSED_PULSES', 250))
+
+
+# Function that stores the condensed dataset of every AMU, every n-th pulse up to
+# CONDENSED_PULSES pulses, in the dataset store and returns its handle. The
+# pulses are copied out of the raw array, so the condensed dataset does not keep
+# the raw pulses alive in the store. The handle also carries the step
+# between the pulses, so figures can label them with their pulse numbers, and the
+# id and version of the raw dataset it was taken from.
+def put_condensed(session, amu, raw_handle):
+    pulse_set = get_dataset(raw_handle)
+    step = max(1, -(-pulse_set.n_pulses // CONDENSED_PULSES))
+    handle = datastore.put(session, 'condensed/{0}'.format(amu),
+                           pulse_set.subset(slice(None, None, step)))
+    handle['pulse step'] = step
+    handle['raw'] = [raw_handle['id'], raw_handle['version']]
+
+    return handle
+
+
+# Function that stores evenly spaced pulses in the "condensed-data-tab1" dcc.Storage component.
+# The condensed datasets are kept in the dataset store; the component holds their handles.
+# Condensed datasets of raw datasets that did not change since are kept with their
+# versions, so their figures are not made again.
+def store_condensed(raw_pulse_data, current_cond_data, session):
+    cond_data = {}
+    raw_data = dict(raw_pulse_data[0]['props']['data'])
+    for amu in raw_data.keys():
+        current = (current_cond_data or {}).get(amu)
+        if (current is not None and current.get('raw') == [raw_data[amu]['id'], raw_data[amu]['version']]
+                and current in datastore):
+            cond_data[amu] = current
         else:
-            temp = {}
-            return store_data(temp, final_data)
+            cond_data[amu] = put_condensed(session, amu, raw_data[amu])
 
+    return cond_data
 
+    
 # Function that appends temp data params with amus as keys
 def append_to_temp_data_full(temp_data, current_temp_data):
     if current_temp_data is None:
@@ -247,51 +488,115 @@ def append_to_temp_data_full(temp_data, current_temp_data):
         return temp
 
 
-# Correct the raw data from tab1 with the params stored in temp-data-full
-def correct_full_data(temp_data, raw_data, current_temp_data):
+# Function run by the correction pool: corrects the pulses in the shared array
+# `in_path` and writes them into the shared array `out_path`
+def _correct_worker(args):
+    in_path, out_path, t0, dt, params = args
+    amu, x, timespan, corr, smooth, window_size, order = params
+
+    pulse_set = PulseSet(np.load(in_path, mmap_mode='r'), t0, dt, amu=0)
+    out = np.load(out_path, mmap_mode='r+')
+
+    if corr is True:
+        correct_baseline(pulse_set.pulses, pulse_set.times, timespan, out=out)
+        pulse_set = pulse_set.with_pulses(out)
+    if smooth is True:
+        out[...] = savitzky_golay_pulses(pulse_set.pulses, window_size, order)
+    if corr is not True and smooth is not True:
+        out[...] = pulse_set.pulses
+
+    out.flush()
+
+    return in_path
+
+
+# Function that corrects several datasets, a list of (handle, params), across
+# `pool`, a multiprocessing pool, and puts the results in the correction cache.
+# Pulse arrays are passed to and from the processes as memory-mapped files in
+# shmdir rather than pickled, and the results stay mapped in the parent.
+# `progress`, when given, is called with the number of datasets finished so far.
+def correct_parallel(items, pool, progress=None):
+    tmp = tempfile.mkdtemp(prefix='tappy-correct-', dir=shmdir)
+    try:
+        tasks = []
+        for i, (handle, params) in enumerate(items):
+            pulse_set = get_dataset(handle)
+            in_path = os.path.join(tmp, '{0}-in.npy'.format(i))
+            out_path = os.path.join(tmp, '{0}-out.npy'.format(i))
+            np.save(in_path, pulse_set.pulses)
+            np.lib.format.open_memmap(out_path, mode='w+', dtype=pulse_set.pulses.dtype,
+                                      shape=pulse_set.pulses.shape).flush()
+            tasks.append((in_path, out_path, pulse_set.t0, pulse_set.dt, params))
+
+        paths = dict((task[0], i) for i, task in enumerate(tasks))
+        for n, in_path in enumerate(pool.imap_unordered(_correct_worker, tasks)):
+            i = paths[in_path]
+            handle, params = items[i]
+            pulses = np.load(tasks[i][1], mmap_mode='r')
+            correction_cache.put(correction_key(handle, params),
+                                 get_dataset(handle).with_pulses(pulses))
+            if progress is not None:
+                progress(n + 1)
+
+    finally:
+        # The results stay mapped after their files are removed. The tasks of a
+        # cancelled job still run to the end in the pool, on their unlinked files.
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+# Correct the raw data from tab1 with the params stored in temp-data-full.
+# Corrected datasets are put in the dataset store, keyed by AMU. AMUs that were
+# already corrected with the same params in tab 2 come from the correction cache;
+# the others are corrected across `pool`, the correction pool by default, when
+# there are several of them, or in this process without a pool. Progress is
+# reported to `job` when run as a background job.
+def correct_full_data(temp_data, raw_data, current_temp_data, session, job=None,
+                      pool=None):
     if current_temp_data is not None:
         temp = current_temp_data
-        raw_data = dict(raw_data[0]['props']['data'])
-        amus = temp_data.keys()
-        
-        for amu in amus:
-            amu, x, timespan, corr, smooth, window_size, order = temp_data[amu]
-            corrected_dataset = correct_data(raw_data[amu], x, timespan, corr,
-                                             smooth, window_size, order)
-            temp[amu] = {}
-            temp[amu]['data'] = corrected_dataset
-            temp[amu]['params'] = temp_data[amu]
-        
-        return temp
-
     else:
         temp = {}
-        raw_data = dict(raw_data[0]['props']['data'])
-        amus = temp_data.keys()
+
+    raw_data = dict(raw_data[0]['props']['data'])
+    amus = temp_data.keys()
+
+    if pool is None:
+        pool = _correct_pool
+    missing = [(raw_data[amu], temp_data[amu]) for amu in amus
+               if correction_key(raw_data[amu], temp_data[amu]) not in correction_cache]
+    if pool is None or len(missing) <= 1:
+        missing = []
+
+    # Progress counts the parallel corrections, then storing every AMU
+    steps = len(missing) + len(amus)
+    if missing:
+        correct_parallel(missing, pool,
+                         progress=lambda n: job.report(n, steps) if job is not None else None)
         
-        for amu in amus:
-            amu, x, timespan, corr, smooth, window_size, order = temp_data[amu]
-            corrected_dataset = correct_data(raw_data[amu], x, timespan, corr,
-                                             smooth, window_size, order)
-            temp[amu] = {}
-            temp[amu]['data'] = corrected_dataset
-            temp[amu]['params'] = temp_data[amu]
+    for i, amu in enumerate(amus):
+        if job is not None:
+            job.report(len(missing) + i, steps)
+
+        corrected_dataset = get_corrected(raw_data[amu], temp_data[amu])
+        temp[amu] = {}
+        temp[amu]['handle'] = datastore.put(session, 'full/{0}'.format(amu), corrected_dataset)
+        temp[amu]['raw handle'] = raw_data[amu]
+        temp[amu]['params'] = temp_data[amu]
         
-        return temp
+    return temp
 
     
-# Function that reads raw data in Tab 1 and returns data set corresponding to
-# the AMU chosen
-def select_dataset(raw_data, amu):
-    if raw_data and amu:
-        dataset = raw_data[amu]
-        return dataset
+# Savitzky-Golay filter coefficients keyed by (window_size, order, deriv, rate),
+# in least-recently-used order
+_sg_coeffs = OrderedDict()
+_sg_lock = threading.Lock()
 
 
-# Function that performs the savitzky golay smoothing per arguments passed by user
-def savitzky_golay(y, window_size, order, deriv=0, rate=1):
+# Function that returns the Savitzky-Golay filter coefficients for a window size,
+# polynomial order and derivative. Filters are computed once and kept in a small
+# LRU cache, since the sliders in tab 2 only ever ask for a handful of them.
+def savgol_coeffs(window_size, order, deriv=0, rate=1):
 #    Taken from https://scipy-cookbook.readthedocs.io/items/SavitzkyGolay.html
-#    Have not really thought much about it. Hopefully works for all cases!
 
     try:
         window_size = np.abs(np.int(window_size))
@@ -305,170 +610,510 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     if window_size < order + 2:
         raise TypeError("window_size is too small for the polynomials order")
 
+    key = (window_size, order, deriv, rate)
+    with _sg_lock:
+        if key in _sg_coeffs:
+            _sg_coeffs[key] = _sg_coeffs.pop(key)
+            return _sg_coeffs[key]
+
     order_range = range(order+1)
     half_window = (window_size -1) // 2
 
     b = np.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
     m = np.linalg.pinv(b).A[deriv] * rate**deriv * factorial(deriv)
 
-    firstvals = y[0] - np.abs( y[1:half_window+1][::-1] - y[0] )
-    lastvals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
-    y = np.concatenate((firstvals, y, lastvals))
+    with _sg_lock:
+        _sg_coeffs[key] = m
+        while len(_sg_coeffs) > SG_CACHE_SIZE:
+            _sg_coeffs.popitem(last=False)
+
+    return m
+
+
+# Function that performs the savitzky golay smoothing of all pulses, the rows of
+# a (n_pulses, n_datapoints) matrix, in one filtering pass along the time axis.
+# The ends of every pulse are padded with its values mirrored about the first
+# and last points. With deriv > 0 the derivative of the smoothed pulses is
+# returned instead.
+def savitzky_golay_pulses(pulses, window_size, order, deriv=0, rate=1):
+    m = savgol_coeffs(window_size, order, deriv, rate)
+    half_window = len(m) // 2
+    n = pulses.shape[1]
+
+    first = pulses[:, :1]
+    last = pulses[:, -1:]
+    padded = np.concatenate((first - np.abs(pulses[:, half_window:0:-1] - first),
+                             pulses,
+                             last + np.abs(pulses[:, -2:-half_window-2:-1] - last)), axis=1)
+
+    smoothed = correlate1d(padded, m, axis=1)
+
+    return np.ascontiguousarray(smoothed[:, half_window:half_window+n])
+
+
+# Function that performs the savitzky golay smoothing per arguments passed by user
+def savitzky_golay(y, window_size, order, deriv=0, rate=1):
+    return savitzky_golay_pulses(np.asarray(y).reshape(1, -1), window_size, order,
+                                 deriv, rate)[0]
+
+
+# Function that returns the mask of the times that fall in any of the baseline
+# windows, and the number of windows. `windows` is a flat list of window bounds,
+# [t1, t2, t3, t4, ...].
+def baseline_mask(times, windows):
+    windows = np.asarray(windows, dtype=np.float64).reshape(-1, 2)
+
+    mask = np.zeros(len(times), dtype=bool)
+    for t1, t2 in windows:
+        mask |= (times >= t1) & (times <= t2)
+
+    return mask, len(windows)
+
+
+# Function that subtracts the baseline from all pulses as one operation on the
+# (n_pulses, n_datapoints) matrix. With one window the baseline of a pulse is its
+# mean over the window; with several disjoint windows it is the straight line
+# fitted through all of them, which follows a drifting baseline. The result is
+# written to `out`, which can be `pulses` itself when the caller owns the array.
+def correct_baseline(pulses, times, windows, out=None):
+    mask, n_windows = baseline_mask(times, windows)
+    if out is None:
+        out = np.empty_like(pulses)
+
+    if not mask.any():
+        out[...] = pulses
+        return out
+
+    selected = pulses[:, mask]
+    offsets = np.mean(selected, axis=1, dtype=np.float64)
+    np.subtract(pulses, offsets[:, np.newaxis].astype(pulses.dtype), out=out)
+
+    if n_windows > 1:
+        # Least-squares slope of every pulse over the windows, around their mean time
+        t_mean = times[mask].mean()
+        t = times[mask] - t_mean
+        if t.any():
+            slope = np.dot(selected, t) / np.dot(t, t)
+            out -= np.multiply.outer(slope, times - t_mean).astype(pulses.dtype)
+
+    return out
 
-    return np.convolve( m[::-1], y, mode='valid')
 
-    
 # Function that loads data and the baseline correction timespan as arguments
-# and corrects the baseline for all pulses, returns the entire dataset
-def correct_data(data, x, timespan, corr, smooth, window_size, order):
-    pulses = np.array([np.array(pulse) for pulse in data['pulses']])
-    times = np.array(data['times'])
+# and corrects the baseline for all pulses, returns the corrected PulseSet.
+# `timespan` holds the bounds of one or more baseline windows.
+def correct_data(pulse_set, timespan, corr, smooth, window_size, order):
+    pulses = pulse_set.pulses
 
     if corr is True:
-        t1, t2 = timespan
-        indx = (times>=t1) & (times<=t2)
+        pulses = correct_baseline(pulses, pulse_set.times, timespan)
 
-        select_pulses = np.array([pulse[indx] for pulse in pulses])
-        avg_spans = np.mean(select_pulses, axis=1)
-        corr_pulses = np.array([pulse - avg_spans[i] for i, pulse in enumerate(pulses)])
-    
-        if smooth is True:
-            smooth_pulses = np.array([savitzky_golay(pulse,
-                                                     window_size=window_size,
-                                                     order=order)
-                                      for pulse in corr_pulses])
-            data[x] = smooth_pulses
-        else:
-            data[x] = corr_pulses
+    if smooth is True:
+        pulses = savitzky_golay_pulses(pulses, window_size, order)
 
-    else:
-        if smooth is True:
-            smooth_pulses = np.array([savitzky_golay(pulse,
-                                                     window_size=window_size,
-                                                     order=order)
-                                      for pulse in pulses])
-            data[x] = smooth_pulses
+    if pulses is pulse_set.pulses:
+        return pulse_set
 
-        else:
-            data[x] = pulses
+    return pulse_set.with_pulses(pulses)
+
+
+# Preprocessing stages of tab 2, applied in this order after the raw pulses.
+# Each takes the output of the previous stage and its own parameters.
+def baseline_stage(pulse_set, timespan):
+    return pulse_set.with_pulses(correct_baseline(pulse_set.pulses, pulse_set.times, timespan))
+
+
+def smooth_stage(pulse_set, window_size, order):
+    return pulse_set.with_pulses(savitzky_golay_pulses(pulse_set.pulses, window_size, order))
+
+
+def average_stage(pulse_set):
+    return pulse_set.avg_pulse()
+
+
+# Function that returns the stage key and the cached computation of a stage
+# applied to the output of `parent`, the computation of the previous stage
+def chain_stage(parent_key, parent, func, args):
+    key = (parent_key, func.__name__, args)
+
+    return key, lambda: stage_cache.get_or_compute(key, lambda: func(parent(), *args))
+
+
+# Function that returns the preview of a dataset: `n_pulses` pulses, the middle
+# pulse of as many equal strata of the experiment, with every `step`-th point
+def preview_stage(pulse_set, n_pulses, step):
+    n = pulse_set.n_pulses
+    inds = ((np.arange(min(n_pulses, n)) + 0.5) * n / min(n_pulses, n)).astype(int)
+
+    return pulse_set.subset(inds).decimate(step)
 
-    return data
 
+# Function that returns the preview size of a dataset as (n_pulses, step), or
+# None if the dataset is no larger than a preview
+def preview_size(pulse_set):
+    step = -(-pulse_set.n_datapoints // PREVIEW_POINTS)
+    if pulse_set.n_pulses <= PREVIEW_PULSES and step <= 1:
+        return None
 
-# Function the saves temporary pre-processed .npy files and updates
-# as the user makes changes in tab 2
-# This data is rendered into an average pulse response and stored in the
-# 'data-tab2' dcc Storage component.
-def write_temp(data, x):
-    t = data['times']
-    amu = data['amu']
-    tf = np.array(t).reshape(1, len(t))
-    pulses = np.array(data[x])
+    return PREVIEW_PULSES, max(step, 1)
 
-    avg = np.mean(pulses, axis=0)
-    avg1 = avg.reshape(1, len(avg))
 
-    c1 = np.array([float(amu)] * pulses.shape[1])
-    c1f = c1.reshape(1, len(c1))
+# Function that runs the preprocessing stages, raw -> baseline -> smooth -> average,
+# on the dataset of a handle, with `params` as stored in 'temp-data', and returns
+# the output of `stage`: the corrected PulseSet for 'baseline' or 'smooth', the
+# average pulse for 'average'. Every stage output is cached under the key of its
+# input and its own parameters, so a slider change only recomputes the stages
+# downstream of it, and disabled stages pass their input through.
+# With `preview` the stages run on the preview of the dataset instead, with the
+# smoothing window scaled to the decimated time axis.
+def preprocess(handle, params, stage='smooth', preview=False):
+    amu, x, timespan, corr, smooth, window_size, order = params
 
-    d1 = np.append(c1f, tf, axis=0)
-    d2 = np.append(d1, avg1, axis=0)
-    final_data = np.append(d2, pulses, axis=0)
+    key = (handle['id'], handle['version'])
+    compute = lambda: get_dataset(handle)
 
-    np.save('{0}.npy'.format(os.path.join(savedir, '{0:0.1f}'.format(amu))), final_data)
+    if preview:
+        size = preview_size(get_dataset(handle))
+        if size is not None:
+            key, compute = chain_stage(key, compute, preview_stage, size)
+            window_size = max(int(window_size) // size[1] // 2 * 2 + 1,
+                              int(order) + 3 - int(order) % 2)
+
+    stages = [('baseline', baseline_stage,
+               (tuple(float(t) for t in timespan),) if corr is True else None),
+              ('smooth', smooth_stage,
+               (int(window_size), int(order)) if smooth is True else None),
+              ('average', average_stage, ())]
+
+    for name, func, args in stages:
+        if args is not None:
+            key, compute = chain_stage(key, compute, func, args)
+        if name == stage:
+            break
+
+    return compute()
+
+
+# Function that returns the key of a corrected dataset in the correction cache:
+# the dataset id and version and the params as stored in 'full-temp-data', with
+# the params of disabled corrections left out
+def correction_key(handle, params):
+    amu, x, timespan, corr, smooth, window_size, order = params
+
+    return (handle['id'], handle['version'],
+            tuple(float(t) for t in timespan) if corr is True else None,
+            (int(window_size), int(order)) if smooth is True else None)
+
+
+# Function that returns the dataset of a handle corrected with `params`. Every
+# corrected dataset is computed once per params and shared by the plots, the
+# download links and apply-all through the correction cache.
+def get_corrected(handle, params):
+    return correction_cache.get_or_compute(correction_key(handle, params),
+                                           lambda: preprocess(handle, params))
+
+
+# Function that returns the Pyramid of the pulses of the dataset of a handle, or
+# of its average pulse with `average`, building it on first use. Pyramids are
+# kept in the dataset store next to their dataset and built again once it has a
+# new version, as every new correction does. They are stored without the pulses,
+# which are read from the dataset again; the average pulse is stored with its
+# pyramid, as it is kept nowhere else.
+def get_pyramid(handle, average=False):
+    session, name = handle['id'].split('/', 1)
+    name = '{0}/{1}'.format(name, 'avg-pyramid' if average else 'pyramid')
+    try:
+        entry = datastore.get({'id': '{0}/{1}'.format(session, name)})
+    except KeyError:
+        entry = None
+
+    if entry is not None and entry['version'] == handle['version']:
+        data = entry['data'] if average else get_dataset(handle).pulses
+        return entry['pyramid'].with_data(data)
+
+    pulse_set = get_dataset(handle)
+    data = pulse_set.avg_pulse() if average else pulse_set.pulses
+    pyramid = Pyramid(data, pulse_set.t0, pulse_set.dt)
+    entry = {'version': handle['version'], 'pyramid': pyramid.without_data()}
+    if average:
+        entry['data'] = data
+    datastore.put(session, name, entry)
+
+    return pyramid
+
+
+# Function that returns the 3D figure of the condensed dataset of a handle in
+# `mode`, see figures.figure3d, cached per dataset version and mode
+def condensed_figure(handle, mode):
+    key = ('3d', handle['id'], handle['version'], mode, figures.MAX_POINTS_3D)
+
+    def compute():
+        pulse_set = get_dataset(handle)
+        step = handle.get('pulse step', 1)
+
+        return figures.figure3d(pulse_set, mode, np.arange(pulse_set.n_pulses)*step + 1,
+                                get_pyramid(handle))
+
+    return plot_cache.get_or_compute(key, compute)
+
+
+# Function that returns the time axis and average pulse of the correction in
+# 'temp-data', decimated for the plot of tab 2 to decimation.PLOT_POINTS points of
+# the whole pulse or of the range `x_range` zoomed into. With the 'minmax' method
+# the points are served from the pyramid of the average pulse. Decimated averages
+# are cached per correction and zoom range, so zooming back and forth costs nothing.
+def avg_plot_data(temp_data, x_range=None):
+    raw_handle, params, preview = temp_data['raw handle'], temp_data['params'], temp_data.get('preview')
+    key = (correction_key(raw_handle, params), bool(preview), x_range,
+           decimation.PLOT_POINTS, decimation.default_method)
+
+    def compute():
+        if decimation.default_method == 'minmax':
+            times, pulses, avg_pulse = get_pyramid(temp_data['handle'], average=True).envelope(
+                decimation.PLOT_POINTS, x_range)
+            return times, avg_pulse
+
+        pulse_set = get_dataset(temp_data['handle'])
+        avg_pulse = preprocess(raw_handle, params, 'average', preview=preview)
+
+        return decimation.decimate(pulse_set.times, avg_pulse, decimation.PLOT_POINTS, x_range)
+
+    return plot_cache.get_or_compute(key, compute)
+
+
+# Function that returns the pulse heatmap of the correction in 'temp-data' for
+# figures.heatmap: the PNG raster of the means of bins of pulses and time points,
+# served from the pyramid of the pulses at figures.RASTER_WIDTH by
+# figures.RASTER_HEIGHT bins of the whole dataset or of the time range `x_range`
+# and the range of pulse rows `pulse_range`, (first, stop), zoomed into, its
+# extent, and the colour range. The colour range is that of the whole dataset, so
+# colours keep their meaning when zooming. Rasters are cached per correction and
+# zoom range like avg_plot_data.
+def heatmap_data(temp_data, x_range=None, pulse_range=None):
+    raw_handle, params, preview = temp_data['raw handle'], temp_data['params'], temp_data.get('preview')
+    key = ('heatmap', correction_key(raw_handle, params), bool(preview), x_range, pulse_range,
+           figures.RASTER_WIDTH, figures.RASTER_HEIGHT)
+
+    def compute():
+        pyramid = get_pyramid(temp_data['handle'])
+        times, pulses, mins, maxs, means = pyramid.window(
+            figures.RASTER_WIDTH, x_range, figures.RASTER_HEIGHT, pulse_range)
+
+        coarsest = max(t for t, p in pyramid.levels)
+        vmin = float(pyramid.levels[(coarsest, 0)][0].min())
+        vmax = float(pyramid.levels[(coarsest, 0)][1].max())
+
+        # Every pixel spans one bin, from half a bin before its centre, and pulse
+        # numbers count from 1. Bins of pulses are aligned to their size, so they
+        # may reach past the pulses zoomed into.
+        width = times[1] - times[0] if len(times) > 1 else pyramid.dt
+        height = pulses[1] - pulses[0] if len(pulses) > 1 else 1
+        x0 = float(times[0] - width / 2.0)
+        extent = (x0, x0 + width * len(times),
+                  pulses[0] + 0.5, min(pulses[-1] + height, pyramid.shape[0]) + 0.5)
+
+        # The first pulse is drawn at the bottom
+        return figures.raster_png(means[::-1], vmin, vmax), extent, vmin, vmax
+
+    return plot_cache.get_or_compute(key, compute)
+
+
+# Timers of the pending full-resolution corrections, keyed by session and AMU
+_full_timers = {}
+_full_lock = threading.Lock()
+
+
+# Function that computes the full-resolution correction of a dataset into the
+# correction cache in a background thread, once no newer request for the same
+# session and AMU has come in for PREVIEW_DELAY seconds
+def schedule_full_correction(session, handle, params):
+    name = (session, params[0])
+
+    def run():
+        with _full_lock:
+            if _full_timers.get(name) is not timer:
+                return
+        try:
+            get_corrected(handle, params)
+        finally:
+            with _full_lock:
+                if _full_timers.get(name) is timer:
+                    del _full_timers[name]
+
+    timer = threading.Timer(PREVIEW_DELAY, run)
+    timer.daemon = True
+    with _full_lock:
+        previous = _full_timers.get(name)
+        if previous is not None:
+            previous.cancel()
+        _full_timers[name] = timer
+    timer.start()
+
+
+# Function that returns the full-resolution correction of a dataset if it is
+# ready, or None. A correction that was requested more than PREVIEW_DELAY ago
+# but is not pending in this process, as when the app runs several server
+# processes, is computed here.
+def full_correction(session, handle, params, requested):
+    key = correction_key(handle, params)
+    if key in correction_cache:
+        return get_corrected(handle, params)
+
+    with _full_lock:
+        pending = (session, params[0]) in _full_timers
+    if not pending and time.time() - requested > PREVIEW_DELAY:
+        return get_corrected(handle, params)
+
+    return None
+
+
+# Function that returns the path of the saved session container of a browser session
+def session_path(session):
+    sessiondir = os.path.join(savedir, 'sessions')
+    if not os.path.exists(sessiondir):
+        os.mkdir(sessiondir)
+
+    return os.path.join(sessiondir, '{0}.tap'.format(session))
+
+
+# Function that saves the raw data from tab 1, together with the corrected pulses
+# and correction params of every AMU processed in tab 2, into a .tap container.
+# Loading the container back restores the experiment without any parsing, see
+# update_database.
+def save_session(raw_pulse_data, current_data, path):
+    raw_data = dict(raw_pulse_data[0]['props']['data'])
+
+    datasets = {}
+    for amu, handle in raw_data.items():
+        ds = get_dataset(handle).to_dict()
+
+        if current_data is not None and amu in current_data:
+            ds['params'] = current_data[amu]['params']
+            ds['corrected pulses'] = get_dataset(current_data[amu]['handle']).pulses
+
+        datasets[amu] = ds
+
+    container.write_container(path, datasets)
 
 
 # Function to calculate area under the curve for each pulse using the trapezoid rule from SciPy.
+# The float64 time axis makes the sums accumulate in float64 for float32 pulses too.
 def get_areas(pulses, t):
-    areas = np.array([trapz(pulse, t) for pulse in pulses])
+    areas = trapz(pulses, np.asarray(t, dtype=np.float64), axis=1)
 
     return areas
 
-# Implementation of the inert normalization routines to obtain the final clean data for further analysis
-def inert_normalization(amu_inert, pulses_data_all):
-    normdir = os.path.join(savedir, 'normalized')
-    if not os.path.exists(normdir):
-        os.mkdir(normdir)        
-    
-    pulses_combined = []
-    amus = pulses_data_all.keys()
-    for amu in amus:
-        data = pulses_data_all[amu]['data']
-        x = pulses_data_all[amu]['params'][1]
-
-        pulses_combined.append(data[x])
-        times = np.array(data['times'])
-
-    inert_index = amus.index(amu_inert)
-    pulses_areas = [get_areas(pulses, times) for pulses in pulses_combined]
-    inert_areas = pulses_areas[inert_index]
-    inert_coeffs = np.array(inert_areas / max(inert_areas))
-
-    for (pulses, amu) in zip(np.array(pulses_combined), amus):
-        norm_pulses = np.array([pulse/k for (pulse, k) in zip(pulses, inert_coeffs)])
-        times_r = times.reshape(1, len(times))
-
-        c1 = np.array([float(amu)] * norm_pulses.shape[1])
-        c1f = c1.reshape(1, len(c1))
-        
-        avg = np.mean(norm_pulses, axis=0)
-        avg1 = avg.reshape(1, len(avg))
+# Function that normalizes the pulses of all AMUs, a dict of AMU to PulseSet, by
+# the areas of the pulses of the inert AMU. The pulses are stacked into one
+# (amu, pulse, time) array, the inert areas are integrated along the time axis
+# and all AMUs are divided by the inert coefficients in one broadcast operation.
+# AMUs recorded with different numbers of data points cannot be stacked and are
+# divided one by one. Returns a dict of AMU to normalized PulseSet.
+def normalize_pulses(amu_inert, pulse_sets):
+    amus = sorted(pulse_sets.keys())
+    n_pulses = set(pulse_sets[amu].pulses.shape[0] for amu in amus)
+    if len(n_pulses) > 1:
+        raise ValueError('All AMUs need the same number of pulses to be normalized '
+                         'together, found {0}'.format(sorted(n_pulses)))
+
+    inert = pulse_sets[amu_inert]
+    inert_areas = get_areas(inert.pulses, inert.times)
+    inert_coeffs = inert_areas / max(inert_areas)
+
+    if len(set(pulse_sets[amu].pulses.shape for amu in amus)) > 1:
+        normalized = {}
+        for amu in amus:
+            pulses = pulse_sets[amu].pulses
+            normalized[amu] = pulse_sets[amu].with_pulses(pulses / inert_coeffs[:, np.newaxis].astype(pulses.dtype))
+        return normalized
 
-        d1 = np.append(c1f, times_r, axis=0)
-        d2 = np.append(d1, avg1, axis=0)
-        final_pulses = np.append(d2, norm_pulses, axis=0)
-         
-        np.save('{0}-i.npy'.format(os.path.join(normdir, '{0}'.format(amu))), final_pulses)
+    stacked = np.stack([pulse_sets[amu].pulses for amu in amus])
+    stacked /= inert_coeffs[np.newaxis, :, np.newaxis].astype(stacked.dtype)
 
+    return dict((amu, pulse_sets[amu].with_pulses(stacked[i])) for i, amu in enumerate(amus))
 
-# Function that creates a download link from a dynamic xlsx file created in the code.
-# This creates a Flask server route with this downloadable link.
-def create_download_link(amu):
-    stuff = np.load(os.path.join(savedir, str(amu+'.npy')))
 
-    cols = ['AMU'] + ['Time'] + ['Avg'] + [str(i) for i in range(1, stuff.shape[0]-2)]
-    df = pd.DataFrame(np.transpose(stuff), columns=cols)
-    amu = df['AMU'].iloc[0]
-    del df['AMU']
-    
-    buf = io.BytesIO()
-    excel_writer = ExcelWriter(buf)
-    df.to_excel(excel_writer, sheet_name="Pulses", index=False)
-    excel_writer.save()
-    buf.seek(0)
-    
-    return send_file(
-        buf,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        attachment_filename='AMU={0:0.1f}.xlsx'.format(amu),
-        as_attachment=True,
-        cache_timeout=0)
-
-
-# Function that combines inert normalized .npy pulse data into one whole .xslx file ready for download.
-def create_download_link_norm(amu_inert):
-    normdir = os.path.join(savedir, 'normalized')
-    buf = io.BytesIO()
-    excel_writer = ExcelWriter(buf)
-    pulse_files = os.listdir(normdir)
-    
-    for pulse_file in pulse_files:
-        stuff = np.load(os.path.join(normdir, pulse_file))
+# Function that returns the key of an inert normalization in the normalization
+# cache: the inert AMU and the correction key of every AMU
+def normalization_key(amu_inert, pulses_data_all):
+    keys = []
+    for amu in sorted(pulses_data_all.keys()):
+        data = pulses_data_all[amu]
+        if 'raw handle' in data:
+            keys.append((amu, correction_key(data['raw handle'], data['params'])))
+        else:
+            keys.append((amu, data['handle']['id'], data['handle']['version']))
 
-        cols = ['AMU'] + ['Time'] + ['Avg'] + [str(i)
-                                               for i in range(1, stuff.shape[0]-2)]
-        df = pd.DataFrame(np.transpose(stuff), columns=cols)
-        amu = df['AMU'].iloc[0]
-        del df['AMU']
+    return (amu_inert, tuple(keys))
 
-        df.to_excel(excel_writer, sheet_name='{0:0.1f}'.format(amu), index=False)
-    
-    excel_writer.save()
-    buf.seek(0)
-    
-    return send_file(
-        buf,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        attachment_filename='{0}-inert-normalized.xlsx'.format(amu_inert),
-        as_attachment=True,
-        cache_timeout=0)
+
+# Implementation of the inert normalization routines to obtain the final clean data for further analysis
+# The normalized datasets are kept in memory, in the normalization cache and in
+# the dataset store of the session, and only written to disk when downloaded.
+# Returns the handle of the normalized datasets.
+def inert_normalization(amu_inert, pulses_data_all, session, job=None):
+    def normalize():
+        pulse_sets = {}
+        for i, amu in enumerate(sorted(pulses_data_all.keys())):
+            if job is not None:
+                job.report(i, len(pulses_data_all) + 1)
+            pulse_sets[amu] = get_dataset(pulses_data_all[amu]['handle'])
+
+        return normalize_pulses(amu_inert, pulse_sets)
+
+    key = normalization_key(amu_inert, pulses_data_all)
+    normalized = normalization_cache.get_or_compute(key, normalize)
+
+    params = dict((amu, pulses_data_all[amu].get('params')) for amu in pulses_data_all)
+
+    return datastore.put(session, 'normalized/{0}'.format(amu_inert),
+                         {'data': normalized, 'params': params, 'key': key})
+
+
+# Function that returns a response streaming PulseSets exported in format `fmt`,
+# see exports.py, as the file is generated. `names` are their keys in the dataset
+# store, `metas` their dataset_meta dicts, `sheet_names` the xlsx sheet names if
+# not `names`, and `key` the key of the data they hold. The file is cached on
+# disk under the key, the format and the names, which repeat downloads are served
+# from, and the response carries that as its ETag so the route can answer
+# conditional requests.
+def stream_export(names, pulse_sets, metas, basename, fmt, key, sheet_names=None):
+    extension, mimetype, chunks = exports.export(fmt, names, pulse_sets, metas, sheet_names)
+    etag = artifacts.artifact_key(key, fmt, tuple(names), tuple(sheet_names or names))
+
+    path = artifacts.lookup(etag)
+    if path is not None:
+        response = send_file(path, mimetype=mimetype, add_etags=False, cache_timeout=0)
+    else:
+        response = Response(artifacts.write_through(etag, chunks), mimetype=mimetype)
+
+    response.set_etag(etag)
+    response.headers['Content-Disposition'] = 'attachment; filename="{0}.{1}"'.format(basename, extension)
+    response.headers['Cache-Control'] = 'no-cache'
+
+    return response
+
+
+# Function that creates a download link from a dynamic file created in the code.
+# This creates a Flask server route with this downloadable link.
+# The corrected pulses of the AMU are exported from the dataset store of the
+# session, as put there by the download link callback, in format `fmt`. The xlsx
+# sheet keeps the name exports.SINGLE_SHEET.
+def create_download_link(amu, session, fmt='xlsx'):
+    export = datastore.get({'id': '{0}/export/{1}'.format(session, amu)})
+    pulse_set = export['data']
+
+    return stream_export([amu], [pulse_set], [exports.dataset_meta(pulse_set, export['params'])],
+                         'AMU={0}'.format(amu), fmt, export['key'], [exports.SINGLE_SHEET])
+
+
+# Function that combines the inert normalized pulse data of a session into one whole file ready for download.
+def create_download_link_norm(amu_inert, session, fmt='xlsx'):
+    normalized = datastore.get({'id': '{0}/normalized/{1}'.format(session, amu_inert)})
+    amus = sorted(normalized['data'].keys())
+    pulse_sets = [normalized['data'][amu] for amu in amus]
+    metas = [exports.dataset_meta(normalized['data'][amu], normalized['params'][amu], amu_inert)
+             for amu in amus]
+
+    return stream_export(amus, pulse_sets, metas, '{0}-inert-normalized'.format(amu_inert), fmt,
+                         normalized['key'])
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+# Streaming writer for .xlsx workbooks of numeric sheets.
+#
+# A workbook is a zip archive of XML parts. write_workbook generates the archive
+# as a sequence of byte strings: every sheet is turned into XML a block of rows
+# at a time, deflated and yielded as soon as it is compressed, so memory use
+# depends on the block size and not on the number of rows or pulses, and a
+# download can start before the whole workbook is written. Since the size and
+# CRC of a part are only known once it has been written, they follow each part
+# in a zip data descriptor.
+#
+# Sheets hold one header row of strings, written as inline strings so that the
+# workbook needs no shared strings table, followed by rows of numbers. Missing
+# values (NaN) are left out of their rows. The archive is not zip64, so each part
+# is limited to 4 GiB.
+
+import struct
+import time
+import zlib
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Deflate level of the parts; higher levels barely shrink numeric XML further
+COMPRESS_LEVEL = 6
+
+# Size of the compressed chunks yielded by write_workbook
+CHUNK_SIZE = 1 << 16
+
+_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+_REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+_DOC_TYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+_CT_NS = 'http://schemas.openxmlformats.org/package/2006/content-types'
+_CT = 'application/vnd.openxmlformats-officedocument.spreadsheetml.'
+
+_local_header = struct.Struct('<IHHHHHIIIHH')
+_descriptor = struct.Struct('<IIII')
+_central_header = struct.Struct('<IHHHHHHIIIHHHHHII')
+_end_record = struct.Struct('<IHHHHIIH')
+
+
+# Function that returns the date and time of now in the MS-DOS format of zip headers
+def _dos_time():
+    t = time.localtime()
+    return (((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+            (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2))
+
+
+# Class that writes a zip archive as a stream of byte strings, one deflated part
+# after the other, at deflate level `level`
+class ZipStream(object):
+
+    def __init__(self, level=COMPRESS_LEVEL):
+        self.level = level
+        self.offset = 0
+        self.entries = []
+        self.date, self.time = _dos_time()
+
+    # Function that yields the bytes of one part, `name`, with the data produced
+    # by the iterable of byte strings `chunks`
+    def part(self, name, chunks):
+        name = name.encode('utf-8')
+        header = _local_header.pack(0x04034b50, 20, 0x08, 8, self.time, self.date,
+                                    0, 0, 0, len(name), 0) + name
+        start = self.offset
+        self.offset += len(header)
+        yield header
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        crc = 0
+        size = 0
+        compressed_size = 0
+        pending = []
+        pending_size = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                pending.append(data)
+                pending_size += len(data)
+                if pending_size >= CHUNK_SIZE:
+                    data = b''.join(pending)
+                    compressed_size += len(data)
+                    pending, pending_size = [], 0
+                    yield data
+
+        pending.append(compressor.flush())
+        data = b''.join(pending)
+        compressed_size += len(data)
+        yield data
+
+        if size > 0xFFFFFFFF or compressed_size > 0xFFFFFFFF:
+            raise ValueError('Part {0} of the workbook is larger than 4 GiB'.format(name))
+
+        crc &= 0xFFFFFFFF
+        descriptor = _descriptor.pack(0x08074b50, crc, compressed_size, size)
+        self.offset += compressed_size + len(descriptor)
+        self.entries.append((name, crc, compressed_size, size, start))
+        yield descriptor
+
+    # Function that yields the central directory, which ends the archive
+    def close(self):
+        directory = []
+        for name, crc, compressed_size, size, start in self.entries:
+            directory.append(_central_header.pack(0x02014b50, 20, 20, 0x08, 8, self.time, self.date,
+                                                  crc, compressed_size, size, len(name),
+                                                  0, 0, 0, 0, 0, start) + name)
+        directory = b''.join(directory)
+        yield directory + _end_record.pack(0x06054b50, 0, 0, len(self.entries), len(self.entries),
+                                           len(directory), self.offset, 0)
+
+
+# Function that returns the letters of the column with index `i`, from 0
+def _column(i):
+    letters = ''
+    i += 1
+    while i:
+        i, rest = divmod(i - 1, 26)
+        letters = chr(ord('A') + rest) + letters
+
+    return letters
+
+
+# Function that returns the XML row of a header of strings
+def _header_row(header):
+    cells = u''.join(u'<c r="{0}1" t="inlineStr"><is><t>{1}</t></is></c>'.format(
+        _column(i), escape(unicode(h))) for i, h in enumerate(header))
+    return u'<row r="1">{0}</row>'.format(cells).encode('utf-8')
+
+
+# Function that yields the XML of a sheet. `blocks` is an iterable of 2D arrays,
+# each a block of consecutive rows. Every row and cell carries its reference,
+# which readers such as openpyxl need to place the cells.
+def _sheet_xml(header, blocks):
+    yield ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+           '<worksheet xmlns="{0}"><sheetData>'.format(_NS)).encode('ascii')
+    yield _header_row(header)
+
+    row = 2
+    row_fmt = None
+    for block in blocks:
+        block = np.asarray(block)
+        if block.dtype != np.float32:
+            block = block.astype(np.float64, copy=False)
+        if row_fmt is None or block.shape[1] != n_cols:
+            n_cols = block.shape[1]
+            columns = [_column(i) for i in range(n_cols)]
+            # Shortest round-trip representation for double precision, and
+            # enough digits to round-trip single precision. ROW stands for the
+            # row number, which is filled in before the values.
+            value_fmt = '%r' if block.dtype != np.float32 else '%.9g'
+            row_fmt = ('<row r="ROW">' +
+                       ''.join('<c r="{0}ROW"><v>{1}</v></c>'.format(c, value_fmt) for c in columns) +
+                       '</row>')
+
+        finite = np.isfinite(block).all(axis=1)
+        lines = []
+        for values, ok in zip(block.tolist(), finite):
+            if ok:
+                lines.append(row_fmt.replace('ROW', str(row)) % tuple(values))
+            else:
+                # Missing values are left out of the row
+                lines.append('<row r="%d">%s</row>' % (row, ''.join(
+                    ('<c r="%s%d"><v>' + value_fmt + '</v></c>') % (c, row, v)
+                    for c, v in zip(columns, values) if np.isfinite(v))))
+            row += 1
+        yield ''.join(lines).encode('ascii')
+
+    yield b'</sheetData></worksheet>'
+
+
+# Function that generates a workbook as a sequence of byte strings. `sheets` is a
+# list of (sheet name, header, blocks), where `header` is the list of column
+# names and `blocks` an iterable of 2D arrays of rows; blocks are only consumed
+# while the workbook is being generated.
+def write_workbook(sheets):
+    archive = ZipStream()
+
+    content_types = ''.join(
+        '<Override PartName="/xl/worksheets/sheet{0}.xml" ContentType="{1}worksheet+xml"/>'.format(i, _CT)
+        for i in range(1, len(sheets) + 1))
+    for data in archive.part('[Content_Types].xml', [(
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Types xmlns="{0}">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="{1}sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" ContentType="{1}styles+xml"/>'
+            '{2}</Types>').format(_CT_NS, _CT, content_types).encode('utf-8')]):
+        yield data
+
+    for data in archive.part('_rels/.rels', [(
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="{0}">'
+            '<Relationship Id="rId1" Type="{1}officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>').format(_PKG_REL_NS, _DOC_TYPE).encode('utf-8')]):
+        yield data
+
+    sheet_entries = ''.join(
+        u'<sheet name="{0}" sheetId="{1}" r:id="rId{1}"/>'.format(escape(unicode(name)[:31]), i)
+        for i, (name, _, _) in enumerate(sheets, 1))
+    for data in archive.part('xl/workbook.xml', [(
+            u'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            u'<workbook xmlns="{0}" xmlns:r="{1}"><sheets>{2}</sheets></workbook>').format(
+                _NS, _REL_NS, sheet_entries).encode('utf-8')]):
+        yield data
+
+    sheet_rels = ''.join(
+        '<Relationship Id="rId{0}" Type="{1}worksheet" Target="worksheets/sheet{0}.xml"/>'.format(i, _DOC_TYPE)
+        for i in range(1, len(sheets) + 1))
+    for data in archive.part('xl/_rels/workbook.xml.rels', [(
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="{0}">{1}'
+            '<Relationship Id="rId{2}" Type="{3}styles" Target="styles.xml"/>'
+            '</Relationships>').format(_PKG_REL_NS, sheet_rels, len(sheets) + 1, _DOC_TYPE).encode('utf-8')]):
+        yield data
+
+    for data in archive.part('xl/styles.xml', [(
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<styleSheet xmlns="{0}">'
+            '<fonts count="1"><font><sz val="11"/><name val="Calibri"/><family val="2"/></font></fonts>'
+            '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+            '<fill><patternFill patternType="gray125"/></fill></fills>'
+            '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+            '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+            '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+            '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+            '</styleSheet>').format(_NS).encode('utf-8')]):
+        yield data
+
+    for i, (name, header, blocks) in enumerate(sheets, 1):
+        for data in archive.part('xl/worksheets/sheet{0}.xml'.format(i), _sheet_xml(header, blocks)):
+            yield data
+
+    for data in archive.close():
+        yield data